@@ -0,0 +1,108 @@
+import hashlib
+import hmac
+import os
+import queue
+import threading
+import time
+
+import Metrics
+
+# scrypt cost: N = 2**KDF_COST with r=8, p=1 uses 128 * N * r bytes of memory
+# per hash (16 MiB at the default) and takes tens of milliseconds.
+DEFAULT_KDF_COST = 14
+KDF_R = 8
+KDF_P = 1
+SALT_BYTES = 16
+KEY_BYTES = 32
+
+KDF_SECONDS = Metrics.Histogram('multividchat_kdf_seconds', "Time spent hashing or verifying one password")
+AUTH_REJECTED = Metrics.Counter('multividchat_auth_rejected_total', "Password checks refused by the auth pool, by reason", label='reason')
+
+
+def _scrypt(password, salt, cost, r, p):
+    n = 1 << cost
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p,
+                          maxmem=256 * n * r * p, dklen=KEY_BYTES)
+
+
+def hash_password(password, cost=DEFAULT_KDF_COST):
+    # "scrypt$<log2 N>$<r>$<p>$<salt hex>$<key hex>"
+    salt = os.urandom(SALT_BYTES)
+    key = _scrypt(password, salt, cost, KDF_R, KDF_P)
+    return f"scrypt${cost}${KDF_R}${KDF_P}${salt.hex()}${key.hex()}"
+
+
+def is_legacy(password_hash):
+    return not password_hash.startswith('scrypt$')
+
+
+def verify_password(password, password_hash, cost=DEFAULT_KDF_COST):
+    # Returns (ok, new_hash). new_hash is set when the stored hash is a legacy
+    # unsalted SHA-256 digest or uses a different cost, so the caller can store
+    # the upgraded hash. Unknown users (password_hash None) still pay for one
+    # KDF run, so response time does not reveal which usernames exist.
+    if password_hash is None:
+        hash_password(password, cost)
+        return False, None
+
+    if is_legacy(password_hash):
+        digest = hashlib.sha256(password.encode('utf-8')).hexdigest()
+        if not hmac.compare_digest(digest, password_hash):
+            return False, None
+        return True, hash_password(password, cost)
+
+    try:
+        _, stored_cost, r, p, salt, key = password_hash.split('$')
+        stored_cost, r, p = int(stored_cost), int(r), int(p)
+        key = bytes.fromhex(key)
+        candidate = _scrypt(password, bytes.fromhex(salt), stored_cost, r, p)
+    except ValueError:
+        return False, None
+    if not hmac.compare_digest(candidate, key):
+        return False, None
+    if (stored_cost, r, p) != (cost, KDF_R, KDF_P):
+        return True, hash_password(password, cost)
+    return True, None
+
+
+class HashPool:
+    # A fixed set of worker threads for KDF jobs so the connection threads and
+    # the event loop never block on scrypt (hashlib releases the GIL while it
+    # runs, so the workers hash in parallel). The queue is bounded: submit()
+    # refuses new work once max_queue jobs are waiting, and a job that waited
+    # longer than timeout is answered with None instead of being run, so a
+    # login storm turns into fast "busy" replies instead of a growing backlog.
+    def __init__(self, workers=2, max_queue=256, timeout=5.0):
+        self.timeout = timeout
+        self._jobs = queue.Queue(max_queue)
+        self._threads = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def __len__(self):
+        return self._jobs.qsize()
+
+    def submit(self, job, done):
+        # Runs job() on a worker and calls done(result) there; done(None) if
+        # the job expired in the queue.
+        try:
+            self._jobs.put_nowait((time.monotonic() + self.timeout, job, done))
+        except queue.Full:
+            AUTH_REJECTED.inc('busy')
+            return False
+        return True
+
+    def _work(self):
+        while True:
+            deadline, job, done = self._jobs.get()
+            if time.monotonic() > deadline:
+                AUTH_REJECTED.inc('timeout')
+                done(None)
+                continue
+            try:
+                with KDF_SECONDS.time():
+                    result = job()
+            except Exception as e:
+                print(f"Password hashing failed: {e}")
+                result = None
+            done(result)
@@ -0,0 +1,65 @@
+from collections import OrderedDict, deque
+
+import Metrics
+
+DEFAULT_MESSAGES_PER_ROOM = 50
+DEFAULT_MAX_BYTES = 8 << 20
+
+# Rough per-entry cost of a bytes object in a deque, counted against the cap
+# so that many tiny messages cannot slip past it.
+ENTRY_OVERHEAD = 48
+
+EVICTED = Metrics.Counter('multividchat_room_backlog_evicted_total', "Room histories evicted to stay under the memory cap")
+
+
+class RoomBacklog:
+    # Recent chat lines per room, kept as UTF-8 bytes in a ring buffer of
+    # messages_per_room entries. Rooms are ordered by last write; once the
+    # total across all rooms passes max_bytes, whole rooms are evicted starting
+    # with the one that has been idle longest. Memory is therefore bounded by
+    # max_bytes no matter how many rooms are created.
+    def __init__(self, messages_per_room=DEFAULT_MESSAGES_PER_ROOM, max_bytes=DEFAULT_MAX_BYTES):
+        self.messages_per_room = messages_per_room
+        self.max_bytes = max_bytes
+        self.size_bytes = 0
+        self._rooms = OrderedDict()
+
+    def __len__(self):
+        return len(self._rooms)
+
+    def append(self, room_name, line):
+        if self.messages_per_room <= 0:
+            return
+        data = line.encode('utf-8')
+        entries = self._rooms.get(room_name)
+        if entries is None:
+            entries = self._rooms[room_name] = deque()
+        else:
+            self._rooms.move_to_end(room_name)
+
+        if len(entries) >= self.messages_per_room:
+            self.size_bytes -= len(entries.popleft()) + ENTRY_OVERHEAD
+        entries.append(data)
+        self.size_bytes += len(data) + ENTRY_OVERHEAD
+
+        while self.size_bytes > self.max_bytes and self._rooms:
+            _, evicted = self._rooms.popitem(last=False)
+            self.size_bytes -= sum(len(entry) + ENTRY_OVERHEAD for entry in evicted)
+            EVICTED.inc()
+
+    def replay(self, room_name, max_bytes=None):
+        # The backlog as one string, oldest line first. With max_bytes, only
+        # the newest lines that fit in that many UTF-8 bytes.
+        entries = self._rooms.get(room_name)
+        if not entries:
+            return ''
+        if max_bytes is not None:
+            kept = 0
+            size = -1
+            for entry in reversed(entries):
+                size += len(entry) + 1
+                if size > max_bytes:
+                    break
+                kept += 1
+            entries = list(entries)[len(entries) - kept:] if kept else []
+        return b'\n'.join(entries).decode('utf-8')
@@ -0,0 +1,516 @@
+import asyncio
+import argparse
+import json
+import os
+import random
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import Auth
+import Framing
+import Wire
+
+BENCH_TAG = 'bench:'
+
+
+def percentile(samples, fraction):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+def latency_summary(samples):
+    return {
+        "count": len(samples),
+        "p50_ms": percentile(samples, 0.50),
+        "p99_ms": percentile(samples, 0.99),
+        "max_ms": max(samples) if samples else None,
+    }
+
+
+def read_rss_kb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+# ---------------- CHAT CLIENT ----------------
+class ChatClient:
+    # Headless framed client. Benchmark chat lines are timestamped by the sender
+    # and timed on arrival by the reader task; everything else is queued for
+    # expect(). wire is 'text', 'binary' or 'zlib' (binary and compressed).
+    def __init__(self, username, password, stats, wire='text'):
+        self.username = username
+        self.password = password
+        self.stats = stats
+        self.wire = wire
+        self.bytes_received = 0
+        self.reader = None
+        self.writer = None
+        self.inbox = asyncio.Queue()
+        self._reader_task = None
+
+    async def connect(self, host, port):
+        self.reader, self.writer = await asyncio.open_connection(host, port)
+        self.writer.write(Framing.HELLO if self.wire == 'text' else Wire.hello(compress=self.wire == 'zlib'))
+        self._reader_task = asyncio.get_running_loop().create_task(self._read_loop())
+
+    async def _read_loop(self):
+        parser = Framing.FrameParser() if self.wire == 'text' else Wire.Decoder()
+        ack = Framing.HELLO_ACK if self.wire == 'text' else Wire.HELLO_ACK
+        pending = b''
+        try:
+            while True:
+                data = await self.reader.read(Framing.RECV_SIZE)
+                if not data:
+                    break
+                self.bytes_received += len(data)
+                if pending is not None:
+                    pending += data
+                    ack_at = pending.find(ack)
+                    ack_end = pending.find(b'\n', ack_at) if self.wire != 'text' else ack_at + len(ack) - 1
+                    if ack_at < 0 or ack_end < 0:
+                        continue
+                    data, pending = pending[ack_end + 1:], None
+                parser.feed(data)
+                for message in parser.read_messages():
+                    self._dispatch(message)
+        except (ConnectionError, OSError):
+            pass
+        finally:
+            self.inbox.put_nowait(None)
+
+    def _dispatch(self, message):
+        if message == 'H|ping':
+            self.send('H|pong')
+            return
+        at = message.find(BENCH_TAG)
+        if message.startswith('R|') and at >= 0:
+            sent_ns = int(message[at + len(BENCH_TAG):].split()[0])
+            self.stats['fanout_ms'].append((time.perf_counter_ns() - sent_ns) / 1e6)
+            self.stats['delivered'] += 1
+            return
+        self.inbox.put_nowait(message)
+
+    def send(self, *messages):
+        self.writer.write(Framing.encode_frames([message.encode('utf-8') for message in messages]))
+
+    async def expect(self, predicate, timeout=10.0):
+        deadline = time.monotonic() + timeout
+        while True:
+            message = await asyncio.wait_for(self.inbox.get(), max(0.0, deadline - time.monotonic()))
+            if message is None:
+                raise ConnectionError(f"{self.username}: server closed the connection")
+            if predicate(message):
+                return message
+
+    async def authenticate(self, choice):
+        self.send(choice, self.username, self.password)
+        return await self.expect(lambda m: m.startswith('F|') or m.startswith('I|') and 'Welcome,' in m)
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+        if self._reader_task is not None:
+            await self._reader_task
+
+
+async def gather_limited(coros, limit):
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(coro) for coro in coros))
+
+
+# ---------------- PHASES ----------------
+async def phase_connect(clients, args, choice):
+    busy = 0
+
+    async def connect_one(client):
+        nonlocal busy
+        await client.connect(args.host, args.port)
+        reply = await client.authenticate(choice)
+        # The server sheds password checks it cannot get to in time; back off
+        # and retry like a real client would.
+        while reply.startswith('F|Server busy'):
+            busy += 1
+            await asyncio.sleep(random.uniform(0.1, 0.5))
+            reply = await client.authenticate(choice)
+        if reply.startswith('F|'):
+            raise RuntimeError(f"{client.username}: {reply}")
+
+    started = time.perf_counter()
+    await gather_limited([connect_one(client) for client in clients], args.concurrency)
+    elapsed = time.perf_counter() - started
+    return {"clients": len(clients), "seconds": elapsed, "per_sec": len(clients) / elapsed, "busy_retries": busy}
+
+
+def phase_kdf(args, rounds=20):
+    # Single-thread cost of one password hash at --kdf-cost, the ceiling for
+    # logins/sec per auth worker on this machine.
+    started = time.perf_counter()
+    for _ in range(rounds):
+        Auth.hash_password('benchpw', args.kdf_cost)
+    elapsed = time.perf_counter() - started
+    return {"cost": args.kdf_cost, "ms_per_hash": elapsed * 1000 / rounds, "hashes_per_sec": rounds / elapsed}
+
+
+async def phase_join(clients, args):
+    async def join_one(i, client):
+        client.send(f'/join {args.room_prefix}{i % args.rooms}')
+        await client.expect(lambda m: 'You joined:' in m)
+
+    started = time.perf_counter()
+    await gather_limited([join_one(i, client) for i, client in enumerate(clients)], args.concurrency)
+    # Join notices from later joiners are still arriving; they are not part of
+    # the measurement.
+    await asyncio.sleep(0.5)
+    for client in clients:
+        while not client.inbox.empty():
+            client.inbox.get_nowait()
+    return {"rooms": args.rooms, "seconds": time.perf_counter() - started}
+
+
+async def phase_chat(clients, args, stats):
+    # Every client sends args.rate messages per second for args.duration
+    # seconds; receivers time each delivery against the embedded send time.
+    interval = 1.0 / args.rate
+    # phase_join put client i in room i % args.rooms; rooms differ in size by
+    # one when the clients do not divide evenly.
+    room_sizes = [len(range(room, len(clients), args.rooms)) for room in range(args.rooms)]
+    expected = 0
+
+    async def talk(i, client):
+        nonlocal expected
+        await asyncio.sleep(random.random() * interval)
+        deadline = time.monotonic() + args.duration
+        while time.monotonic() < deadline:
+            client.send(f'{BENCH_TAG}{time.perf_counter_ns()}')
+            stats['sent'] += 1
+            expected += room_sizes[i % args.rooms] - 1
+            await asyncio.sleep(interval)
+
+    received_before = sum(client.bytes_received for client in clients)
+    started = time.perf_counter()
+    await asyncio.gather(*(talk(i, client) for i, client in enumerate(clients)))
+    await asyncio.sleep(args.drain)
+    elapsed = time.perf_counter() - started - args.drain
+    received = sum(client.bytes_received for client in clients) - received_before
+
+    return {
+        "sent": stats['sent'],
+        "delivered": stats['delivered'],
+        "delivery_ratio": stats['delivered'] / expected if expected else None,
+        "msgs_per_sec": stats['sent'] / elapsed,
+        "deliveries_per_sec": stats['delivered'] / elapsed,
+        "bytes_per_delivery": received / stats['delivered'] if stats['delivered'] else None,
+        "fanout_latency": latency_summary(stats['fanout_ms']),
+    }
+
+
+async def phase_pm_history(clients, args):
+    pm_ms = []
+    history_ms = []
+    usernames = [client.username for client in clients]
+
+    async def exchange(client):
+        for _ in range(args.pms):
+            recipient = random.choice(usernames)
+            started = time.perf_counter()
+            client.send(f'/pm {recipient} benchmark pm')
+            await client.expect(lambda m: m.startswith('O|'))
+            pm_ms.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        client.send(f'/history {random.choice(usernames)} limit 20')
+        await client.expect(lambda m: m.startswith('I|') and 'PM History' in m or 'No private message' in m)
+        history_ms.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await gather_limited([exchange(client) for client in clients], args.concurrency)
+    elapsed = time.perf_counter() - started
+    return {
+        "pms_per_sec": len(pm_ms) / elapsed,
+        "pm_latency": latency_summary(pm_ms),
+        "history_latency": latency_summary(history_ms),
+    }
+
+
+async def phase_signaling(args):
+    # Drives offer/ice relays through the signaling server's /ws endpoint.
+    import aiohttp
+
+    latencies = []
+    peer_ids = {}
+    hints = []
+    per_room = args.ws_room_size
+    rooms = max(1, args.ws_peers // per_room)
+
+    async with aiohttp.ClientSession() as session:
+        sockets = []
+        started = time.perf_counter()
+        for i in range(rooms * per_room):
+            ws = await session.ws_connect(args.ws_url)
+            await ws.send_json({"action": "set_user", "username": f"bench{i}", "room": f"{args.room_prefix}ws{i % rooms}"})
+            sockets.append(ws)
+        connect_seconds = time.perf_counter() - started
+
+        async def listen(ws):
+            async for msg in ws:
+                data = json.loads(msg.data)
+                if data.get("action") in ("offer", "ice") and "sent_ns" in data:
+                    latencies.append((time.perf_counter_ns() - data["sent_ns"]) / 1e6)
+                elif data.get("action") == "set_user_ack":
+                    peer_ids[ws] = (data["peerId"], [peer["peerId"] for peer in data["peers"]])
+                elif data.get("action") == "peer_joined":
+                    peer_ids[ws][1].append(data["peerId"])
+                elif data.get("action") == "bitrate_hint":
+                    hints.append(data["maxBitrate"])
+
+        listeners = [asyncio.get_running_loop().create_task(listen(ws)) for ws in sockets]
+        await asyncio.sleep(0.2)
+
+        sent = 0
+        started = time.perf_counter()
+        for _ in range(args.ws_rounds):
+            for ws in sockets:
+                await ws.send_json({"action": "offer", "offer": {"type": "offer", "sdp": "v=0"}, "sent_ns": time.perf_counter_ns()})
+                await ws.send_json({"action": "ice", "candidate": {"candidate": ""}, "sent_ns": time.perf_counter_ns()})
+                sent += 2
+        await asyncio.sleep(args.drain)
+        elapsed = time.perf_counter() - started - args.drain
+
+        quality = None
+        if args.ws_stats_rounds:
+            quality = await fake_quality_reports(session, args, sockets, peer_ids, hints)
+
+        for ws in sockets:
+            await ws.close()
+        for listener in listeners:
+            listener.cancel()
+
+    return {
+        "peers": len(sockets),
+        "connects_per_sec": len(sockets) / connect_seconds,
+        "signals_sent": sent,
+        "signals_per_sec": sent / elapsed,
+        "relay_latency": latency_summary(latencies),
+        "quality": quality,
+    }
+
+
+async def fake_quality_reports(session, args, sockets, peer_ids, hints):
+    # Stands in for the browsers' getStats() sampling: every peer reports on
+    # each other peer of its room once a second, and the first room's links
+    # lose 10% of their packets so adaptive mode has something to act on.
+    rooms = max(1, len(sockets) // args.ws_room_size)
+    lossy = sockets[::rooms]
+    for _ in range(args.ws_stats_rounds):
+        for ws in sockets:
+            _, others = peer_ids.get(ws, (None, []))
+            lost = 40 if ws in lossy else 0
+            await ws.send_json({"action": "stats", "peers": {
+                other: {"dt": 1000, "rtt": 40, "jitter": 8, "lost": lost, "recv": 400 - lost,
+                        "rx": 125000, "tx": 125000, "fps": 30, "path": "host/srflx"}
+                for other in others}})
+        await asyncio.sleep(1.1)
+
+    url = args.ws_url.rsplit('/', 1)[0] + '/stats/quality'
+    async with session.get(url) as response:
+        snapshot = await response.json()
+    return {
+        "reports_sent": args.ws_stats_rounds * len(sockets),
+        "calls": len(snapshot["calls"]),
+        "reports_aggregated": sum(call["reports"] for call in snapshot["calls"]),
+        "bitrate_hints": len(hints),
+        "lowest_hint": min((hint for hint in hints if hint), default=None),
+    }
+
+
+async def phase_restart(args, process):
+    # Restarts a spawned server with SIGUSR2 while a logged-in client waits to
+    # resume and a prober keeps opening new connections. Reports how long the
+    # old process took to hand over, how soon the client was back in its
+    # session, and whether any connection attempt failed in between.
+    client = ChatClient(f"restart{os.getpid()}", "benchpw", {"fanout_ms": []})
+    await client.connect(args.host, args.port)
+    reply = await client.authenticate('1')
+    if reply.startswith('F|'):
+        raise RuntimeError(f"{client.username}: {reply}")
+    token = (await client.expect(lambda m: m.startswith('K|')))[2:]
+
+    probes = {"ok": 0, "failed": 0, "max_ms": 0.0}
+    stop = asyncio.Event()
+
+    async def probe():
+        while not stop.is_set():
+            started = time.perf_counter()
+            try:
+                reader, writer = await asyncio.wait_for(asyncio.open_connection(args.host, args.port), 5)
+                welcome = await asyncio.wait_for(reader.read(64), 5)
+                writer.close()
+            except (OSError, asyncio.TimeoutError):
+                welcome = b''
+            if welcome.startswith(b'T|Welcome'):
+                probes["ok"] += 1
+                probes["max_ms"] = max(probes["max_ms"], (time.perf_counter() - started) * 1000)
+            else:
+                probes["failed"] += 1
+            await asyncio.sleep(0.01)
+
+    prober = asyncio.get_running_loop().create_task(probe())
+    signalled = time.perf_counter()
+    process.send_signal(signal.SIGUSR2)
+    try:
+        while True:
+            message = await client.expect(lambda m: True, timeout=30)
+            if message.startswith('K|'):
+                token = message[2:]
+    except ConnectionError:
+        pass
+    dropped_ms = (time.perf_counter() - signalled) * 1000
+    await client.close()
+
+    resumed = ChatClient(client.username, client.password, client.stats)
+    await resumed.connect(args.host, args.port)
+    resumed.send(f'RESUME|{token}')
+    await resumed.expect(lambda m: m.startswith('S|Session restored'))
+    resumed_ms = (time.perf_counter() - signalled) * 1000
+    await resumed.close()
+
+    while process.poll() is None:
+        await asyncio.sleep(0.05)
+    handover_ms = (time.perf_counter() - signalled) * 1000
+    await asyncio.sleep(0.5)
+    stop.set()
+    await prober
+    return {"dropped_ms": dropped_ms, "resumed_ms": resumed_ms, "old_process_exit_ms": handover_ms, "probes": probes}
+
+
+# ---------------- MAIN ----------------
+def spawn_server(args):
+    workdir = tempfile.mkdtemp(prefix='multividchat-bench-')
+    # The login storm is the point of the benchmark, so the server-wide
+    # connect/login limits are lifted unless --server-args sets them again.
+    # Video calls stay off so a bridge under test can keep its port.
+    command = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Server.py'), '--port', str(args.port),
+               '--kdf-cost', str(args.kdf_cost), '--rate-limit', 'connect=0', '--rate-limit', 'login=0', '--http-port', '0',
+               *args.server_args.split()]
+    # Own process group: after --restart the server running is the old one's
+    # successor, and both must be stopped at the end.
+    process = subprocess.Popen(command, cwd=workdir, stdout=subprocess.DEVNULL, start_new_session=True)
+    time.sleep(1.0)
+    return process
+
+
+async def run(args):
+    server_pid = args.server_pid
+    process = None
+    if args.spawn:
+        process = spawn_server(args)
+        server_pid = process.pid
+
+    stats = {"sent": 0, "delivered": 0, "fanout_ms": []}
+    run_id = f"{os.getpid()}{random.randrange(1000)}"
+    result = {"config": {k: v for k, v in vars(args).items()}}
+
+    try:
+        result["kdf"] = phase_kdf(args)
+        rss_before = read_rss_kb(server_pid) if server_pid else None
+        clients = [ChatClient(f"b{run_id}_{i}", "benchpw", stats, args.wire) for i in range(args.clients)]
+        result["register"] = await phase_connect(clients, args, '1')
+
+        if not args.skip_login:
+            for client in clients:
+                await client.close()
+            clients = [ChatClient(client.username, client.password, stats, args.wire) for client in clients]
+            result["login"] = await phase_connect(clients, args, '2')
+
+        result["join"] = await phase_join(clients, args)
+
+        if server_pid:
+            rss_after = read_rss_kb(server_pid)
+            if rss_before is not None and rss_after is not None:
+                result["rss"] = {
+                    "before_kb": rss_before,
+                    "after_kb": rss_after,
+                    "per_connection_kb": (rss_after - rss_before) / len(clients),
+                }
+
+        result["chat"] = await phase_chat(clients, args, stats)
+        if args.pms:
+            result["pm"] = await phase_pm_history(clients, args)
+
+        for client in clients:
+            await client.close()
+
+        if args.ws_url:
+            result["signaling"] = await phase_signaling(args)
+
+        if args.restart:
+            result["restart"] = await phase_restart(args, process)
+    finally:
+        if process is not None:
+            try:
+                os.killpg(process.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+            process.wait()
+
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Load test and latency benchmark for Server.py and BridgeClient.py")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--clients', type=int, default=200)
+    parser.add_argument('--rooms', type=int, default=10)
+    parser.add_argument('--rate', type=float, default=2.0, help="chat messages per client per second")
+    parser.add_argument('--duration', type=float, default=5.0, help="seconds of chat traffic")
+    parser.add_argument('--drain', type=float, default=1.0, help="seconds to wait for in-flight deliveries")
+    parser.add_argument('--pms', type=int, default=5, help="/pm round trips per client (0 to skip)")
+    parser.add_argument('--concurrency', type=int, default=200, help="max connects/logins in flight")
+    parser.add_argument('--wire', choices=['text', 'binary', 'zlib'], default='text',
+                        help="server-to-client encoding the benchmark clients negotiate")
+    parser.add_argument('--room-prefix', default='bench')
+    parser.add_argument('--skip-login', action='store_true', help="only register, do not reconnect and log in")
+    parser.add_argument('--server-pid', type=int, default=None, help="sample this process's RSS")
+    parser.add_argument('--spawn', action='store_true', help="start a throwaway Server.py in a temp dir")
+    parser.add_argument('--restart', action='store_true', help="with --spawn: finish with a graceful restart and time the handover")
+    parser.add_argument('--kdf-cost', type=int, default=Auth.DEFAULT_KDF_COST, metavar='LOG2_N',
+                        help="scrypt cost to measure, also passed to a spawned server")
+    parser.add_argument('--server-args', default='', help="extra arguments for the spawned server")
+    parser.add_argument('--ws-url', default=None, help="e.g. http://127.0.0.1:8000/ws to benchmark signaling")
+    parser.add_argument('--ws-peers', type=int, default=50)
+    parser.add_argument('--ws-room-size', type=int, default=2)
+    parser.add_argument('--ws-rounds', type=int, default=20)
+    parser.add_argument('--ws-stats-rounds', type=int, default=0,
+                        help="then send this many rounds of fake call-quality reports, one per second")
+    parser.add_argument('--output', default='-', help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+    if args.restart and not args.spawn:
+        parser.error("--restart needs --spawn")
+
+    report = json.dumps(asyncio.run(run(args)), indent=2)
+    if args.output == '-':
+        print(report)
+    else:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(report + '\n')
@@ -1,58 +1,311 @@
+import argparse
 import asyncio
 import json
-from aiohttp import web
+import os
+import time
+import uuid
+from aiohttp import web, WSMsgType, WSCloseCode
+
+import CallQuality
 
 PORT = 8000
+SEND_TIMEOUT = 2.0
+VIDEO_HTML = os.path.join(os.path.dirname(os.path.abspath(__file__)), "VideoClient.html")
+
+ROOM_STATS = {}
+STARTED_AT = time.time()
+TOTALS = {"connections": 0, "relayed": 0, "send_failures": 0, "quality_reports": 0, "bitrate_hints": 0}
+# Call quality from the browsers' getStats() reports, served on /stats/quality.
+QUALITY = CallQuality.QualityBoard()
+
+SIGNAL_ACTIONS = ["offer", "answer", "ice", "ready"]
+
+
+# ---------------- MEMBERSHIP ----------------
+class BridgeRooms:
+    # Who is in which video room. Running on its own the bridge trusts the
+    # username and room a peer names in set_user and gives it a random peer
+    # id. Server.py passes its own implementation with the same methods so
+    # the chat sessions stay the single source of identity and membership.
+    def __init__(self):
+        self.joined = {}
+        self.room_peers = {}
+        self.names = {}
+
+    def identify(self, data):
+        # Returns (peer_id, username, room), or None to turn the peer away.
+        room = data.get("room")
+        if not room or not isinstance(room, str):
+            return None
+        return uuid.uuid4().hex[:12], data.get("username"), room
+
+    def add(self, ws, peer_id, username, room):
+        self.room_peers.setdefault(room, {})[peer_id] = ws
+        self.joined[ws] = (room, peer_id)
+        self.names[peer_id] = username
+
+    def remove(self, ws):
+        # Returns (room, peer_id) for a peer that had joined, else None.
+        joined = self.joined.pop(ws, None)
+        if joined is None:
+            return None
+        room, peer_id = joined
+        self.names.pop(peer_id, None)
+        peers = self.room_peers.get(room, {})
+        peers.pop(peer_id, None)
+        if not peers:
+            self.room_peers.pop(room, None)
+        return joined
+
+    def peers(self, room):
+        # peer id -> websocket for everyone in the room's call.
+        return self.room_peers.get(room, {})
+
+    def name(self, peer_id):
+        return self.names.get(peer_id)
+
+
+ROOMS = BridgeRooms()
+
+
+# ---------------- STATS ----------------
+def room_stats(room):
+    stats = ROOM_STATS.get(room)
+    if stats is None:
+        stats = ROOM_STATS[room] = {
+            "created": time.time(),
+            "peers": 0,
+            "peak_peers": 0,
+            "joins": 0,
+            "relayed": {},
+            "bytes": 0,
+            "send_failures": 0,
+            "send_timeouts": 0,
+            "ttff_ms": {"count": 0, "avg": None, "min": None, "max": None},
+        }
+    return stats
+
+
+async def stats(request):
+    return web.json_response({
+        "uptime": time.time() - STARTED_AT,
+        "connections": len(ROOMS.joined),
+        "totals": TOTALS,
+        "rooms": ROOM_STATS,
+    })
+
+
+async def quality(request):
+    return web.json_response(QUALITY.snapshot())
+
+
+async def record_quality(room, peer_id, report):
+    TOTALS["quality_reports"] += 1
+    for sender, receiver, max_bitrate in QUALITY.ingest(room, peer_id, report):
+        # The cap applies to the one connection of the mesh that carries
+        # sender's video to receiver.
+        target = ROOMS.peers(room).get(sender)
+        if target is not None:
+            TOTALS["bitrate_hints"] += 1
+            await send_with_timeout(target, json.dumps({"action": "bitrate_hint", "peerId": receiver, "maxBitrate": max_bitrate}))
+
+
+def record_ttff(room, ttff):
+    sample = room_stats(room)["ttff_ms"]
+    sample["count"] += 1
+    if sample["avg"] is None:
+        sample["avg"] = sample["min"] = sample["max"] = ttff
+    else:
+        sample["avg"] += (ttff - sample["avg"]) / sample["count"]
+        sample["min"] = min(sample["min"], ttff)
+        sample["max"] = max(sample["max"], ttff)
 
-ROOM_PEERS = {}
-ws_room_map = {}
 
 # ---------------- HTML ROUTE ----------------
 async def index(request):
-    return web.FileResponse("VideoClient.html")
+    return web.FileResponse(VIDEO_HTML)
+
+
+# ---------------- FAN-OUT ----------------
+async def send_with_timeout(peer, text):
+    try:
+        await asyncio.wait_for(peer.send_str(text), SEND_TIMEOUT)
+        return None
+    except asyncio.TimeoutError:
+        return "timeout"
+    except (ConnectionError, RuntimeError):
+        return "error"
+
+
+async def relay(room, data, targets):
+    # Serializes once and sends to every target concurrently, so one slow or
+    # dead socket costs at most SEND_TIMEOUT instead of stalling every peer
+    # queued behind it.
+    if not targets:
+        return
+    text = json.dumps(data)
+    results = await asyncio.gather(*(send_with_timeout(peer, text) for peer in targets))
+
+    stats = room_stats(room)
+    action = data.get("action")
+    stats["relayed"][action] = stats["relayed"].get(action, 0) + len(targets)
+    stats["bytes"] += len(text) * len(targets)
+    TOTALS["relayed"] += len(targets)
+
+    for peer, failure in zip(targets, results):
+        if failure is None:
+            continue
+        TOTALS["send_failures"] += 1
+        stats["send_timeouts" if failure == "timeout" else "send_failures"] += 1
+        # A peer that cannot take a signaling message is gone for practical
+        # purposes; dropping it here stops later relays from waiting on it.
+        await leave_room(peer)
+        await peer.close()
+
+
+# ---------------- ROOMS ----------------
+async def join_room(ws, peer_id, username, room):
+    peers = ROOMS.peers(room)
+    existing = [{"peerId": other_id, "username": ROOMS.name(other_id)} for other_id in peers if other_id != peer_id]
+    ROOMS.add(ws, peer_id, username, room)
+    QUALITY.join(room, peer_id)
+
+    stats = room_stats(room)
+    stats["joins"] += 1
+    stats["peers"] = len(ROOMS.peers(room))
+    stats["peak_peers"] = max(stats["peak_peers"], stats["peers"])
+
+    # The newcomer offers to everyone already in the room; with a fresh peer
+    # list per join this stays correct across reconnects.
+    await ws.send_json({
+        "action": "set_user_ack",
+        "peerId": peer_id,
+        "peers": existing,
+        "isCaller": bool(existing)
+    })
+    await relay(room, {"action": "peer_joined", "peerId": peer_id, "username": username},
+                [peer for other_id, peer in ROOMS.peers(room).items() if other_id != peer_id])
+
+
+async def leave_room(ws):
+    left = ROOMS.remove(ws)
+    if left is None:
+        return
+    room, peer_id = left
+    QUALITY.leave(room, peer_id)
+
+    peers = ROOMS.peers(room)
+    room_stats(room)["peers"] = len(peers)
+    if not peers:
+        ROOM_STATS.pop(room, None)
+        return
+
+    await relay(room, {"action": "peer_left", "peerId": peer_id}, list(peers.values()))
+
 
 # ---------------- WEBSOCKET ----------------
 async def websocket_handler(request):
     ws = web.WebSocketResponse()
     await ws.prepare(request)
+    TOTALS["connections"] += 1
 
-    room = None
-
-    async for msg in ws:
-        data = json.loads(msg.data)
-        action = data.get("action")
+    try:
+        async for msg in ws:
+            if msg.type != WSMsgType.TEXT:
+                continue
+            try:
+                data = json.loads(msg.data)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(data, dict):
+                continue
+            action = data.get("action")
 
-        if action == "set_user":
-            room = data["room"]
-            ws_room_map[ws] = room
+            if action == "set_user":
+                await leave_room(ws)
+                identity = ROOMS.identify(data)
+                if identity is None:
+                    await ws.close(code=WSCloseCode.POLICY_VIOLATION, message=b"unknown session")
+                    break
+                await join_room(ws, *identity)
 
-            ROOM_PEERS.setdefault(room, []).append(ws)
+            elif action in SIGNAL_ACTIONS:
+                joined = ROOMS.joined.get(ws)
+                if joined is None:
+                    continue
 
-            is_caller = len(ROOM_PEERS[room]) == 1
+                room, data["from"] = joined
+                peers = ROOMS.peers(room)
+                target = data.get("to")
+                if target is not None and not isinstance(target, str):
+                    continue
+                if target is not None:
+                    # Addressed signaling: each pair in a mesh negotiates its
+                    # own connection.
+                    targets = [peers[target]] if target in peers else []
+                else:
+                    targets = [peer for peer in peers.values() if peer is not ws]
 
-            await ws.send_json({
-                "action": "set_user_ack",
-                "isCaller": is_caller
-            })
+                await relay(room, data, targets)
 
-        elif action in ["offer", "answer", "ice"]:
-            room = ws_room_map.get(ws)
-            if not room:
-                continue
+            elif action == "metrics":
+                joined = ROOMS.joined.get(ws)
+                if joined and isinstance(data.get("ttff"), (int, float)):
+                    record_ttff(joined[0], data["ttff"])
 
-            for peer in ROOM_PEERS.get(room, []):
-                if peer != ws:
-                    await peer.send_json(data)
+            elif action == "stats":
+                joined = ROOMS.joined.get(ws)
+                if joined:
+                    await record_quality(*joined, data)
+    finally:
+        await leave_room(ws)
 
     return ws
 
 # ---------------- APP ----------------
-app = web.Application()
-app.add_routes([
-    web.get("/", index),
-    web.get("/VideoClient.html", index),
-    web.get("/ws", websocket_handler)
-])
+async def close_peers(app):
+    # Runs on SIGTERM/SIGINT. The listener is bound with SO_REUSEPORT, so a
+    # replacement bridge can be started on the same port first; peers are told
+    # the service is restarting (1012) and reconnect to it.
+    for ws in list(ROOMS.joined):
+        await ws.close(code=WSCloseCode.SERVICE_RESTART, message=b"restarting")
+
+
+def make_app():
+    app = web.Application()
+    app.on_shutdown.append(close_peers)
+    app.add_routes([
+        web.get("/", index),
+        web.get("/VideoClient.html", index),
+        web.get("/ws", websocket_handler),
+        web.get("/stats", stats),
+        web.get("/stats/quality", quality)
+    ])
+    return app
+
+
+async def start(rooms, host="0.0.0.0", port=PORT, sock=None, adaptive=False):
+    # Serves the bridge from the caller's event loop with rooms as the
+    # membership source, on host:port or an already listening sock. Returns
+    # the runner; its cleanup() closes every peer with 1012.
+    global ROOMS
+    ROOMS = rooms
+    QUALITY.adaptive = adaptive
+    runner = web.AppRunner(make_app())
+    await runner.setup()
+    if sock is not None:
+        site = web.SockSite(runner, sock)
+    else:
+        site = web.TCPSite(runner, host, port)
+    await site.start()
+    return runner
+
 
 if __name__ == "__main__":
-    web.run_app(app, host="0.0.0.0", port=PORT)
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Standalone video signaling bridge")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--adaptive-bitrate', action='store_true',
+                        help="send video senders maxBitrate hints when their receivers report packet loss")
+    args = parser.parse_args()
+    QUALITY.adaptive = args.adaptive_bitrate
+    web.run_app(make_app(), host="0.0.0.0", port=args.port, reuse_port=True)
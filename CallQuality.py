@@ -0,0 +1,263 @@
+import math
+import time
+from collections import deque
+
+# Browsers in a call send a "stats" message every few seconds with one entry
+# per remote peer, each the change since their previous report:
+#   {"action": "stats", "peers": {peer_id: {"dt": ms covered, "rtt": ms,
+#    "jitter": ms, "lost": packets, "recv": packets, "rx": bytes received,
+#    "tx": bytes sent, "fps": frames/s received, "path": "host/srflx"}}}
+# Every field is optional. Values are folded into rolling windows per room and
+# per call, a call lasting from the first peer joining a room's video to the
+# last one leaving.
+WINDOW_SECONDS = 60
+BUCKET_SECONDS = 5
+RECENT_CALLS = 20
+# Reports closer together than this from one peer are dropped.
+MIN_REPORT_INTERVAL = 1.0
+
+# Upper bounds for values taken from a report; anything outside is ignored.
+LIMITS = {'dt': 600000, 'rtt': 60000, 'jitter': 60000, 'lost': 1e9, 'recv': 1e9, 'rx': 1e12, 'tx': 1e12, 'fps': 240}
+PATH_TYPES = ('host', 'srflx', 'prflx', 'relay')
+
+# Adaptive bitrate: a receiver whose smoothed loss from a sender passes
+# LOSS_HIGH gets that sender's stream capped at DECREASE times its current
+# rate; once loss stays under LOSS_LOW the cap is raised by INCREASE until it
+# reaches MAX_BITRATE and is lifted. At most one change per pair per
+# HINT_INTERVAL.
+LOSS_HIGH = 0.05
+LOSS_LOW = 0.01
+LOSS_SMOOTHING = 0.3
+DECREASE = 0.7
+INCREASE = 1.15
+MIN_BITRATE = 150000
+MAX_BITRATE = 2500000
+HINT_INTERVAL = 4.0
+
+
+def _number(value, limit):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        return None
+    if not math.isfinite(value) or value < 0 or value > limit:
+        return None
+    return value
+
+
+def parse_sample(entry):
+    # One peer's entry of a report -> (metric values, path), or None.
+    if not isinstance(entry, dict):
+        return None
+    raw = {key: _number(entry.get(key), limit) for key, limit in LIMITS.items()}
+    values = {}
+    if raw['rtt'] is not None:
+        values['rtt_ms'] = raw['rtt']
+    if raw['jitter'] is not None:
+        values['jitter_ms'] = raw['jitter']
+    if raw['lost'] is not None and raw['recv'] is not None and raw['lost'] + raw['recv'] > 0:
+        values['loss'] = raw['lost'] / (raw['lost'] + raw['recv'])
+    if raw['dt']:
+        if raw['rx'] is not None:
+            values['kbps_in'] = raw['rx'] * 8 / raw['dt']
+        if raw['tx'] is not None:
+            values['kbps_out'] = raw['tx'] * 8 / raw['dt']
+    if raw['fps'] is not None:
+        values['fps'] = raw['fps']
+
+    path = entry.get('path')
+    if not isinstance(path, str) or any(part not in PATH_TYPES for part in path.split('/')) or path.count('/') != 1:
+        path = None
+    return values, path
+
+
+class RollingWindow:
+    # count/sum/min/max per metric in BUCKET_SECONDS buckets, of which only
+    # those in the last WINDOW_SECONDS are kept, so memory stays fixed however
+    # long a call runs.
+    def __init__(self, seconds=WINDOW_SECONDS, bucket_seconds=BUCKET_SECONDS):
+        self.seconds = seconds
+        self.bucket_seconds = bucket_seconds
+        self._buckets = deque()
+
+    def _expire(self, now):
+        while self._buckets and self._buckets[0][0] <= now - self.seconds:
+            self._buckets.popleft()
+
+    def empty(self, now):
+        self._expire(now)
+        return not self._buckets
+
+    def add(self, values, path=None, now=None):
+        now = time.time() if now is None else now
+        start = now - now % self.bucket_seconds
+        if not self._buckets or self._buckets[-1][0] != start:
+            self._buckets.append((start, {}, {}))
+            self._expire(now)
+        _, metrics, paths = self._buckets[-1]
+        for name, value in values.items():
+            stats = metrics.get(name)
+            if stats is None:
+                metrics[name] = [1, value, value, value]
+            else:
+                stats[0] += 1
+                stats[1] += value
+                stats[2] = min(stats[2], value)
+                stats[3] = max(stats[3], value)
+        if path:
+            paths[path] = paths.get(path, 0) + 1
+
+    def summary(self, now=None):
+        now = time.time() if now is None else now
+        self._expire(now)
+        merged = {}
+        paths = {}
+        for _, metrics, bucket_paths in self._buckets:
+            for name, (count, total, low, high) in metrics.items():
+                stats = merged.get(name)
+                if stats is None:
+                    merged[name] = [count, total, low, high]
+                else:
+                    stats[0] += count
+                    stats[1] += total
+                    stats[2] = min(stats[2], low)
+                    stats[3] = max(stats[3], high)
+            for path, count in bucket_paths.items():
+                paths[path] = paths.get(path, 0) + count
+        result = {name: {"count": count, "avg": round(total / count, 4), "min": round(low, 4), "max": round(high, 4)}
+                  for name, (count, total, low, high) in merged.items()}
+        result["paths"] = paths
+        return result
+
+
+class Call:
+    __slots__ = ('id', 'room', 'started', 'ended', 'peers', 'reports', 'hints', 'window', 'last_report', 'pairs')
+
+    def __init__(self, call_id, room, now):
+        self.id = call_id
+        self.room = room
+        self.started = now
+        self.ended = None
+        self.peers = set()
+        self.reports = 0
+        self.hints = 0
+        self.window = RollingWindow()
+        self.last_report = {}
+        # (sender, receiver) -> [smoothed loss, cap in bit/s or None, last change]
+        self.pairs = {}
+
+    def summary(self, now):
+        return {
+            "id": self.id,
+            "room": self.room,
+            "started": self.started,
+            "ended": self.ended,
+            "peers": sorted(self.peers),
+            "reports": self.reports,
+            "hints": self.hints,
+            "window": self.window.summary(now),
+            "caps": {f"{sender}->{receiver}": pair[1] for (sender, receiver), pair in self.pairs.items() if pair[1]},
+        }
+
+
+class QualityBoard:
+    # Calls in progress by room, rolling windows per room that outlive single
+    # calls, and the last RECENT_CALLS finished calls. ingest() returns the
+    # bitrate hints to push as (sender, receiver, max bit/s or None to lift
+    # the cap) when adaptive is on.
+    def __init__(self, adaptive=False):
+        self.adaptive = adaptive
+        self.calls = {}
+        self.rooms = {}
+        self.recent = deque(maxlen=RECENT_CALLS)
+        self._next_id = 1
+
+    def join(self, room, peer_id, now=None):
+        now = time.time() if now is None else now
+        call = self.calls.get(room)
+        if call is None:
+            call = self.calls[room] = Call(self._next_id, room, now)
+            self._next_id += 1
+        call.peers.add(peer_id)
+        return call
+
+    def leave(self, room, peer_id, now=None):
+        call = self.calls.get(room)
+        if call is None:
+            return
+        call.peers.discard(peer_id)
+        call.last_report.pop(peer_id, None)
+        for pair in [pair for pair in call.pairs if peer_id in pair]:
+            del call.pairs[pair]
+        if not call.peers:
+            call.ended = time.time() if now is None else now
+            self.recent.append(call.summary(call.ended))
+            del self.calls[room]
+
+    def ingest(self, room, peer_id, report, now=None):
+        now = time.time() if now is None else now
+        call = self.calls.get(room)
+        peers = report.get("peers") if isinstance(report, dict) else None
+        if call is None or peer_id not in call.peers or not isinstance(peers, dict):
+            return []
+        if now - call.last_report.get(peer_id, -MIN_REPORT_INTERVAL) < MIN_REPORT_INTERVAL:
+            return []
+        call.last_report[peer_id] = now
+        call.reports += 1
+        room_window = self.rooms.get(room)
+        if room_window is None:
+            room_window = self.rooms[room] = RollingWindow()
+
+        hints = []
+        for sender, entry in peers.items():
+            if sender == peer_id or sender not in call.peers:
+                continue
+            sample = parse_sample(entry)
+            if sample is None:
+                continue
+            values, path = sample
+            call.window.add(values, path, now)
+            room_window.add(values, path, now)
+            if self.adaptive and 'loss' in values:
+                hint = self._adapt(call, sender, peer_id, values, now)
+                if hint is not None:
+                    hints.append(hint)
+        return hints
+
+    def _adapt(self, call, sender, receiver, values, now):
+        pair = call.pairs.get((sender, receiver))
+        if pair is None:
+            pair = call.pairs[(sender, receiver)] = [values['loss'], None, -HINT_INTERVAL]
+        else:
+            pair[0] += LOSS_SMOOTHING * (values['loss'] - pair[0])
+        loss, cap, changed = pair
+        if now - changed < HINT_INTERVAL:
+            return None
+
+        if loss > LOSS_HIGH:
+            current = cap or min(MAX_BITRATE, values.get('kbps_in', MAX_BITRATE / 1000) * 1000)
+            new_cap = max(MIN_BITRATE, int(current * DECREASE))
+            if new_cap == cap:
+                return None
+        elif loss < LOSS_LOW and cap:
+            new_cap = int(cap * INCREASE)
+            if new_cap >= MAX_BITRATE:
+                new_cap = None
+        else:
+            return None
+        pair[1] = new_cap
+        pair[2] = now
+        call.hints += 1
+        return sender, receiver, new_cap
+
+    def snapshot(self, now=None):
+        now = time.time() if now is None else now
+        # Rooms whose window ran empty since their last call are forgotten.
+        for room in [room for room, window in self.rooms.items() if room not in self.calls and window.empty(now)]:
+            del self.rooms[room]
+        return {
+            "window_seconds": WINDOW_SECONDS,
+            "adaptive": self.adaptive,
+            "rooms": {room: {"call": self.calls[room].id if room in self.calls else None, "window": window.summary(now)}
+                      for room, window in self.rooms.items()},
+            "calls": [call.summary(now) for call in self.calls.values()],
+            "recent_calls": list(self.recent),
+        }
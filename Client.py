@@ -2,13 +2,38 @@ import socket
 import threading
 import sys
 import os
+import time
 import webbrowser
+import itertools
+
+import Framing
+import Wire
+import Transfers
 
 HOST = '192.168.2.31'
 PORT = 8080
+# If the server has been silent this long the client pings it; a second silent
+# interval means the connection is dead.
+HEARTBEAT_INTERVAL = 10
+SEND_LOCK = threading.Lock()
+SOCK = None
+
+# Set from the server's K| messages; used to resume after a dropped connection.
+RESUME_TOKEN = None
+RESUMING = False
+QUITTING = False
+RECONNECT_DELAYS = (0.5, 1, 2, 4, 8, 15, 30)
 CURRENT_USERNAME = None
 CURRENT_ROOM = "lobby"
-ngrok_url = "https://jacquelin-subfestive-overpopularly.ngrok-free.dev"
+
+# /send and /receive. Our offers wait in PENDING_OFFERS under a local ref until
+# the server numbers them; OUTGOING and INCOMING are keyed by that number.
+# TRANSFER_LOCK guards all three and wakes senders when their window opens.
+TRANSFER_LOCK = threading.Condition()
+TRANSFER_REFS = itertools.count(1)
+PENDING_OFFERS = {}
+OUTGOING = {}
+INCOMING = {}
 
 def clear_console():
     os.system('cls' if os.name == 'nt' else 'clear')
@@ -20,67 +45,371 @@ def prompt_input(prompt_char="> "):
 # מיקום HTML עם הוידאו
 VIDEO_HTML = os.path.abspath("VideoClient.html")
 
-def open_video_chat(username, room, ngrok_url):
+def open_video_chat(url):
+    # The server sends either a full URL or ":port/path" on the chat host.
+    if url.startswith(':'):
+        url = f"http://{HOST}{url}"
     try:
-        url = f"{ngrok_url}/VideoClient.html?username={username}&room={room}"
         webbrowser.open(url)
     except Exception as e:
         print(f"Failed to open browser: {e}")
 
 
-def receive(client):
+def handle_server_message(full_message):
     global CURRENT_USERNAME
     global CURRENT_ROOM
+
+    parts = full_message.split('|', 1)
+    msg_type = parts[0]
+    message = parts[1] if len(parts) > 1 else ""
+
+    sys.stdout.write('\r' + ' ' * 80 + '\r')
+
+    if msg_type == 'T':
+        print(f"{message}", end='')
+    elif msg_type == 'F':
+        print(f"\n{message}\n")
+    elif msg_type == 'S':
+        print(f"\n{message}")
+    elif msg_type == 'V':
+        if message.startswith("OPEN_VIDEO|"):
+            open_video_chat(message[len("OPEN_VIDEO|"):])
+    elif msg_type == 'E':
+        print(f"\n{message}\n")
+    elif msg_type == 'M':
+        print(f"\n{message}")
+    elif msg_type == 'I':
+        print(f"{message}")
+        if "You joined:" in message:
+            lines = message.split('\n')
+            for line in lines:
+                if line.startswith("You joined:"):
+                    CURRENT_ROOM = line[len("You joined:"):].strip()
+                    break
+        elif message.startswith("Now talking in:"):
+            CURRENT_ROOM = message[len("Now talking in:"):].strip()
+    elif msg_type == 'P':
+        print(f"** {message} **")
+    elif msg_type == 'O':
+        print(f"({message})")
+    elif msg_type == 'R':
+        # "#room|text" when following several rooms (/subscribe).
+        if message.startswith('#') and '|' in message:
+            room, _, message = message[1:].partition('|')
+            print(f"[{room}] {message}")
+        else:
+            print(message)
+    elif msg_type == 'D':
+        changes = [change.rpartition('=') for change in message.split(',') if change]
+        print("(Rooms: " + ", ".join(f"{name} {count} users" for name, _, count in changes) + ")")
+
+    prompt_input()
+
+
+def format_size(size):
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024 or unit == 'GB':
+            return f"{size:.0f} {unit}" if unit == 'bytes' else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+# ---------------- FILE TRANSFERS ----------------
+def offer_file(target, path):
+    # Hashing a large file takes a while, so it runs on its own thread.
+    try:
+        size = os.path.getsize(path)
+        digest = Transfers.file_digest(path)
+    except OSError as e:
+        handle_server_message(f"E|Cannot read {path}: {e}")
+        return
+    name = Transfers.safe_name(path)
+    ref = str(next(TRANSFER_REFS))
+    with TRANSFER_LOCK:
+        PENDING_OFFERS[ref] = {'path': path, 'name': name, 'target': target, 'credit': 0, 'window': 0,
+                               'chunk_size': Transfers.CHUNK_SIZE, 'cancelled': False}
+    send_message(f"FILE|OFFER|{ref}|{target}|{size}|{digest}|{name}")
+
+
+def stream_file(transfer_id, transfer):
+    # Sends chunks while fewer than window of them are unacknowledged.
+    try:
+        for seq, data in enumerate(Transfers.read_chunks(transfer['path'], transfer['chunk_size'])):
+            with TRANSFER_LOCK:
+                while not transfer['cancelled'] and seq >= transfer['credit'] + transfer['window']:
+                    TRANSFER_LOCK.wait()
+                if transfer['cancelled']:
+                    return
+            send_message(f"FILE|DATA|{transfer_id}|{seq}|{data}")
+        send_message(f"FILE|END|{transfer_id}")
+    except OSError as e:
+        transfer['cancelled'] = True
+        try:
+            send_message(f"FILE|CANCEL|{transfer_id}|sender could not read the file")
+        except OSError:
+            pass
+        handle_server_message(f"E|Sending {transfer['name']} failed: {e}")
+        return
+    handle_server_message(f"S|Sent {transfer['name']}; waiting for the recipients to verify it.")
+
+
+def handle_transfer_message(message):
+    kind, _, rest = message.partition('|')
+
+    if kind == 'OFFERED':
+        ref, transfer_id, count = rest.split('|')
+        with TRANSFER_LOCK:
+            transfer = PENDING_OFFERS.pop(ref, None)
+            if transfer is None:
+                return
+            OUTGOING[transfer_id] = transfer
+        handle_server_message(f"S|Offered {transfer['name']} to {transfer['target']} ({count} recipient(s)); "
+                              "waiting for them to accept.")
+    elif kind == 'REFUSED':
+        ref, reason = rest.split('|', 1)
+        with TRANSFER_LOCK:
+            transfer = PENDING_OFFERS.pop(ref, None)
+        if transfer is None:
+            return
+        handle_server_message(f"E|Cannot send {transfer['name']}: {reason}")
+    elif kind == 'START':
+        transfer_id, chunk_size, window, count = rest.split('|')
+        with TRANSFER_LOCK:
+            transfer = OUTGOING.get(transfer_id)
+            if transfer is None:
+                return
+            transfer['chunk_size'] = int(chunk_size)
+            transfer['window'] = int(window)
+            transfer['remaining'] = int(count)
+        handle_server_message(f"S|Sending {transfer['name']} to {count} recipient(s)...")
+        threading.Thread(target=stream_file, args=(transfer_id, transfer), daemon=True).start()
+    elif kind == 'ACK':
+        transfer_id, count = rest.split('|')
+        with TRANSFER_LOCK:
+            if transfer_id in OUTGOING:
+                OUTGOING[transfer_id]['credit'] = int(count)
+                TRANSFER_LOCK.notify_all()
+    elif kind in ('DELIVERED', 'FAILED'):
+        transfer_id, user, *reason = rest.split('|', 2)
+        with TRANSFER_LOCK:
+            transfer = OUTGOING.get(transfer_id)
+            if transfer is None:
+                return
+            # Recipients that left before the start were not counted.
+            if 'remaining' in transfer:
+                transfer['remaining'] -= 1
+                if transfer['remaining'] <= 0:
+                    del OUTGOING[transfer_id]
+        if kind == 'DELIVERED':
+            handle_server_message(f"S|{user} received {transfer['name']} (checksum verified).")
+        else:
+            handle_server_message(f"E|{user} did not receive {transfer['name']}: {''.join(reason)}")
+
+    elif kind == 'OFFER':
+        transfer_id, sender, room, size, digest, name = rest.split('|', 5)
+        INCOMING[transfer_id] = {'sender': sender, 'size': int(size), 'digest': digest, 'name': name, 'spool': None}
+        where = f" in {room}" if room else ""
+        handle_server_message(f"M|{sender} wants to send {name} ({format_size(int(size))}){where}. "
+                              f"Type /receive {transfer_id} to accept or /decline {transfer_id}.")
+    elif kind == 'DATA':
+        transfer_id, seq, data = rest.split('|', 2)
+        spool = INCOMING[transfer_id]['spool'] if transfer_id in INCOMING else None
+        if spool is None:
+            return
+        try:
+            spool.write(int(seq), data)
+        except (ValueError, OSError) as e:
+            abandon_incoming(transfer_id, str(e))
+            return
+        send_message(f"FILE|ACK|{transfer_id}|{seq}")
+    elif kind == 'END':
+        incoming = INCOMING.pop(rest, None)
+        if incoming is None or incoming['spool'] is None:
+            return
+        try:
+            path = incoming['spool'].finish()
+        except (ValueError, OSError) as e:
+            send_message(f"FILE|CANCEL|{rest}|{e}")
+            handle_server_message(f"E|{incoming['name']} from {incoming['sender']} was discarded: {e}")
+            return
+        send_message(f"FILE|DONE|{rest}")
+        handle_server_message(f"S|Saved {incoming['name']} from {incoming['sender']} to {path} (checksum verified).")
+
+    elif kind == 'CANCEL':
+        transfer_id, reason = rest.split('|', 1)
+        with TRANSFER_LOCK:
+            transfer = OUTGOING.pop(transfer_id, None)
+            if transfer:
+                transfer['cancelled'] = True
+                TRANSFER_LOCK.notify_all()
+        incoming = INCOMING.pop(transfer_id, None)
+        if incoming and incoming['spool']:
+            incoming['spool'].discard()
+        if transfer or incoming:
+            name = (transfer or incoming)['name']
+            handle_server_message(f"E|Transfer of {name} cancelled: {reason}")
+
+
+def abandon_incoming(transfer_id, reason):
+    incoming = INCOMING.pop(transfer_id)
+    if incoming['spool']:
+        incoming['spool'].discard()
+    send_message(f"FILE|CANCEL|{transfer_id}|{reason}")
+    handle_server_message(f"E|Stopped receiving {incoming['name']}: {reason}")
+
+
+def transfer_command(message):
+    # Returns True if message was a transfer command handled here.
+    parts = message.split(maxsplit=2)
+    cmd = parts[0].lower()
+    if cmd == '/send':
+        if len(parts) < 3:
+            handle_server_message("E|USAGE: /send <user|room> <path>")
+        elif not os.path.isfile(os.path.expanduser(parts[2])):
+            handle_server_message(f"E|No such file: {parts[2]}")
+        else:
+            threading.Thread(target=offer_file, args=(parts[1], os.path.expanduser(parts[2])), daemon=True).start()
+        return True
+    if cmd in ('/receive', '/decline'):
+        if len(parts) < 2 or parts[1] not in INCOMING or INCOMING[parts[1]]['spool'] is not None:
+            handle_server_message(f"E|No file offer {parts[1] if len(parts) > 1 else ''} is waiting for an answer.")
+        elif cmd == '/decline':
+            INCOMING.pop(parts[1])
+            send_message(f"FILE|DECLINE|{parts[1]}")
+        else:
+            incoming = INCOMING[parts[1]]
+            incoming['spool'] = Transfers.Spool(Transfers.DOWNLOAD_DIR, incoming['name'], incoming['size'], incoming['digest'])
+            send_message(f"FILE|ACCEPT|{parts[1]}")
+            handle_server_message(f"S|Receiving {incoming['name']} into {incoming['spool'].path}...")
+        return True
+    return False
+
+
+def abort_transfers():
+    # Transfers do not survive a reconnect.
+    with TRANSFER_LOCK:
+        for transfer in OUTGOING.values():
+            transfer['cancelled'] = True
+        OUTGOING.clear()
+        PENDING_OFFERS.clear()
+        TRANSFER_LOCK.notify_all()
+    for incoming in INCOMING.values():
+        if incoming['spool']:
+            incoming['spool'].discard()
+    INCOMING.clear()
+
+
+def send_message(message):
+    # The reader thread answers pings while the writer thread sends user input.
+    with SEND_LOCK:
+        SOCK.sendall(Framing.encode_frame(message.encode('utf-8')))
+
+
+def set_keepalive(sock):
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 5), ('TCP_KEEPCNT', 3)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def connect(first_message=None):
+    sock = socket.create_connection((HOST, PORT), timeout=HEARTBEAT_INTERVAL)
+    # Binary messages from the server, compressed when they are large.
+    hello = Wire.hello(compress=True)
+    if first_message:
+        hello += Framing.encode_frame(first_message.encode('utf-8'))
+    sock.sendall(hello)
+    set_keepalive(sock)
+    return sock
+
+
+def reconnect():
+    # Presents the last resume token so the server hands back the same session
+    # (room and missed messages) without asking for the password again.
+    global SOCK, RESUMING
+    for delay in RECONNECT_DELAYS:
+        time.sleep(delay)
+        try:
+            sock = connect(f"RESUME|{RESUME_TOKEN}")
+        except OSError:
+            continue
+        with SEND_LOCK:
+            SOCK = sock
+        RESUMING = True
+        return True
+    return False
+
+
+def read_until_disconnected(sock):
+    global RESUME_TOKEN, RESUMING
+    parser = Wire.Decoder()
+    # Anything the server sends before acknowledging the framed protocol is the
+    # legacy welcome, which it repeats as a frame right after the ack.
+    pending = b''
+    negotiated = False
+    awaiting_pong = False
     while True:
         try:
-            full_message = client.recv(1024).decode('utf-8')
-            if not full_message: continue
-
-            parts = full_message.split('|', 1)
-            msg_type = parts[0]
-            message = parts[1] if len(parts) > 1 else ""
-
-            sys.stdout.write('\r' + ' ' * 80 + '\r')
-
-            if msg_type == 'T':
-                print(f"{message}", end='')
-            elif msg_type == 'F':
-                print(f"\n{message}\n")
-            elif msg_type == 'S':
-                print(f"\n{message}")
-            elif msg_type == 'V':
-                if message.startswith("OPEN_VIDEO"):
-                    parts = message.split('|')
-                    ngrok_url = parts[1]
-                    open_video_chat(CURRENT_USERNAME, CURRENT_ROOM, ngrok_url)
-            elif msg_type == 'E':
-                print(f"\n{message}\n")
-            elif msg_type == 'M':
-                print(f"\n{message}")
-            elif msg_type == 'I':
-                print(f"{message}")
-                if "You joined:" in message:
-                    lines = message.split('\n')
-                    for line in lines:
-                        if line.startswith("You joined:"):
-                            CURRENT_ROOM = line[len("You joined:"):].strip()
-                            break
-            elif msg_type == 'P':
-                print(f"** {message} **")
-            elif msg_type == 'O':
-                print(f"({message})")
-            elif msg_type == 'R':
-                print(message)
+            if not negotiated:
+                data = sock.recv(Framing.RECV_SIZE)
+                if not data:
+                    return "Disconnected from Server"
+                pending += data
+                ack_at = pending.find(Wire.HELLO_ACK)
+                ack_end = pending.find(b'\n', ack_at)
+                if ack_at < 0 or ack_end < 0:
+                    continue
+                parser.feed(pending[ack_end + 1:])
+                negotiated = True
+            elif not parser.recv_into(sock):
+                return "Disconnected from Server"
 
-            prompt_input()
+            awaiting_pong = False
+            for full_message in parser.read_messages():
+                if full_message.startswith('H|'):
+                    if full_message == 'H|ping':
+                        send_message('H|pong')
+                    continue
+                if full_message.startswith('X|'):
+                    handle_transfer_message(full_message[2:])
+                    continue
+                if full_message.startswith('K|'):
+                    RESUME_TOKEN = full_message[2:]
+                    continue
+                if RESUMING and full_message[:2] in ('S|', 'F|'):
+                    RESUMING = False
+                    if full_message.startswith('F|'):
+                        RESUME_TOKEN = None
+                handle_server_message(full_message)
+
+        except socket.timeout:
+            if negotiated and not awaiting_pong:
+                send_message('H|ping')
+                awaiting_pong = True
+                continue
+            return "Server stopped responding"
 
         except Exception:
-            sys.stdout.write('\r' + ' ' * 80 + '\r')
-            print("\n*** Disconnected from Server ***")
-            client.close()
+            return "Disconnected from Server"
+
+
+def receive():
+    while True:
+        reason = read_until_disconnected(SOCK)
+        SOCK.close()
+        abort_transfers()
+        if QUITTING:
+            break
+        sys.stdout.write('\r' + ' ' * 80 + '\r')
+        if not RESUME_TOKEN:
+            print(f"\n*** {reason} ***")
+            break
+        print(f"\n*** {reason}, reconnecting... ***")
+        if not reconnect():
+            print("\n*** Could not reconnect to Server ***")
             break
 
-def write(client):
+def write():
+    global QUITTING
     while True:
         try:
             message = input()
@@ -89,27 +418,35 @@ def write(client):
                 if CURRENT_USERNAME is None:
                     # first username typed during login
                     CURRENT_USERNAME = message
-                client.send(message.encode('utf-8'))
+                if message.strip().lower() == '/quit':
+                    QUITTING = True
+                if not (message.startswith('/') and transfer_command(message)):
+                    send_message(message)
 
             prompt_input()
         except EOFError:
             print("\nClosing connection...")
-            client.close()
-            break
-        except Exception:
+            QUITTING = True
+            try:
+                send_message('/quit')
+            except OSError:
+                pass
+            SOCK.close()
             break
+        except OSError:
+            print("(Not connected; message not sent.)")
+            prompt_input()
 
 clear_console()
 print("Connecting...")
-client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
 try:
-    client.connect((HOST, PORT))
-except ConnectionRefusedError:
+    SOCK = connect()
+except OSError:
     print("Cannot connect to server.")
     exit()
 
-receive_thread = threading.Thread(target=receive, args=(client,))
+receive_thread = threading.Thread(target=receive)
 receive_thread.start()
 
-write_thread = threading.Thread(target=write, args=(client,))
+write_thread = threading.Thread(target=write)
 write_thread.start()
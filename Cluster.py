@@ -0,0 +1,202 @@
+import socket
+import array
+import bisect
+import hashlib
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+from collections import deque
+
+MAX_FDS_PER_MESSAGE = 4
+# A bus message must fit in one Unix datagram.
+MAX_BUS_MESSAGE = 1 << 20
+
+
+def stable_hash(key):
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    # Consistent-hash map from room name to shard. Each shard owns many virtual
+    # points on the ring so rooms spread evenly and changing the shard count
+    # only moves the rooms whose arc changed hands.
+    def __init__(self, nodes, replicas=64):
+        self._points = []
+        self._owners = []
+        for point, node in sorted((stable_hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas)):
+            self._points.append(point)
+            self._owners.append(node)
+
+    def node_for(self, key):
+        at = bisect.bisect(self._points, stable_hash(key)) % len(self._points)
+        return self._owners[at]
+
+
+def bus_path(bus_dir, shard):
+    return os.path.join(bus_dir, f"shard-{shard}.sock")
+
+
+class ShardBus:
+    # Local pub/sub between the worker processes of one server: every shard binds
+    # a Unix datagram socket in bus_dir and sends JSON messages (optionally with
+    # file descriptors attached) straight to its peers. Datagrams keep message
+    # boundaries and their SCM_RIGHTS payload together, so no framing is needed.
+    def __init__(self, shard, shard_count, bus_dir, handler):
+        self.shard = shard
+        self.shard_count = shard_count
+        self.bus_dir = bus_dir
+        self.handler = handler
+        self.sent = 0
+        self.received = 0
+        self.dropped = 0
+        self._sock = None
+        self._loop = None
+        self._backlog = deque()
+
+    def start(self, loop):
+        self._loop = loop
+        path = bus_path(self.bus_dir, self.shard)
+        if os.path.exists(path):
+            os.unlink(path)
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, MAX_BUS_MESSAGE)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, MAX_BUS_MESSAGE * 4)
+        self._sock.bind(path)
+        self._sock.setblocking(False)
+        loop.add_reader(self._sock.fileno(), self._on_readable)
+
+    def peers(self):
+        return [shard for shard in range(self.shard_count) if shard != self.shard]
+
+    def send(self, shard, message, fds=()):
+        data = json.dumps({**message, 'src': self.shard}, separators=(',', ':')).encode('utf-8')
+        if len(data) > MAX_BUS_MESSAGE:
+            self.dropped += 1
+            print(f"Bus message {message.get('t')} to shard {shard} is too large ({len(data)} bytes), dropped.")
+            self._close_fds(fds)
+            return
+        self._backlog.append((shard, data, list(fds)))
+        if len(self._backlog) == 1:
+            self._flush()
+
+    def broadcast(self, message):
+        for shard in self.peers():
+            self.send(shard, message)
+
+    def _flush(self):
+        while self._backlog:
+            shard, data, fds = self._backlog[0]
+            ancillary = [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array('i', fds))] if fds else []
+            try:
+                self._sock.sendmsg([data], ancillary, 0, bus_path(self.bus_dir, shard))
+            except BlockingIOError:
+                # The peer's receive queue is full; retry once it drains.
+                self._loop.add_writer(self._sock.fileno(), self._on_writable)
+                return
+            except (FileNotFoundError, ConnectionRefusedError):
+                # Peer not up (yet) or gone: nothing can be delivered to it.
+                self.dropped += 1
+            except OSError as e:
+                # EMSGSIZE, ENOBUFS and the like: this message will never go,
+                # so it must not block the ones queued behind it.
+                self.dropped += 1
+                print(f"Bus message to shard {shard} failed ({e}), dropped.")
+            else:
+                self.sent += 1
+            self._backlog.popleft()
+            self._close_fds(fds)
+
+    def _on_writable(self):
+        self._loop.remove_writer(self._sock.fileno())
+        self._flush()
+
+    def _on_readable(self):
+        while True:
+            try:
+                data, fds, _flags, _address = socket.recv_fds(self._sock, MAX_BUS_MESSAGE, MAX_FDS_PER_MESSAGE)
+            except BlockingIOError:
+                return
+            self.received += 1
+            try:
+                self.handler(json.loads(data), fds)
+            except Exception as e:
+                print(f"Error handling bus message on shard {self.shard}: {e}")
+                self._close_fds(fds)
+
+    @staticmethod
+    def _close_fds(fds):
+        for fd in fds:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    def close(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._sock.fileno())
+            self._sock.close()
+            try:
+                os.unlink(bus_path(self.bus_dir, self.shard))
+            except OSError:
+                pass
+
+
+class Cluster:
+    # Per-worker view of the cluster: which shard owns which room, plus the
+    # presence table every shard replicates from its peers.
+    def __init__(self, shard, shard_count, bus_dir, handler, replicated_rooms=()):
+        self.shard = shard
+        self.shard_count = shard_count
+        self.ring = HashRing(range(shard_count))
+        self.replicated_rooms = set(replicated_rooms)
+        self.bus = ShardBus(shard, shard_count, bus_dir, handler)
+        self.user_shards = {}
+
+    def owner_of(self, room_name):
+        if room_name in self.replicated_rooms:
+            return self.shard
+        return self.ring.node_for(room_name)
+
+    def owns(self, room_name):
+        return self.owner_of(room_name) == self.shard
+
+    def start(self, loop):
+        self.bus.start(loop)
+
+    def close(self):
+        self.bus.close()
+
+
+# ---------------- SUPERVISOR ----------------
+def run_cluster(worker_count, argv):
+    # Starts worker_count copies of the server, each with its own shard id and
+    # the shared bus directory, and stops them all when interrupted.
+    bus_dir = tempfile.mkdtemp(prefix='multividchat-bus-')
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    script = os.path.abspath(sys.argv[0])
+    workers = [
+        subprocess.Popen([sys.executable, script, *argv, '--shard', str(shard), '--bus-dir', bus_dir])
+        for shard in range(worker_count)
+    ]
+    print(f"Started {worker_count} workers (bus: {bus_dir})")
+
+    try:
+        for worker in workers:
+            worker.wait()
+    except (KeyboardInterrupt, SystemExit):
+        pass
+    finally:
+        for worker in workers:
+            if worker.poll() is None:
+                worker.send_signal(signal.SIGTERM)
+        for worker in workers:
+            worker.wait()
+        for shard in range(worker_count):
+            try:
+                os.unlink(bus_path(bus_dir, shard))
+            except OSError:
+                pass
+        os.rmdir(bus_dir)
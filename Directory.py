@@ -0,0 +1,72 @@
+import bisect
+
+# Bounds the render cache when clients ask for many different prefixes.
+MAX_RENDERS = 1024
+
+
+class RoomDirectory:
+    # Room name -> member count, updated in place on every membership change,
+    # plus a sorted name index for prefix filtering and paging. Rendered pages
+    # are cached and the cache is dropped only when a count actually changes,
+    # so repeated /list and /join menus cost a dict lookup. Changed rooms are
+    # also collected for presence subscribers until take_changes() is called.
+    def __init__(self, permanent_rooms=(), hidden_rooms=(), page_size=20):
+        self.permanent_rooms = frozenset(permanent_rooms)
+        self.hidden_rooms = frozenset(hidden_rooms)
+        self.page_size = page_size
+        self.counts = {}
+        self._names = []
+        self._renders = {}
+        self._changes = {}
+        for name in permanent_rooms:
+            self.update(name, 0)
+        self._changes.clear()
+
+    def __len__(self):
+        return len(self.counts)
+
+    def update(self, room_name, count):
+        if self.counts.get(room_name) == count:
+            return
+        if count or room_name in self.permanent_rooms:
+            if room_name not in self.counts and room_name not in self.hidden_rooms:
+                bisect.insort(self._names, room_name)
+            self.counts[room_name] = count
+        elif room_name in self.counts:
+            del self.counts[room_name]
+            if room_name not in self.hidden_rooms:
+                del self._names[bisect.bisect_left(self._names, room_name)]
+        else:
+            return
+        self._renders.clear()
+        if room_name not in self.hidden_rooms:
+            self._changes[room_name] = count
+
+    def page(self, prefix='', page=1):
+        # Returns ([(name, count), ...], total_pages) for one page of the rooms
+        # whose name starts with prefix.
+        start = bisect.bisect_left(self._names, prefix)
+        end = bisect.bisect_left(self._names, prefix + '\U0010ffff') if prefix else len(self._names)
+        total_pages = max(1, -(-(end - start) // self.page_size))
+        first = start + (page - 1) * self.page_size
+        names = self._names[first:min(first + self.page_size, end)]
+        return [(name, self.counts[name]) for name in names], total_pages
+
+    def snapshot(self):
+        return [(name, self.counts[name]) for name in self._names]
+
+    def rendered(self, key, render):
+        # Caches render()'s result under key until the next count change.
+        text = self._renders.get(key)
+        if text is None:
+            if len(self._renders) >= MAX_RENDERS:
+                self._renders.clear()
+            text = self._renders[key] = render()
+        return text
+
+    def has_changes(self):
+        return bool(self._changes)
+
+    def take_changes(self):
+        changes, self._changes = self._changes, {}
+        return changes
@@ -0,0 +1,83 @@
+import struct
+
+# A framed client opens with HELLO; the server answers with HELLO_ACK and from
+# then on both directions carry 4-byte big-endian length-prefixed frames.
+# Connections that never send HELLO keep the legacy one-recv-per-message format.
+HELLO = b"\x00MVC/F1\n"
+HELLO_ACK = b"\x00MVC/F1+\n"
+
+HEADER = struct.Struct('!I')
+MAX_FRAME_SIZE = 1 << 20
+RECV_SIZE = 65536
+
+
+class FrameError(Exception):
+    pass
+
+
+def encode_frame(payload):
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameError(f"Frame of {len(payload)} bytes exceeds {MAX_FRAME_SIZE}")
+    return HEADER.pack(len(payload)) + payload
+
+
+def encode_frames(payloads):
+    return b''.join(encode_frame(payload) for payload in payloads)
+
+
+class FrameParser:
+    # Incremental parser over one reusable bytearray. Complete frames are decoded
+    # straight out of a memoryview, and consumed bytes are only compacted away
+    # once they make up most of the buffer, so a burst of pipelined frames costs
+    # one copy in and one decode out per frame.
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._start = 0
+        self._scratch = None
+
+    def __len__(self):
+        return len(self._buffer) - self._start
+
+    def pending(self):
+        return bytes(self._buffer[self._start:])
+
+    def feed(self, data):
+        if self._start and self._start >= len(self._buffer) // 2:
+            del self._buffer[:self._start]
+            self._start = 0
+        self._buffer += data
+
+    def recv_into(self, sock, size=RECV_SIZE):
+        if self._scratch is None or len(self._scratch) != size:
+            self._scratch = bytearray(size)
+        with memoryview(self._scratch) as view:
+            received = sock.recv_into(view)
+            self.feed(view[:received])
+        return received
+
+    def read_frames(self):
+        return self._read(bytes)
+
+    def read_messages(self):
+        return self._read(lambda body: str(body, 'utf-8'))
+
+    def _read(self, decode):
+        items = []
+        buffer = self._buffer
+        start = self._start
+        end = len(buffer)
+
+        with memoryview(buffer) as view:
+            while end - start >= HEADER.size:
+                (length,) = HEADER.unpack_from(buffer, start)
+                if length > self.max_frame_size:
+                    raise FrameError(f"Frame of {length} bytes exceeds {self.max_frame_size}")
+                if end - start - HEADER.size < length:
+                    break
+                body_start = start + HEADER.size
+                items.append(decode(view[body_start:body_start + length]))
+                start = body_start + length
+
+        self._start = start
+        return items
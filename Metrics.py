@@ -0,0 +1,213 @@
+import bisect
+import collections
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Instruments are plain dicts of numbers keyed by label value, updated inline on
+# the hot path: an increment is one dict lookup and an add, cheap enough to
+# leave on under full load. Gauges are callbacks evaluated only when scraped.
+
+REGISTRY = []
+STARTED_AT = time.time()
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+def _labels(label_name, label_value):
+    if label_name is None:
+        return ''
+    escaped = str(label_value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return f'{{{label_name}="{escaped}"}}'
+
+
+class Counter:
+    def __init__(self, name, help_text, label=None):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.values = collections.defaultdict(int)
+        if label is None:
+            self.values[None] = 0
+        REGISTRY.append(self)
+
+    def inc(self, label_value=None, amount=1):
+        self.values[label_value] += amount
+
+    def total(self):
+        return sum(self.values.values())
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_value, value in list(self.values.items()):
+            lines.append(f"{self.name}{_labels(self.label, label_value)} {value}")
+        return lines
+
+
+class Gauge:
+    def __init__(self, name, help_text, callback, label=None):
+        # callback returns a number, or a {label_value: number} dict when the
+        # gauge is labelled.
+        self.name = name
+        self.help_text = help_text
+        self.callback = callback
+        self.label = label
+        REGISTRY.append(self)
+
+    def value(self):
+        return self.callback()
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} gauge"]
+        value = self.callback()
+        if self.label is None:
+            lines.append(f"{self.name} {value}")
+        else:
+            for label_value, number in value.items():
+                lines.append(f"{self.name}{_labels(self.label, label_value)} {number}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, help_text, label=None, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self.counts = {}
+        self.sums = collections.defaultdict(float)
+        REGISTRY.append(self)
+
+    def observe(self, value, label_value=None):
+        counts = self.counts.get(label_value)
+        if counts is None:
+            counts = self.counts[label_value] = [0] * (len(self.buckets) + 1)
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[label_value] += value
+
+    def time(self, label_value=None):
+        return _Timer(self, label_value)
+
+    def quantile(self, fraction, label_value=None):
+        # Upper bound of the bucket holding the requested quantile.
+        counts = self.counts.get(label_value)
+        if not counts:
+            return None
+        target = fraction * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+            seen += count
+            if seen >= target:
+                return bound
+        return float('inf')
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_value, counts in list(self.counts.items()):
+            prefix = '' if self.label is None else f'{self.label}="{label_value}",'
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{{{prefix}le="+Inf"}} {cumulative}')
+            lines.append(f"{self.name}_sum{_labels(self.label, label_value)} {self.sums[label_value]}")
+            lines.append(f"{self.name}_count{_labels(self.label, label_value)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    __slots__ = ('histogram', 'label_value', 'started')
+
+    def __init__(self, histogram, label_value):
+        self.histogram = histogram
+        self.label_value = label_value
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.started, self.label_value)
+        return False
+
+
+def render():
+    lines = []
+    for instrument in REGISTRY:
+        lines.extend(instrument.render())
+    lines.extend(PROFILER.render() if PROFILER else [])
+    return '\n'.join(lines) + '\n'
+
+
+# ---------------- SAMPLING PROFILER ----------------
+class SamplingProfiler:
+    # Every interval seconds, records the innermost frame of every thread
+    # except its own. Costs one sys._current_frames() call per tick, so it can
+    # stay on in production at a coarse interval.
+    def __init__(self, interval=0.01, top=20):
+        self.interval = interval
+        self.top = top
+        self.samples = collections.Counter()
+        self.total = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def _run(self):
+        own_id = threading.get_ident()
+        while True:
+            time.sleep(self.interval)
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                code = frame.f_code
+                self.samples[f"{code.co_name} ({code.co_filename.rsplit('/', 1)[-1]}:{frame.f_lineno})"] += 1
+                self.total += 1
+
+    def hottest(self):
+        return self.samples.most_common(self.top)
+
+    def render(self):
+        lines = ["# HELP multividchat_profile_samples Sampled innermost frames (top N)",
+                 "# TYPE multividchat_profile_samples counter"]
+        for location, count in self.hottest():
+            lines.append(f"multividchat_profile_samples{_labels('frame', location)} {count}")
+        return lines
+
+
+PROFILER = None
+
+
+def start_profiler(interval):
+    global PROFILER
+    PROFILER = SamplingProfiler(interval).start()
+    return PROFILER
+
+
+# ---------------- HTTP ENDPOINT ----------------
+def start_http_server(port, render_text, host='127.0.0.1'):
+    # Serves GET /metrics in Prometheus text format from a daemon thread.
+    # render_text is responsible for reading server state safely (e.g. by
+    # hopping onto the event loop).
+    class MetricsHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = render_text().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
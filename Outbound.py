@@ -0,0 +1,86 @@
+from collections import deque
+from itertools import islice
+
+import Metrics
+
+DROP_OLDEST = 'drop-oldest'
+DISCONNECT = 'disconnect'
+OVERFLOW_POLICIES = (DROP_OLDEST, DISCONNECT)
+
+DEFAULT_MAX_MESSAGES = 1024
+DEFAULT_MAX_BYTES = 1 << 20
+
+# Most platforms cap the number of buffers a single sendmsg() may carry.
+IOV_MAX = 1024
+
+DROPPED = Metrics.Counter('multividchat_outbound_dropped_total', "Messages dropped from full outbound queues (drop-oldest policy)")
+
+
+class SlowConsumerError(ConnectionError):
+    pass
+
+
+class OutboundQueue:
+    # Bounded FIFO of already-encoded messages waiting for a connection's writer.
+    # Items are shared bytes objects, so one broadcast payload is referenced by
+    # every recipient's queue rather than copied into each.
+    def __init__(self, max_messages=DEFAULT_MAX_MESSAGES, max_bytes=DEFAULT_MAX_BYTES, policy=DROP_OLDEST):
+        if policy not in OVERFLOW_POLICIES:
+            raise ValueError(f"Unknown overflow policy: {policy}")
+        self.max_messages = max_messages
+        self.max_bytes = max_bytes
+        self.policy = policy
+        self.size_bytes = 0
+        self.dropped = 0
+        self.overflowed = False
+        self._items = deque()
+
+    def __len__(self):
+        return len(self._items)
+
+    def _over_limit(self):
+        return len(self._items) > self.max_messages or self.size_bytes > self.max_bytes
+
+    def put(self, data):
+        self._items.append(data)
+        self.size_bytes += len(data)
+
+        if not self._over_limit():
+            return
+
+        if self.policy == DISCONNECT:
+            self.overflowed = True
+            raise SlowConsumerError(f"Outbound queue full ({len(self._items)} messages, {self.size_bytes} bytes)")
+
+        # Always keep the newest message, even if it alone exceeds max_bytes.
+        while self._over_limit() and len(self._items) > 1:
+            self.size_bytes -= len(self._items.popleft())
+            self.dropped += 1
+            DROPPED.inc()
+
+    def drain(self):
+        items = list(self._items)
+        self._items.clear()
+        self.size_bytes = 0
+        return items
+
+
+def send_batch(sock, batch):
+    # Coalesces a batch of queued messages into as few syscalls as possible,
+    # resuming correctly after partial writes.
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(batch))
+        return
+
+    pending = deque(memoryview(data) for data in batch if data)
+    while pending:
+        chunk = list(islice(pending, IOV_MAX))
+        sent = sock.sendmsg(chunk)
+        while sent:
+            head = pending[0]
+            if sent >= len(head):
+                sent -= len(head)
+                pending.popleft()
+            else:
+                pending[0] = head[sent:]
+                sent = 0
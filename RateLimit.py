@@ -0,0 +1,40 @@
+import time
+
+
+class TokenBucket:
+    # Allows bursts of up to burst events and refills at rate events per
+    # second. Refilling is computed lazily on each check, so an idle bucket
+    # costs nothing. notified lets callers warn once per throttled burst
+    # instead of answering every rejected message.
+    __slots__ = ('rate', 'burst', 'tokens', 'updated', 'notified')
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.notified = False
+
+    def allow(self, cost=1.0):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= cost:
+            self.tokens -= cost
+            self.notified = False
+            return True
+        return False
+
+
+def parse_limit(text):
+    # "chat=5/10" -> ('chat', 5.0, 10.0); the burst defaults to twice the rate
+    # and a rate of 0 turns the limit off.
+    name, sep, value = text.partition('=')
+    if not sep or not name:
+        raise ValueError(f"expected CLASS=RATE[/BURST], got {text!r}")
+    rate, _, burst = value.partition('/')
+    rate = float(rate)
+    burst = float(burst) if burst else max(1.0, rate * 2)
+    if rate < 0 or burst < 1:
+        raise ValueError(f"invalid limit {text!r}")
+    return name, rate, burst
@@ -0,0 +1,67 @@
+import bisect
+import re
+from array import array
+
+TOKEN_RE = re.compile(r'\w+')
+
+
+def tokenize(text):
+    return set(TOKEN_RE.findall(text.lower()))
+
+
+def _contains(ids, pm_id):
+    at = bisect.bisect_left(ids, pm_id)
+    return at < len(ids) and ids[at] == pm_id
+
+
+class SearchIndex:
+    # Inverted index over PM text: per participant, token -> posting list of
+    # PM ids in ascending order. Ids only grow, so indexing a new PM is one
+    # append per token, and each PM is filed under both its sender and its
+    # recipient so a query reads nothing but the searching user's postings.
+    # Postings are arrays of 32-bit ints; most (user, token) pairs occur once,
+    # so a lone id is stored as a plain int until a second one arrives.
+    def __init__(self):
+        self._postings = {}
+
+    def add(self, pm_id, sender, recipient, message):
+        tokens = tokenize(message)
+        for user in {sender, recipient}:
+            postings = self._postings.setdefault(user, {})
+            for token in tokens:
+                ids = postings.get(token)
+                if ids is None:
+                    postings[token] = pm_id
+                elif type(ids) is int:
+                    postings[token] = array('I', (ids, pm_id))
+                else:
+                    ids.append(pm_id)
+
+    def search(self, username, text, with_user=None, before=None, limit=None):
+        # Ids of username's PMs containing every token of text, newest first
+        # and below before. With with_user, the postings of both users are
+        # intersected, which leaves exactly the PMs the two exchanged.
+        tokens = tokenize(text)
+        if not tokens:
+            return []
+        lists = []
+        for user in {username, with_user or username}:
+            postings = self._postings.get(user, {})
+            for token in tokens:
+                ids = postings.get(token)
+                if ids is None:
+                    return []
+                lists.append((ids,) if type(ids) is int else ids)
+
+        # Walk the rarest token's postings backwards and probe the others.
+        lists.sort(key=len)
+        shortest, others = lists[0], lists[1:]
+        end = len(shortest) if before is None else bisect.bisect_left(shortest, before)
+        hits = []
+        for at in range(end - 1, -1, -1):
+            pm_id = shortest[at]
+            if all(_contains(ids, pm_id) for ids in others):
+                hits.append(pm_id)
+                if len(hits) == limit:
+                    break
+        return hits
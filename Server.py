@@ -1,210 +1,764 @@
 import socket
 import threading
+import asyncio
+import argparse
 import json
-import hashlib
+import functools
 import time
 import os
+import sys
+import signal
+import base64
+import itertools
+import subprocess
+
+import Framing
+import Wire
+import Outbound
+import Storage
+import Cluster
+import Metrics
+import Sessions
+import Backlog
+import Directory
+import RateLimit
+import Auth
+import Transfers
+try:
+    import BridgeClient
+except ImportError:  # aiohttp is only needed for video calls
+    BridgeClient = None
 
 
 HOST = '0.0.0.0'
 PORT = 8080
 
-NICKNAMES = {}
-CLIENT_ROOM = {}
-ROOMS = {
-    "lobby": [],
-    "room1": [],
-    "room2": []
-}
-CLIENT_STATE = {}
-ROOM_MAP = {}
-ONLINE_USERS = {}
+PERMANENT_ROOMS = ["lobby", "room1", "room2"]
+REGISTRY = Sessions.Registry(PERMANENT_ROOMS)
+
+# Member counts for every room (including other shards' rooms in clustered
+# mode), kept up to date by publish_room_count and the bus, with cached /list
+# pages and /join menus. The lobby is not listed.
+DIRECTORY = Directory.RoomDirectory(PERMANENT_ROOMS, hidden_rooms=["lobby"])
+MEMBER_LISTS = {}
+MEMBER_LIST_LIMIT = 50
+# Rooms a session may follow besides its active one.
+MAX_SUBSCRIPTIONS = 10
+# Sessions subscribed to room count changes with /watch.
+WATCHERS = set()
+PRESENCE_FLUSH_SCHEDULED = False
+LOOP = None
+
+# Threaded mode serializes every state mutation through this lock so that the
+# registry above only ever has one writer; in async mode the event loop is the
+# single writer and the lock is never contended.
+STATE_LOCK = threading.RLock()
 
 JSON_FILE = 'chat_data.json'
+DB_FILE = 'chat_data.db'
+STORAGE_BACKEND = 'json'
+STORAGE = None
+# Messages that need storage while it is still opening, per connection in
+# arrival order, together with everything that connection sent after them.
+HELD_MESSAGES = {}
+STORAGE_COMMANDS = ('/pm', '/inbox', '/history', '/search')
+
+# Password hashing runs on AUTH_WORKERS threads; at most AUTH_QUEUE checks wait
+# for a worker, and one that waited AUTH_TIMEOUT seconds is answered "busy".
+KDF_COST = Auth.DEFAULT_KDF_COST
+AUTH_WORKERS = 2
+AUTH_QUEUE = 256
+AUTH_TIMEOUT = 5.0
+AUTH_POOL = None
+
+HISTORY_PAGE_SIZE = 20
+HISTORY_MAX_PAGE_SIZE = 200
+# Usernames and room names interned for binary (Wire) clients, and the batch
+# size from which their output is compressed (0: never).
+NAMES = Wire.Names()
+COMPRESS_THRESHOLD = Wire.COMPRESS_THRESHOLD
+
+# Unread PMs delivered per frame, at login and per /inbox.
+INBOX_BATCH = 100
+SEARCH_PAGE_SIZE = 20
+
+# /send file transfers in flight, by id; a user may have this many open at once.
+TRANSFERS = {}
+TRANSFER_IDS = itertools.count(1)
+MAX_OPEN_TRANSFERS = 4
+
+OUTBOUND_MAX_MESSAGES = Outbound.DEFAULT_MAX_MESSAGES
+OUTBOUND_MAX_BYTES = Outbound.DEFAULT_MAX_BYTES
+OUTBOUND_OVERFLOW = Outbound.DROP_OLDEST
+
+# Framed clients that have been silent for HEARTBEAT_INTERVAL seconds get an
+# H|ping; any connection silent for IDLE_TIMEOUT seconds is reaped (logged-in
+# legacy clients, which cannot answer pings, are left to TCP keepalive).
+# Legacy clients still logging in are somebody typing at a prompt, so they get
+# LEGACY_LOGIN_TIMEOUT instead.
+HEARTBEAT_INTERVAL = 10.0
+IDLE_TIMEOUT = 30.0
+LEGACY_LOGIN_TIMEOUT = 300.0
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 5
+KEEPALIVE_COUNT = 3
+
+# Recent chat per room, replayed to whoever joins (see Backlog.RoomBacklog).
+ROOM_HISTORY_MESSAGES = Backlog.DEFAULT_MESSAGES_PER_ROOM
+ROOM_HISTORY_BYTES = Backlog.DEFAULT_MAX_BYTES
+ROOM_HISTORY = Backlog.RoomBacklog(ROOM_HISTORY_MESSAGES, ROOM_HISTORY_BYTES)
+# Legacy clients read each message with one recv() of this size.
+LEGACY_RECV_SIZE = 1024
+
+# Framed clients get a signed resume token (K|) after login and on every room
+# change. If their socket drops, the session is parked for RESUME_WINDOW
+# seconds, keeping its room seat and buffering up to RESUME_BUFFER messages,
+# and a reconnect that sends RESUME|<token> as its first frame takes it back
+# without re-authenticating.
+RESUME_KEY_FILE = 'resume.key'
+RESUME_SECRET = None
+RESUME_TOKEN_TTL = 600
+RESUME_WINDOW = 60.0
+RESUME_BUFFER = 256
+# A token whose session is gone restores it only if it is the user's latest
+# login and the user did not /quit since (see Sessions.LoginLedger).
+LOGIN_LEDGER_FILE = 'logins.jsonl'
+LOGINS = Sessions.LoginLedger()
+
+# Video calls: BridgeClient's /ws signaling and VideoClient.html are served
+# from this process on HTTP_PORT (+ shard). Browsers are sent to VIDEO_URL, or
+# to HTTP_PORT on the host the chat client connected to, with a signed token
+# naming their chat session. CALLS maps a room to the user whose /call is open.
+# With ADAPTIVE_BITRATE the bridge caps senders' video when their receivers
+# report loss (see CallQuality).
+HTTP_PORT = 8000
+VIDEO_URL = None
+ADAPTIVE_BITRATE = False
+VIDEO_SECRET = None
+VIDEO_TOKEN_TTL = 600
+HTTP_FD = None
+HTTP_SOCK = None
+HTTP_RUNNER = None
+CALLS = {}
+
+# Graceful restart (SIGUSR2): the successor inherits the listening socket as
+# LISTEN_FD and reports back over HANDOFF_FD; the old process then gets
+# DRAIN_TIMEOUT seconds to flush and close its clients.
+RESTART_SIGNAL = signal.SIGUSR2
+DRAIN_TIMEOUT = 10.0
+LISTEN_FD = None
+HANDOFF_FD = None
+HANDOFF_PEER = None
+RESTARTING = False
+METRICS_SERVER = None
+
+# Token buckets as (events per second, burst). Every message a connection sends
+# is charged to 'message' and then to its own class, except file transfer
+# messages, which the transfer window paces and which only count against
+# 'file'; 'connect' and 'login' are shared by the whole server. A rate of 0
+# disables that limit.
+RATE_LIMITS = {
+    'message': (30, 60),
+    'chat': (5, 15),
+    'pm': (2, 6),
+    'history': (1, 5),
+    'join': (1, 5),
+    'webrtc': (50, 200),
+    'file': (1000, 2000),
+    'command': (5, 10),
+    'connect': (200, 1000),
+    'login': (50, 200),
+}
+GLOBAL_RATE_LIMITS = ('connect', 'login')
+GLOBAL_BUCKETS = {}
+COMMAND_CLASSES = {'/pm': 'pm', '/history': 'history', '/inbox': 'history', '/search': 'history',
+                   '/join': 'join', '/leave': 'join',
+                   '/subscribe': 'join', '/unsubscribe': 'join', '/switch': 'join'}
+
+# Set in clustered mode (--workers N): this process is one shard of the server.
+CLUSTER = None
+
+# ---------------- METRICS ----------------
+ADMINS = set()
+METRICS_PORT = None
+LAST_STATS = {'at': Metrics.STARTED_AT, 'sent': {}}
+
+# Label values are bounded: anything that is not a known command is counted as
+# 'other' so a client cannot grow the histogram table. The unknown-command
+# reply lists these too.
+COMMANDS = ('/list', '/join', '/call', '/accept', '/reject', '/leave', '/subscribe', '/unsubscribe', '/switch',
+            '/pm', '/inbox', '/history', '/search', '/send', '/stats', '/quit', '/watch', '/unwatch')
+
+MESSAGES_SENT = Metrics.Counter('multividchat_messages_sent_total', "Messages queued to clients, by type", label='type')
+MESSAGES_RECEIVED = Metrics.Counter('multividchat_messages_received_total', "Messages received from clients, by kind", label='kind')
+SEND_FAILURES = Metrics.Counter('multividchat_send_failures_total', "Sends that failed and removed the client")
+RESUMES = Metrics.Counter('multividchat_resumes_total', "Resume attempts, by result", label='result')
+RATE_LIMITED = Metrics.Counter('multividchat_rate_limited_total', "Messages, connections and logins refused by rate limits", label='kind')
+REAPED = Metrics.Counter('multividchat_reaped_total', "Connections closed by the idle reaper")
+COMMAND_SECONDS = Metrics.Histogram('multividchat_command_seconds', "process_command latency", label='command')
+
+
+def init_storage():
+    # Loads in the background so the listener is up straight away; a restarted
+    # server first waits for its predecessor to close the files.
+    global STORAGE
+    STORAGE = Storage.BackgroundStorage(lambda: Storage.open_storage(STORAGE_BACKEND, JSON_FILE, DB_FILE),
+                                        wait_for=wait_for_predecessor if HANDOFF_FD is not None else None)
+    return STORAGE
 
 
-def init_data():
-    if os.path.exists(JSON_FILE) and os.path.getsize(JSON_FILE) > 0:
-        with open(JSON_FILE, 'r', encoding='utf-8') as f:
-            try:
-                data = json.load(f)
-                return data
-            except json.JSONDecodeError:
-                return {"users": {}, "pms": []}
-    else:
-        return {"users": {}, "pms": []}
+def relay_webrtc_signal(sender_client, payload):
+    session = REGISTRY.get(sender_client)
+    if not session or not session.room:
+        return
+    room = session.room
 
+    sender = session.username or "Unknown"
 
-def save_data(data):
-    with open(JSON_FILE, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+    # Construct the signaling message around the payload text as received;
+    # it was only parsed to check that it is JSON.
+    data = '{"from": ' + json.dumps(sender) + ', "payload": ' + payload + '}'
+    sender_id = NAMES.id(sender)
+    body = Wire.signal_body(sender_id, payload) if sender_id else None
 
+    # Only send the signaling data to the clients in the same room (but not the sender)
+    send_to_many(REGISTRY.members(room), "V|" + data, sender_client, body, (sender_id,) if body else ())
 
-CHAT_DATA = init_data()
 
+def call_in_state_thread(callback, *args):
+    # For worker threads: runs callback where server state may be touched.
+    if LOOP is not None:
+        LOOP.call_soon_threadsafe(callback, *args)
+    else:
+        with STATE_LOCK:
+            callback(*args)
 
-def hash_password(password):
-    return hashlib.sha256(password.encode('utf-8')).hexdigest()
 
-def relay_webrtc_signal(sender_client, payload):
-    room = CLIENT_ROOM.get(sender_client)
-    if not room:
-        return
+def valid_username(username):
+    # Names end up in "|"-delimited messages (R|, X|OFFER|, tokens) and in
+    # whitespace-split commands such as /pm.
+    return (0 < len(username) <= 20 and username.isprintable()
+            and '|' not in username and not any(c.isspace() for c in username))
 
-    sender = ONLINE_USERS.get(sender_client, "Unknown")
 
-    # Construct the signaling message
-    data = json.dumps({
-        "from": sender,
-        "payload": payload
-    })
+def check_password(client, auth_choice, username, password):
+    # Queues the KDF work on AUTH_POOL; finish_auth picks up the result on the
+    # state thread. The session waits in AUTHENTICATING meanwhile.
+    session = REGISTRY.get(client)
+    if auth_choice == '1':
+        if STORAGE.get_password_hash(username) is not None:
+            send_to_client(client, 'F|Username taken. Try again (1/2):')
+            return
+        job = functools.partial(Auth.hash_password, password, KDF_COST)
+    else:
+        job = functools.partial(Auth.verify_password, password, STORAGE.get_password_hash(username), KDF_COST)
 
-    # Only send the signaling data to the clients in the same room (but not the sender)
-    for client in ROOMS.get(room, []):
-        if client != sender_client:  # Don't send to the sender
-            send_to_client(client, "V|" + data)  # Forward signaling message
+    def done(result):
+        call_in_state_thread(finish_auth, client, session, auth_choice, username, result)
 
+    session.state = ('AUTHENTICATING', None)
+    if not AUTH_POOL.submit(job, done):
+        session.state = ('AWAITING_AUTH_CHOICE', None)
+        send_to_client(client, 'F|Server busy. Try again (1/2):')
 
-def register_user(username, password):
-    if username in CHAT_DATA['users']:
-        return False
 
-    CHAT_DATA['users'][username] = {'password': hash_password(password)}
-    save_data(CHAT_DATA)
-    return True
+def finish_auth(client, session, auth_choice, username, result):
+    if REGISTRY.get(client) is not session:
+        return  # disconnected while the password was being checked
+    session.state = ('AWAITING_AUTH_CHOICE', None)
+    if result is None:
+        send_to_client(client, 'F|Server busy. Try again (1/2):')
+        return
 
+    if auth_choice == '1':
+        if not STORAGE.add_user(username, result):
+            send_to_client(client, 'F|Username taken. Try again (1/2):')
+            return
+        send_to_client(client, 'S|Registration successful. Logging in...')
+    else:
+        ok, new_hash = result
+        if not ok:
+            send_to_client(client, 'F|Invalid credentials. Try again (1/2):')
+            return
+        if new_hash:
+            # Legacy SHA-256 (or an older KDF cost) upgraded on first login.
+            STORAGE.set_password_hash(username, new_hash)
+        existing = REGISTRY.find(username)
+        if isinstance(existing, ParkedConnection):
+            # Logging in with a password gives up the parked session.
+            remove_client(existing, resumable=False)
+        if REGISTRY.is_online(username) or (CLUSTER and username in CLUSTER.user_shards):
+            send_to_client(client, 'F|User already logged in. Try again (1/2):')
+            return
+        send_to_client(client, 'S|Login successful.')
 
-def authenticate_user(username, password):
-    user_data = CHAT_DATA['users'].get(username)
-    if user_data and user_data['password'] == hash_password(password):
-        return True
-    return False
+    complete_login(client, username)
 
 
-def save_pm(sender, recipient, message):
-    pm_entry = {
-        'sender': sender,
-        'recipient': recipient,
-        'message': message,
-        'timestamp': time.time()
-    }
-    CHAT_DATA['pms'].append(pm_entry)
-    save_data(CHAT_DATA)
+def save_pm(sender, recipient, message, unread=False):
+    STORAGE.save_pm(sender, recipient, message, time.time(), unread)
 
 
-def get_pm_history(user1, user2):
-    history = []
-    for pm in CHAT_DATA['pms']:
-        is_relevant = (pm['sender'] == user1 and pm['recipient'] == user2) or \
-                      (pm['sender'] == user2 and pm['recipient'] == user1)
-        if is_relevant:
-            history.append((pm['sender'], pm['message'], pm['timestamp']))
-    return history
+def send_inbox(client, username, announce_empty=False):
+    # Unread PMs go out oldest first, up to INBOX_BATCH of them in one frame;
+    # they are marked read as they are handed out.
+    counts = STORAGE.unread_counts(username)
+    if not counts:
+        if announce_empty:
+            send_to_client(client, "I|No unread private messages.")
+        return
+    pms = STORAGE.take_unread(username, INBOX_BATCH)
+    if not pms:
+        return
+    senders = ", ".join(f"{sender} ({count})" for sender, count in counts.items())
+    lines = [f"Unread private messages from {senders}:"]
+    for sender, msg, timestamp in pms:
+        lines.append(f"[{time.strftime('%H:%M', time.localtime(timestamp))}] {sender}: {msg}")
+    remaining = sum(counts.values()) - len(pms)
+    if remaining > 0:
+        lines.append(f"{remaining} more: /inbox")
+    send_to_client(client, "I|" + "\n".join(lines))
+
+
+def get_pm_history(user1, user2, before=None, limit=None):
+    return STORAGE.get_pm_history(user1, user2, before, limit)
+
+
+def parse_history_args(args):
+    before = None
+    limit = HISTORY_PAGE_SIZE
+    args = list(args)
+    while args:
+        option = args.pop(0).lower()
+        if option not in ('before', 'limit') or not args:
+            raise ValueError
+        value = args.pop(0)
+        if option == 'before':
+            if not value.isdigit():
+                raise ValueError
+            before = int(value)
+        else:
+            limit = int(value)
+            if limit < 1:
+                raise ValueError
+    return before, min(limit, HISTORY_MAX_PAGE_SIZE)
+
+
+def parse_search_args(args):
+    # /search <terms> [with <user>] [before <id>]; the options are read from
+    # the end, so "with" and "before" still work as search terms.
+    args = list(args)
+    before = with_user = None
+    if len(args) >= 3 and args[-2].lower() == 'before' and args[-1].isdigit():
+        before = int(args.pop())
+        args.pop()
+    if len(args) >= 3 and args[-2].lower() == 'with':
+        with_user = args.pop()
+        args.pop()
+    if not args:
+        raise ValueError
+    return ' '.join(args), with_user, before
+
+
+def is_framed(client):
+    session = REGISTRY.get(client)
+    return session is not None and session.parser is not None
+
+
+def attach_compressor(client, compressor):
+    # Shared by both connection classes. Whatever is queued already (the
+    # handshake) is written uncompressed.
+    compressor.skip = len(client.outbound)
+    client.compressor = compressor
+
+
+def encode_for_client(client, message):
+    data = message.encode('utf-8')
+    session = REGISTRY.get(client)
+    if session is None or session.parser is None:
+        return data
+    if session.wire is not None:
+        return Wire.encode_text(data)
+    return Framing.encode_frame(data)
 
 
 def send_to_client(client, message):
+    MESSAGES_SENT.inc(message[:1])
     try:
-        client.send(message.encode('utf-8'))
+        client.send(encode_for_client(client, message))
     except:
+        SEND_FAILURES.inc()
         remove_client(client)
 
 
-def list_rooms_menu(client):
-    available_rooms = [name for name in ROOMS.keys() if name != 'lobby']
+def send_to_many(clients, message, exclude=None, body=None, refs=()):
+    # Encodes the message once per wire format and hands the same bytes object
+    # to every recipient's outbound queue; clients whose queue overflows under
+    # the disconnect policy are removed after the loop so the membership list is
+    # not mutated while it is being iterated. Binary clients get body (default:
+    # the message's text encoding), preceded by the definitions of any interned
+    # names in refs they have not been sent yet.
+    data = message.encode('utf-8')
+    framed = None
+    binary = None
+    sent = 0
+    failed = []
+
+    for client in clients:
+        if client is exclude:
+            continue
+        session = REGISTRY.get(client)
+        if session is None or session.parser is None:
+            payload = data
+        elif session.wire is None:
+            if framed is None:
+                framed = Framing.encode_frame(data)
+            payload = framed
+        else:
+            if binary is None:
+                binary = Wire.encode_text(data) if body is None else Wire.frame(body)
+            payload = binary
+            missing = [ref for ref in refs if ref not in session.wire]
+            if missing:
+                session.wire.update(missing)
+                payload = NAMES.define(missing) + binary
+        try:
+            client.send(payload)
+            sent += 1
+        except:
+            failed.append(client)
+
+    MESSAGES_SENT.inc(message[:1], sent)
+    SEND_FAILURES.inc(amount=len(failed))
+    for client in failed:
+        remove_client(client)
+
+
+def room_user_counts():
+    return DIRECTORY.counts
+
+
+def publish_room_count(room_name):
+    # Called after every local membership change of room_name.
+    MEMBER_LISTS.pop(room_name, None)
+    DIRECTORY.update(room_name, len(REGISTRY.members(room_name)))
+    schedule_presence_flush()
+    if CLUSTER and room_name not in CLUSTER.replicated_rooms:
+        CLUSTER.bus.broadcast({'t': 'count', 'room': room_name, 'count': len(REGISTRY.members(room_name))})
+
+
+def schedule_presence_flush():
+    # Count changes are coalesced per event-loop iteration; the threaded server
+    # has no loop and pushes them straight away.
+    global PRESENCE_FLUSH_SCHEDULED
+    if not WATCHERS:
+        DIRECTORY.take_changes()
+        return
+    if not DIRECTORY.has_changes() or PRESENCE_FLUSH_SCHEDULED:
+        return
+    if LOOP is None:
+        flush_presence()
+    else:
+        PRESENCE_FLUSH_SCHEDULED = True
+        LOOP.call_soon(flush_presence)
+
+
+def flush_presence():
+    global PRESENCE_FLUSH_SCHEDULED
+    PRESENCE_FLUSH_SCHEDULED = False
+    changes = DIRECTORY.take_changes()
+    if changes and WATCHERS:
+        send_counts([session.conn for session in WATCHERS], changes.items())
+
+
+def send_counts(clients, counts):
+    delta = ",".join(f"{name}={count}" for name, count in counts)
+    body, refs = None, [NAMES.id(name) for name, _ in counts]
+    if all(refs):
+        body = Wire.counts_body(zip(refs, (count for _, count in counts)))
+    send_to_many(clients, "D|" + delta, body=body, refs=refs if body else ())
+
+
+def render_room_page(prefix, page):
+    rooms, total_pages = DIRECTORY.page(prefix, page)
+    if not rooms and page > 1:
+        return f"I|There are only {total_pages} page(s)."
+    if not rooms:
+        return "I|No matching rooms." if prefix else "I|No active rooms (other than lobby)."
+    title = f"Active Rooms{f' matching {prefix!r}' if prefix else ''} (page {page}/{total_pages}):"
+    lines = [title] + [f"- {name} ({count} users)" for name, count in rooms]
+    if page < total_pages:
+        lines.append(f"More: /list {prefix + ' ' if prefix else ''}{page + 1}")
+    return "I|" + "\n".join(lines)
+
+
+def parse_list_args(args):
+    # /list [prefix] [page]; a lone number is a page of the full list.
+    prefix, page = '', 1
+    if args and args[-1].isdigit():
+        page = max(1, int(args[-1]))
+        args = args[:-1]
+    if args:
+        prefix = args[0]
+    return prefix, page
+
+
+def render_rooms_menu():
+    rooms, total_pages = DIRECTORY.page('', 1)
     room_map = {}
     room_list_str = "Available Rooms:\n"
 
-    for i, name in enumerate(available_rooms):
+    for i, (name, count) in enumerate(rooms):
         room_map[i + 1] = name
-        room_list_str += f"{i + 1}. {name} ({len(ROOMS[name])} users)\n"
+        room_list_str += f"{i + 1}. {name} ({count} users)\n"
 
-    create_option_number = len(available_rooms) + 1
+    create_option_number = len(rooms) + 1
     room_map[create_option_number] = 'CREATE_NEW'
     room_list_str += f"{create_option_number}. Create New Room\n"
+    if total_pages > 1:
+        room_list_str += f"({len(DIRECTORY) - 1} rooms in total; /list <prefix> [page] to search, /join <room> to go straight there)\n"
     room_list_str += "Enter number or type /leave:"
+    return "M|" + room_list_str, room_map, create_option_number
 
-    ROOM_MAP[client] = room_map
-    return "M|" + room_list_str, create_option_number
+
+def list_rooms_menu(client):
+    # The menu text and its number -> room map are shared by every session
+    # until a room count changes.
+    menu, room_map, create_option_number = DIRECTORY.rendered('menu', render_rooms_menu)
+    REGISTRY.get(client).room_map = room_map
+    return menu, create_option_number
 
 
 def get_room_members_list(room_name):
-    if room_name not in ROOMS or not ROOMS[room_name]:
+    members_str = MEMBER_LISTS.get(room_name)
+    if members_str is not None:
+        return members_str
+
+    members = REGISTRY.members(room_name)
+    if not members:
         return "The room is currently empty."
 
     member_nicknames = []
-    for client in ROOMS[room_name]:
-        nickname = ONLINE_USERS.get(client, 'Unknown')
+    for client in members:
+        nickname = REGISTRY.username(client, 'Unknown')
         member_nicknames.append(nickname)
+        if len(member_nicknames) == MEMBER_LIST_LIMIT:
+            break
 
-    members_str = f"Members in {room_name} ({len(member_nicknames)}): {', '.join(member_nicknames)}"
-
+    members_str = f"Members in {room_name} ({len(members)}): {', '.join(member_nicknames)}"
+    if len(members) > MEMBER_LIST_LIMIT:
+        members_str += f" and {len(members) - MEMBER_LIST_LIMIT} more"
+    MEMBER_LISTS[room_name] = members_str
     return members_str
 
 
-def broadcast_to_room(message, room_name, sender_client=None):
-    if room_name not in ROOMS:
+def broadcast_to_room(message, room_name, sender_client=None, record=False, chat=None):
+    broadcast_to_rooms(message, (room_name,), sender_client, record, chat)
+
+
+def broadcast_to_rooms(message, room_names, sender_client=None, record=False, chat=None):
+    # record=True keeps the line in each room's history (chat, not notices).
+    # chat=(username, text) marks message as that user's chat line, which
+    # binary clients get with the username interned.
+    room_names = [room_name for room_name in room_names if room_name in REGISTRY.rooms]
+    deliver_to_rooms(message, room_names, sender_client, chat)
+
+    for room_name in room_names:
+        if record:
+            record_room_message(room_name, message)
+        if CLUSTER and room_name in CLUSTER.replicated_rooms:
+            CLUSTER.bus.broadcast({'t': 'room', 'room': room_name, 'msg': message, 'record': record, 'chat': chat})
+
+
+def room_body(message, room_name, chat):
+    # Binary form of an R| line, as (body, refs); (None, ()) where the text
+    # encoding is as good or a name could not be interned.
+    room_id = NAMES.id(room_name) if room_name else 0
+    if room_name and not room_id:
+        return None, ()
+    if chat:
+        user_id = NAMES.id(chat[0])
+        if user_id:
+            return Wire.chat_body(room_id, user_id, chat[1]), (room_id, user_id) if room_id else (user_id,)
+    if room_id:
+        return Wire.notice_body(room_id, message), (room_id,)
+    return None, ()
+
+
+def deliver_to_rooms(message, room_names, exclude=None, chat=None):
+    # Every local member of any of room_names gets the message once, even when
+    # it is in several of them. Sessions following more than one room get it
+    # tagged with the first of its rooms, "R|#room|message"; everyone else keeps
+    # the plain "R|message", so the common case stays one encode per room.
+    if len(room_names) == 1 and not REGISTRY.multi_room:
+        send_to_many(REGISTRY.members(room_names[0]), "R|" + message, exclude, *room_body(message, None, chat))
         return
 
-    for client in ROOMS[room_name]:
-        if client != sender_client:
-            send_to_client(client, "R|" + message)
+    seen = {exclude}
+    plain = []
+    tagged = {}
+    for room_name in room_names:
+        for client in REGISTRY.members(room_name):
+            if client in seen:
+                continue
+            seen.add(client)
+            if client in REGISTRY.multi_room:
+                tagged.setdefault(room_name, []).append(client)
+            else:
+                plain.append(client)
+
+    send_to_many(plain, "R|" + message, None, *room_body(message, None, chat))
+    for room_name, clients in tagged.items():
+        send_to_many(clients, f"R|#{room_name}|{message}", None, *room_body(message, room_name, chat))
+
+
+def record_room_message(room_name, message):
+    ROOM_HISTORY.append(room_name, f"[{time.strftime('%H:%M')}] {message}")
 
 
-def join_room(client, room_name, initial_connect=False):
-    username = ONLINE_USERS.get(client, 'Unknown')
+def recent_messages(session, room_name, message, after=''):
+    # The replay section of an I| message made of message, the section and
+    # after. A legacy client would lose whatever does not fit in its one
+    # recv(), so it only gets the newest lines that do.
+    heading = "--- Recent messages ---\n"
+    max_bytes = None
+    if not session.framed:
+        max_bytes = LEGACY_RECV_SIZE - len(f"I|{message}{heading}{after}".encode('utf-8'))
+    recent = ROOM_HISTORY.replay(room_name, max_bytes)
+    return heading + recent if recent else ''
+
+
+def join_room(client, room_name, initial_connect=False, after=''):
+    session = REGISTRY.get(client)
+    username = session.username or 'Unknown'
     room_name = room_name.strip()
 
-    if client in CLIENT_ROOM and CLIENT_ROOM[client] is not None:
-        old_room = CLIENT_ROOM[client]
+    if session.room is not None:
+        old_room = session.room
 
         if old_room == room_name:
             send_to_client(client, f"I|You are already in {room_name}")
             return
 
         broadcast_to_room(f'{username} left {old_room}', old_room, client)
+        end_video(session, old_room)
 
-        if client in ROOMS[old_room]:
-            ROOMS[old_room].remove(client)
-
-        if not ROOMS[old_room] and old_room not in ["lobby", "room1", "room2"]:
-            del ROOMS[old_room]
+        _, closed = REGISTRY.leave(client)
+        if closed:
             print(f"Room {old_room} closed.")
+            CALLS.pop(old_room, None)
+        publish_room_count(old_room)
 
-    if room_name not in ROOMS:
-        ROOMS[room_name] = []
-        print(f"Room {room_name} created by {username}.")
+    if CLUSTER and not CLUSTER.owns(room_name):
+        hand_off(client, room_name)
+        return
 
-    ROOMS[room_name].append(client)
-    CLIENT_ROOM[client] = room_name
+    # A subscribed room is already joined; it only becomes the active one.
+    announce = room_name not in session.subscriptions
+    if not announce:
+        REGISTRY.activate(client, room_name)
+    else:
+        if REGISTRY.join(client, room_name):
+            print(f"Room {room_name} created by {username}.")
+        publish_room_count(room_name)
 
     join_msg = f'You joined: {room_name}'
     members_list_str = get_room_members_list(room_name)
 
     message_content = f"\n{join_msg}\n{members_list_str}\n"
+    recent = recent_messages(session, room_name, message_content, "\n" + after)
+    if recent:
+        message_content += recent + "\n"
 
     if initial_connect:
         return message_content
 
     send_to_client(client, "I|" + message_content)
+    if announce:
+        broadcast_to_room(f'{username} joined {room_name}', room_name, client)
+    if session.resume_id:
+        send_resume_token(client)
+
+
+# ---------------- SUBSCRIPTIONS ----------------
+def valid_room_name(room_name):
+    # "|" would break the room tag in R|#room|message frames.
+    return 0 < len(room_name) <= 15 and ' ' not in room_name and '|' not in room_name
+
+
+def subscribe_room(client, room_name):
+    session = REGISTRY.get(client)
+    username = session.username
+
+    if room_name == session.room or room_name in session.subscriptions:
+        send_to_client(client, f"I|You already follow {room_name}.")
+        return
+    if not valid_room_name(room_name):
+        send_to_client(client, "E|Invalid room name. Must be 1-15 characters and contain no spaces or '|'.")
+        return
+    if len(session.subscriptions) >= MAX_SUBSCRIPTIONS:
+        send_to_client(client, f"E|You can follow at most {MAX_SUBSCRIPTIONS} other rooms. /unsubscribe one first.")
+        return
+    if CLUSTER and not CLUSTER.owns(room_name):
+        send_to_client(client, f"E|{room_name} is hosted by another server; /join it instead.")
+        return
+
+    if REGISTRY.subscribe(client, room_name):
+        print(f"Room {room_name} created by {username}.")
+    publish_room_count(room_name)
+
+    message_content = (f"Subscribed to {room_name}; its messages are marked [{room_name}]. "
+                       f"/switch {room_name} to talk there.\n{get_room_members_list(room_name)}")
+    recent = recent_messages(session, room_name, message_content + "\n")
+    if recent:
+        message_content += "\n" + recent
+    send_to_client(client, "I|" + message_content)
     broadcast_to_room(f'{username} joined {room_name}', room_name, client)
+    if session.resume_id:
+        send_resume_token(client)
+
+
+def unsubscribe_room(client, room_name):
+    session = REGISTRY.get(client)
+    broadcast_to_room(f'{session.username} left {room_name}', room_name, client)
+    end_video(session, room_name)
+    if REGISTRY.unsubscribe(client, room_name):
+        print(f"Room {room_name} closed.")
+        CALLS.pop(room_name, None)
+    publish_room_count(room_name)
+
+
+def switch_room(client, room_name):
+    session = REGISTRY.get(client)
+    if room_name == session.room:
+        send_to_client(client, f"I|You are already talking in {room_name}.")
+        return
+    if room_name not in session.subscriptions:
+        send_to_client(client, f"E|You do not follow {room_name}. /subscribe {room_name} or /join {room_name} first.")
+        return
+    REGISTRY.activate(client, room_name)
+    send_to_client(client, f"I|Now talking in: {room_name}")
+    if session.resume_id:
+        send_resume_token(client)
 
 
 def process_new_room_name(client, room_name):
     room_name = room_name.strip()
-    CLIENT_STATE[client] = None
+    REGISTRY.get(client).state = None
 
-    if not room_name or len(room_name) > 15 or ' ' in room_name:
-        send_to_client(client, "E|Invalid room name. Must be 1-15 characters and contain no spaces. Try /join again.")
+    if not valid_room_name(room_name):
+        send_to_client(client, "E|Invalid room name. Must be 1-15 characters and contain no spaces or '|'. Try /join again.")
         return
 
-    if room_name in ROOMS:
+    if room_name in room_user_counts():
         send_to_client(client, f"I|Room '{room_name}' already exists. Connecting now.")
 
     join_room(client, room_name)
 
 
 def process_room_selection(client, selection, max_choice):
-    room_map = ROOM_MAP.get(client)
+    session = REGISTRY.get(client)
+    room_map = session.room_map
 
     try:
         choice = int(selection.strip())
@@ -214,15 +768,14 @@ def process_room_selection(client, selection, max_choice):
         send_to_client(client, f"E|Invalid choice. Enter number (1-{max_choice}) or type /leave:")
         return
 
-    CLIENT_STATE[client] = None
-    if client in ROOM_MAP:
-        del ROOM_MAP[client]
+    session.state = None
+    session.room_map = None
 
     selected_action = room_map.get(choice)
 
     if selected_action == 'CREATE_NEW':
         send_to_client(client, "M|Enter the name for the new room (max 15 chars, no spaces):")
-        CLIENT_STATE[client] = ('AWAITING_NEW_ROOM_NAME', None)
+        session.state = ('AWAITING_NEW_ROOM_NAME', None)
     elif selected_action:
         join_room(client, selected_action)
     else:
@@ -232,27 +785,32 @@ def process_room_selection(client, selection, max_choice):
 def process_command(client, command):
     parts = command.split()
     cmd = parts[0].lower()
-    username = ONLINE_USERS.get(client, 'Unknown')
+    session = REGISTRY.get(client)
+    username = session.username or 'Unknown'
 
     if cmd == '/list':
-        room_list_str = "Active Rooms:\n"
-        rooms_to_list = [name for name in ROOMS.keys() if name != 'lobby']
-        if not rooms_to_list:
-            send_to_client(client, "I|No active rooms (other than lobby).")
-            return
+        prefix, page = parse_list_args(parts[1:])
+        send_to_client(client, DIRECTORY.rendered(('list', prefix, page), lambda: render_room_page(prefix, page)))
 
-        for name in rooms_to_list:
-            room_list_str += f"- {name} ({len(ROOMS[name])} users)\n"
-        room_list_str = room_list_str.strip()
-        send_to_client(client, "I|" + room_list_str)
+    elif cmd == '/watch':
+        WATCHERS.add(session)
+        send_to_client(client, "S|Watching room counts. /unwatch to stop.")
+        send_counts([client], list(DIRECTORY.snapshot()))
+
+    elif cmd == '/unwatch':
+        WATCHERS.discard(session)
+        send_to_client(client, "S|Stopped watching room counts.")
 
     elif cmd == '/join':
         if len(parts) >= 2:
             room_name = parts[1]
+            if '|' in room_name:
+                send_to_client(client, "E|Room names cannot contain '|'.")
+                return
             join_room(client, room_name)
         else:
             room_list_str, max_choice = list_rooms_menu(client)
-            CLIENT_STATE[client] = ('AWAITING_ROOM_CHOICE', max_choice)
+            session.state = ('AWAITING_ROOM_CHOICE', max_choice)
             send_to_client(client, room_list_str)
 
 
@@ -263,9 +821,7 @@ def process_command(client, command):
 
     elif cmd == '/call':
 
-        username = ONLINE_USERS.get(client, 'Unknown')
-
-        current_room = CLIENT_ROOM.get(client)
+        current_room = session.room
 
         if not current_room:
             send_to_client(client, "E|You are not in a room! Use /join first.")
@@ -273,11 +829,8 @@ def process_command(client, command):
             return
 
         # only notify others
-
-        for peer in ROOMS[current_room]:
-
-            if peer != client:
-                send_to_client(peer, f"M| {username} wants to start a video call. Type /accept")
+        CALLS[current_room] = username
+        send_to_many(REGISTRY.members(current_room), f"M| {username} wants to start a video call. Type /accept", client)
 
         send_to_client(client, "S|Call request sent.")
 
@@ -287,17 +840,29 @@ def process_command(client, command):
 
     elif cmd == '/accept':
 
-        current_room = CLIENT_ROOM.get(client)
+        current_room = session.room
 
         if not current_room:
             send_to_client(client, "E|Join a room first")
 
             return
 
-        ngrok_url = "https://jacquelin-subfestive-overpopularly.ngrok-free.dev"
+        caller = REGISTRY.get(REGISTRY.find(CALLS.get(current_room)))
+        if caller is None or caller.room != current_room:
+            CALLS.pop(current_room, None)
+            send_to_client(client, "E|There is no call to accept in this room.")
+            return
+
+        if HTTP_RUNNER is None:
+            send_to_client(client, "E|Video calls are not available on this server.")
+            return
 
-        for peer in ROOMS[current_room]:
-            send_to_client(peer, f"V|OPEN_VIDEO|{ngrok_url}")
+        # The caller's browser opens with the first acceptance; everyone who
+        # accepts later joins the same call.
+        if caller.video is None and caller.conn is not client:
+            send_to_client(caller.conn, f"V|OPEN_VIDEO|{video_link(caller)}")
+            send_to_client(caller.conn, f"M|{username} accepted your call.")
+        send_to_client(client, f"V|OPEN_VIDEO|{video_link(session)}")
 
         send_to_client(client, "S|Video call started")
 
@@ -305,24 +870,55 @@ def process_command(client, command):
 
 
     elif cmd == '/reject':
-        username = ONLINE_USERS.get(client, 'Unknown')
-        current_room = CLIENT_ROOM.get(client)
+        current_room = session.room
 
         if not current_room:
             send_to_client(client, "E|You are not in a room! Use /join first.")
             return
 
+        caller = REGISTRY.find(CALLS.get(current_room))
+        if caller is not None and caller is not client:
+            send_to_client(caller, f"M|{username} rejected your call.")
         send_to_client(client, "S|You rejected the video call.")
 
 
 
     elif cmd == '/leave':
-        if CLIENT_ROOM.get(client) == "lobby":
+        if session.room == "lobby":
             send_to_client(client, "I|You are already in the lobby.")
             return
 
         join_room(client, "lobby")
 
+    elif cmd == '/subscribe':
+        if len(parts) < 2:
+            following = ', '.join(session.subscriptions) or 'no other rooms'
+            send_to_client(client, f"I|Talking in {session.room}; also following {following}.\nUSAGE: /subscribe <room>")
+            return
+        subscribe_room(client, parts[1])
+
+    elif cmd == '/unsubscribe':
+        if len(parts) < 2:
+            send_to_client(client, "E|USAGE: /unsubscribe <room>")
+            return
+        room_name = parts[1]
+        if room_name not in session.subscriptions:
+            if room_name == session.room:
+                send_to_client(client, f"E|{room_name} is your active room. /switch to another room or /leave first.")
+            else:
+                send_to_client(client, f"E|You do not follow {room_name}.")
+            return
+        unsubscribe_room(client, room_name)
+        send_to_client(client, f"S|Unsubscribed from {room_name}.")
+        if session.resume_id:
+            send_resume_token(client)
+
+    elif cmd == '/switch':
+        if len(parts) < 2:
+            send_to_client(client, "E|USAGE: /switch <room>")
+            return
+        switch_room(client, parts[1])
+
     elif cmd == '/pm':
         if len(parts) < 3:
             send_to_client(client, "E|USAGE: /pm <recipient_username> <message>")
@@ -331,174 +927,1695 @@ def process_command(client, command):
         recipient = parts[1]
         message = ' '.join(parts[2:])
 
-        save_pm(username, recipient, message)
-
-        recipient_socket = next((sock for sock, user in ONLINE_USERS.items() if user == recipient), None)
+        recipient_socket = REGISTRY.find(recipient)
+        if isinstance(recipient_socket, ParkedConnection):
+            # A parked session's buffer is lost if the client never resumes;
+            # the PM waits in the inbox instead, which a resume hands out.
+            recipient_socket = None
 
         pm_to_sender = f"PM sent to {recipient}: {message}"
         send_to_client(client, "O|" + pm_to_sender)
 
         if recipient_socket:
+            save_pm(username, recipient, message)
             pm_to_recipient = f"PM from {username}: {message}"
             send_to_client(recipient_socket, "P|" + pm_to_recipient)
+        elif CLUSTER and recipient in CLUSTER.user_shards:
+            # Saved by the shard holding the recipient, which knows whether
+            # they are connected or parked.
+            pm_to_recipient = f"PM from {username}: {message}"
+            CLUSTER.bus.send(CLUSTER.user_shards[recipient], {'t': 'pm', 'from': username, 'to': recipient,
+                                                              'text': message, 'msg': "P|" + pm_to_recipient})
         else:
+            save_pm(username, recipient, message, unread=True)
             send_to_client(client, f"I|{recipient} is offline. Message saved.")
 
+    elif cmd == '/inbox':
+        send_inbox(client, username, announce_empty=True)
+
     elif cmd == '/history':
+        usage = "E|USAGE: /history <username> [before <id>] [limit N]"
         if len(parts) < 2:
-            send_to_client(client, "E|USAGE: /history <username>")
+            send_to_client(client, usage)
             return
 
         target_user = parts[1]
-        history = get_pm_history(username, target_user)
+        try:
+            before, limit = parse_history_args(parts[2:])
+        except ValueError:
+            send_to_client(client, usage)
+            return
+
+        # Fetch one extra entry to learn whether an older page exists.
+        history = get_pm_history(username, target_user, before, limit + 1)
+        has_more = len(history) > limit
+        if has_more:
+            history = history[1:]
 
         if not history:
-            send_to_client(client, f"I|No private message history with {target_user}.")
+            if before is None:
+                send_to_client(client, f"I|No private message history with {target_user}.")
+            else:
+                send_to_client(client, f"I|No older private messages with {target_user}.")
             return
 
         hist_str = f"PM History with {target_user}:\n"
-        for sender, msg, timestamp in history:
+        for _, sender, msg, timestamp in history:
             time_str = time.strftime('%H:%M', time.localtime(timestamp))
             prefix = "-> " if sender == username else "<- "
             hist_str += f"[{time_str}] {prefix}{sender}: {msg}\n"
+        if has_more:
+            hist_str += f"Older messages: /history {target_user} before {history[0][0]} limit {limit}\n"
         hist_str = hist_str.strip()
         send_to_client(client, "I|" + hist_str)
 
+    elif cmd == '/search':
+        try:
+            text, with_user, before = parse_search_args(parts[1:])
+        except ValueError:
+            send_to_client(client, "E|USAGE: /search <terms> [with <user>] [before <id>]")
+            return
+
+        # One extra result tells whether there is an older page.
+        results = STORAGE.search_pms(username, text, with_user, before, SEARCH_PAGE_SIZE + 1)
+        has_more = len(results) > SEARCH_PAGE_SIZE
+        results = results[:SEARCH_PAGE_SIZE]
+        scope = f" with {with_user}" if with_user else ""
+
+        if not results:
+            more = "more " if before is not None else ""
+            send_to_client(client, f"I|No {more}private messages{scope} match {text!r}.")
+            return
+
+        lines = [f"Private messages{scope} matching {text!r}, newest first:"]
+        for pm_id, sender, recipient, msg, timestamp in results:
+            time_str = time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
+            direction = f"-> {recipient}" if sender == username else f"<- {sender}"
+            lines.append(f"[{time_str}] {direction}: {msg}")
+        if has_more:
+            lines.append(f"Older results: /search {text}{scope} before {results[-1][0]}")
+        send_to_client(client, "I|" + "\n".join(lines))
+
+    elif cmd == '/quit':
+        send_to_client(client, "S|Goodbye.")
+        # Logging out also retires the resume token.
+        record_login(username, None)
+        remove_client(client, resumable=False)
+
+    elif cmd == '/stats':
+        if username not in ADMINS:
+            send_to_client(client, "E|/stats is only available to server admins.")
+            return
+        send_to_client(client, "I|" + format_stats())
+
+    elif cmd == '/send':
+        # Client.py turns /send into FILE| messages; only a client without
+        # file transfers sends it as text.
+        send_to_client(client, "E|This client cannot send files.")
+
     else:
-        send_to_client(client, "E|Unknown command. Available: /list, /join, /leave, /pm, /history")
+        available = [command for command in COMMANDS if command != '/stats' or username in ADMINS]
+        send_to_client(client, "E|Unknown command. Available: " + ", ".join(available))
 
 
-def remove_client(client):
-    if client not in ONLINE_USERS:
+def remove_client(client, resumable=True):
+    drop_transfers(client)
+    session = REGISTRY.get(client)
+    if resumable and RESUME_WINDOW and session is not None and session.resume_id and not isinstance(client, ParkedConnection):
+        park_client(client)
         return
 
-    username = ONLINE_USERS[client]
-    current_room = CLIENT_ROOM.get(client)
+    session, closed = REGISTRY.close(client)
+    WATCHERS.discard(session)
+    if session is not None:
+        end_video(session)
+    if session is None or session.username is None:
+        client.close()
+        return
 
-    if current_room and current_room in ROOMS:
-        if client in ROOMS[current_room]:
-            ROOMS[current_room].remove(client)
-            broadcast_to_room(f'{username} disconnected.', current_room, client)
+    username = session.username
+    current_rooms = [room_name for room_name in (session.room, *session.subscriptions) if room_name]
 
-        if not ROOMS[current_room] and current_room not in ["lobby", "room1", "room2"]:
-            del ROOMS[current_room]
-            print(f"Room {current_room} closed.")
+    if current_rooms:
+        broadcast_to_rooms(f'{username} disconnected.', current_rooms, client)
+        for room_name in closed:
+            print(f"Room {room_name} closed.")
+            CALLS.pop(room_name, None)
+        for room_name in current_rooms:
+            publish_room_count(room_name)
 
-    if client in CLIENT_ROOM:
-        del CLIENT_ROOM[client]
-    if client in CLIENT_STATE:
-        del CLIENT_STATE[client]
-    if client in ROOM_MAP:
-        del ROOM_MAP[client]
-    if client in ONLINE_USERS:
-        del ONLINE_USERS[client]
+    if CLUSTER:
+        CLUSTER.bus.broadcast({'t': 'offline', 'user': username})
 
     client.close()
     print(f'{username} disconnected.')
 
 
-def handle_client(client):
-    try:
-        send_to_client(client, 'T|Welcome. Type 1 to Register, 2 to Login.')
+def start_auth(client):
+    REGISTRY.get(client).state = ('AWAITING_AUTH_CHOICE', None)
+    send_to_client(client, 'T|Welcome. Type 1 to Register, 2 to Login.')
+
+
+def decode_incoming(client, data, first_read=False):
+    # Legacy clients send one message per recv. A framed client announces itself
+    # with Framing.HELLO as its very first bytes; it then gets the ack and a
+    # framed copy of the welcome prompt it may have already received unframed.
+    session = REGISTRY.get(client)
+    if session is None:
+        # Removed by another thread (reaper, failed send) mid-read.
+        return []
+    parser = session.parser
+
+    greet = False
+    if parser is None and session.hello is not None:
+        # The rest of a hello that was split across reads.
+        data, session.hello = session.hello + data, None
+        first_read = True
+    if parser is None and first_read and (len(data) < len(Framing.HELLO) and Framing.HELLO.startswith(data)
+                                          or len(data) < len(Wire.HELLO) and Wire.HELLO.startswith(data)):
+        session.hello = data
+        return []
+
+    if parser is None and first_read and data.startswith(Framing.HELLO):
+        parser = session.parser = Framing.FrameParser()
+        client.framed = True
+        client.send(Framing.HELLO_ACK)
+        data = data[len(Framing.HELLO):]
+        greet = True
+    elif parser is None and first_read and data.startswith(Wire.HELLO):
+        # The binary variant: same frames from the client, Wire's encoding
+        # (and optionally compression) towards it.
+        hello = Wire.parse_hello(data)
+        if hello is None:
+            if len(data) < Wire.MAX_HELLO:
+                session.hello = data
+            return []
+        options, data = hello
+        options &= {Wire.ZLIB} if COMPRESS_THRESHOLD else set()
+        parser = session.parser = Framing.FrameParser()
+        client.framed = True
+        session.wire = set()
+        client.send(Wire.hello_ack(options))
+        if Wire.ZLIB in options:
+            client.enable_compression(Wire.Compressor(COMPRESS_THRESHOLD))
+        greet = True
+
+    if parser is None:
+        message = data.decode('utf-8').strip()
+        return [message] if message else []
+
+    parser.feed(data)
+    messages = []
+    for message in parser.read_messages():
+        message = message.strip()
+        if message:
+            messages.append(message)
+    # A resuming client skips the welcome prompt.
+    if greet and not (messages and messages[0].startswith('RESUME|')):
+        start_auth(client)
+    return messages
+
+
+def process_auth_message(client, message):
+    session = REGISTRY.get(client)
+    state, data = session.state or ('AWAITING_AUTH_CHOICE', None)
+
+    if state == 'AWAITING_AUTH_CHOICE' and message.startswith('RESUME|'):
+        resume_session(client, message[len('RESUME|'):])
+        return
 
-        while True:
-            message = client.recv(1024).decode('utf-8').strip()
+    if state == 'AWAITING_AUTH_CHOICE':
+        if message == '1':
+            send_to_client(client, 'T|Enter desired username:')
+        elif message == '2':
+            send_to_client(client, 'T|Enter username:')
+        else:
+            send_to_client(client, 'F|Invalid choice. Type 1 or 2:')
+            return
+        session.state = ('AWAITING_USERNAME', message)
 
-            if not message: continue
+    elif state == 'AWAITING_USERNAME':
+        if data == '1' and not valid_username(message):
+            session.state = ('AWAITING_AUTH_CHOICE', None)
+            send_to_client(client, 'F|Usernames are up to 20 characters, without spaces or "|". Try again (1/2):')
+            return
+        send_to_client(client, 'T|Enter password:')
+        session.state = ('AWAITING_PASSWORD', (data, message))
 
-            auth_choice = message
+    elif state == 'AUTHENTICATING':
+        return  # input typed while the password is being checked is dropped
 
-            if auth_choice == '1':
-                send_to_client(client, 'T|Enter desired username:')
-                username = client.recv(1024).decode('utf-8').strip()
-                send_to_client(client, 'T|Enter password:')
-                password = client.recv(1024).decode('utf-8').strip()
+    elif state == 'AWAITING_PASSWORD':
+        auth_choice, username = data
+        password = message
+        session.state = ('AWAITING_AUTH_CHOICE', None)
 
-                if register_user(username, password):
-                    send_to_client(client, 'S|Registration successful. Logging in...')
-                    break
-                else:
-                    send_to_client(client, 'F|Username taken. Try again (1/2):')
-
-            elif auth_choice == '2':
-                send_to_client(client, 'T|Enter username:')
-                username = client.recv(1024).decode('utf-8').strip()
-                send_to_client(client, 'T|Enter password:')
-                password = client.recv(1024).decode('utf-8').strip()
-
-                if authenticate_user(username, password):
-                    if username in ONLINE_USERS.values():
-                        send_to_client(client, 'F|User already logged in. Try again (1/2):')
-                        continue
-                    send_to_client(client, 'S|Login successful.')
-                    break
-                else:
-                    send_to_client(client, 'F|Invalid credentials. Try again (1/2):')
+        if not allow_global('login'):
+            send_to_client(client, 'F|Too many logins right now. Try again shortly (1/2):')
+            return
+
+        check_password(client, auth_choice, username, password)
+
+
+def complete_login(client, username):
+    session = REGISTRY.get(client)
+    session.state = None
+    if not REGISTRY.login(client, username):
+        # Registered a moment ago and logged in from another connection since.
+        send_to_client(client, 'F|User already logged in. Try again (1/2):')
+        session.state = ('AWAITING_AUTH_CHOICE', None)
+        return
+    if CLUSTER:
+        CLUSTER.bus.broadcast({'t': 'online', 'user': username})
+
+    DEFAULT_ROOM = "lobby"
+    lobby_message_content = (
+        f"Welcome, {username}!\n"
+        "You can start chatting immediately.\n"
+        "\n--- COMMANDS ---"
+        "\n/list [prefix] [page]\n/watch\n/join <room>\n/leave\n/subscribe <room>\n/unsubscribe <room>\n/switch <room>\n/pm <user> <msg>\n/inbox\n/history <user> [before <id>] [limit N]\n/search <terms> [with <user>]\n/send <user|room> <path>\n/call\n/quit"
+    )
+    initial_join_msg_content = join_room(client, DEFAULT_ROOM, initial_connect=True, after=lobby_message_content)
+
+    full_welcome_message = initial_join_msg_content + lobby_message_content
+    send_to_client(client, "I|" + full_welcome_message)
+    send_inbox(client, username)
+
+    if session.parser is not None and RESUME_SECRET:
+        session.resume_id = Sessions.new_resume_id()
+        send_resume_token(client)
+    # Tokens of the user's earlier sessions stop working.
+    record_login(username, session.resume_id)
+
+
+def needs_storage(client, message):
+    if message.startswith('H|'):
+        return False
+    if REGISTRY.get(client).username is None:
+        return True
+    return message.startswith('/') and message.split(maxsplit=1)[0].lower() in STORAGE_COMMANDS
+
+
+def receive_message(client, message):
+    # Storage loads in the background (and a restarted server first waits for
+    # its predecessor), so rather than block on it a message that needs it is
+    # held until release_held_messages() runs.
+    if client in HELD_MESSAGES and not message.startswith('H|'):
+        HELD_MESSAGES[client].append(message)
+    elif not STORAGE.ready() and needs_storage(client, message):
+        HELD_MESSAGES[client] = [message]
+    else:
+        handle_message(client, message)
+
+
+def release_held_messages():
+    with STATE_LOCK:
+        while HELD_MESSAGES:
+            client, messages = HELD_MESSAGES.popitem()
+            is_async = isinstance(client, AsyncConnection)
+            try:
+                for i, message in enumerate(messages):
+                    if client.closed:
+                        break
+                    if is_async and client.handoff is not None:
+                        client.handoff['messages'].extend(messages[i:])
+                        break
+                    handle_message(client, message)
+            except Exception as e:
+                print(f"Error handling client {REGISTRY.username(client, 'Unknown')}: {e}")
+                remove_client(client)
+            if is_async and not client.closed:
+                client.transport.resume_reading()
+
+
+def handle_message(client, message):
+    if not allow(client, 'file' if message.startswith('FILE|') else 'message'):
+        return
+
+    if message.startswith('H|'):
+        MESSAGES_RECEIVED.inc('heartbeat')
+        if message == 'H|ping':
+            send_to_client(client, 'H|pong')
+        return
+
+    session = REGISTRY.get(client)
+    if session.username is None:
+        MESSAGES_RECEIVED.inc('auth')
+        process_auth_message(client, message)
+        return
+
+    username = session.username
+    state_info = session.state
+
+    if message.startswith('FILE|'):
+        MESSAGES_RECEIVED.inc('file')
+        handle_file_message(client, message)
+        return
+
+    if state_info and state_info[0] == 'AWAITING_ROOM_CHOICE':
+        MESSAGES_RECEIVED.inc('menu')
+        process_room_selection(client, message, state_info[1])
+        return
+
+    elif state_info and state_info[0] == 'AWAITING_NEW_ROOM_NAME':
+        MESSAGES_RECEIVED.inc('menu')
+        process_new_room_name(client, message)
+        return
+
+    if message.startswith("WEBRTC|"):
+        MESSAGES_RECEIVED.inc('webrtc')
+        if not allow(client, 'webrtc'):
+            return
+        payload = message[len("WEBRTC|"):]
+        try:
+            json.loads(payload)
+        except json.JSONDecodeError:
+            return
+        relay_webrtc_signal(client, payload)
+        return
+
+    if message.startswith('/'):
+        MESSAGES_RECEIVED.inc('command')
+        cmd = message.split(maxsplit=1)[0].lower()
+        if not allow(client, COMMAND_CLASSES.get(cmd, 'command')):
+            return
+        with COMMAND_SECONDS.time(cmd if cmd in COMMANDS else 'other'):
+            process_command(client, message)
+    else:
+        MESSAGES_RECEIVED.inc('chat')
+        if not allow(client, 'chat'):
+            return
+        current_room = session.room
+        if current_room:
+            formatted_message = f'{username}: {message}'
+            broadcast_to_room(formatted_message, current_room, client, record=True, chat=(username, message))
+
+
+# ---------------- STATS ----------------
+Metrics.Gauge('multividchat_connections', "Open client connections", lambda: len(REGISTRY))
+Metrics.Gauge('multividchat_online_users', "Logged-in users on this process", lambda: len(REGISTRY.users))
+Metrics.Gauge('multividchat_room_users', "Users per room", room_user_counts, label='room')
+Metrics.Gauge('multividchat_outbound_queued_messages', "Messages waiting in all outbound queues",
+              lambda: sum(len(client.outbound) for client in REGISTRY))
+Metrics.Gauge('multividchat_outbound_queued_bytes', "Bytes waiting in all outbound queues",
+              lambda: sum(client.outbound.size_bytes for client in REGISTRY))
+Metrics.Gauge('multividchat_outbound_queue_max_messages', "Deepest single outbound queue",
+              lambda: max((len(client.outbound) for client in REGISTRY), default=0))
+Metrics.Gauge('multividchat_room_history_bytes', "Bytes held by room history buffers", lambda: ROOM_HISTORY.size_bytes)
+Metrics.Gauge('multividchat_room_history_rooms', "Rooms with buffered history", lambda: len(ROOM_HISTORY))
+
+
+def format_stats():
+    # Human-readable summary for /stats. Message rates cover the time since the
+    # previous /stats call (or since start-up).
+    now = time.time()
+    elapsed = max(now - LAST_STATS['at'], 1e-9)
+    sent = dict(MESSAGES_SENT.values)
+    rates = ", ".join(f"{kind} {(count - LAST_STATS['sent'].get(kind, 0)) / elapsed:.1f}"
+                      for kind, count in sorted(sent.items()))
+    LAST_STATS['at'] = now
+    LAST_STATS['sent'] = sent
+
+    queued = [len(client.outbound) for client in REGISTRY]
+    lines = [
+        f"Server stats (uptime {int(now - Metrics.STARTED_AT)}s):",
+        f"Connections: {len(REGISTRY)}, online: {len(REGISTRY.users)}",
+        "Rooms: " + ", ".join(f"{name} {count}" for name, count in room_user_counts().items()),
+        f"Sent msgs/s over {elapsed:.0f}s: {rates or 'none'}",
+        f"Send failures: {SEND_FAILURES.total()}, queued: {sum(queued)} (max {max(queued, default=0)}), dropped: {Outbound.DROPPED.total()}",
+    ]
+    for name in sorted(COMMAND_SECONDS.counts):
+        count = sum(COMMAND_SECONDS.counts[name])
+        p50 = COMMAND_SECONDS.quantile(0.5, name) * 1000
+        p99 = COMMAND_SECONDS.quantile(0.99, name) * 1000
+        lines.append(f"{name}: {count} calls, p50 <= {p50:g} ms, p99 <= {p99:g} ms")
+    for backend in sorted(Storage.SAVE_SECONDS.counts):
+        lines.append(f"Storage save ({backend}): p99 <= {Storage.SAVE_SECONDS.quantile(0.99, backend) * 1000:g} ms")
+    if Metrics.PROFILER:
+        lines.append("Hottest frames:")
+        for location, count in Metrics.PROFILER.hottest()[:5]:
+            lines.append(f"  {count * 100 / max(Metrics.PROFILER.total, 1):.1f}% {location}")
+    return "\n".join(lines)
+
+
+def start_metrics_server(loop=None):
+    # The HTTP endpoint runs on its own thread; rendering hops onto whichever
+    # thread owns the server state (the event loop, or STATE_LOCK holders).
+    if METRICS_PORT is None:
+        return
+    port = METRICS_PORT + (CLUSTER.shard if CLUSTER else 0)
+
+    async def render_on_loop():
+        return Metrics.render()
+
+    def render_text():
+        if loop is None:
+            with STATE_LOCK:
+                return Metrics.render()
+        return asyncio.run_coroutine_threadsafe(render_on_loop(), loop).result(5)
+
+    global METRICS_SERVER
+    METRICS_SERVER = Metrics.start_http_server(port, render_text)
+    print(f"Metrics on http://127.0.0.1:{port}/metrics")
+
+
+# ---------------- RATE LIMITS ----------------
+def _take(buckets, kind):
+    rate, burst = RATE_LIMITS[kind]
+    if not rate:
+        return True, None
+    bucket = buckets.get(kind)
+    if bucket is None:
+        bucket = buckets[kind] = RateLimit.TokenBucket(rate, burst)
+    return bucket.allow(), bucket
+
+
+def allow(client, kind):
+    # Charges one event of class kind to the connection. When the bucket is
+    # empty the event is dropped and the client is told once per burst.
+    session = REGISTRY.get(client)
+    if session.limits is None:
+        session.limits = {}
+    allowed, bucket = _take(session.limits, kind)
+    if allowed:
+        return True
+    RATE_LIMITED.inc(kind)
+    if not bucket.notified:
+        bucket.notified = True
+        send_to_client(client, f"E|Slow down: you are over the {kind} rate limit; extra messages are dropped.")
+    return False
+
+
+def allow_global(kind):
+    allowed, _ = _take(GLOBAL_BUCKETS, kind)
+    if not allowed:
+        RATE_LIMITED.inc(kind)
+    return allowed
+
+
+# ---------------- RESUME ----------------
+class ParkedConnection:
+    # Stands in for a resumable session whose socket went away: it keeps the
+    # session's room seat and username, and its outbound queue (drop-oldest,
+    # RESUME_BUFFER deep) collects what the client misses until it resumes or
+    # the window runs out.
+    def __init__(self, address):
+        self.address = address
+        self.outbound = Outbound.OutboundQueue(RESUME_BUFFER, OUTBOUND_MAX_BYTES, Outbound.DROP_OLDEST)
+        self.closed = False
+        self.last_seen = time.monotonic()
+        self.expires = self.last_seen + RESUME_WINDOW
+
+    def send(self, data):
+        if self.closed:
+            raise ConnectionError("session is closed")
+        self.outbound.put(data)
+
+    def drain_outbound(self):
+        return self.outbound.drain()
+
+    def close(self):
+        self.closed = True
+
+
+def send_resume_token(client):
+    session = REGISTRY.get(client)
+    token = Sessions.issue_token(RESUME_SECRET, session.username, session.room, session.resume_id, RESUME_TOKEN_TTL,
+                                 session.subscriptions)
+    send_to_client(client, "K|" + token)
+
+
+def record_login(username, resume_id):
+    until = time.time() + RESUME_TOKEN_TTL
+    LOGINS.record(username, resume_id, until)
+    if CLUSTER:
+        CLUSTER.bus.broadcast({'t': 'login', 'user': username, 'sid': resume_id, 'until': until})
+
+
+def park_client(client):
+    parked = ParkedConnection(client.address)
+    for data in client.drain_outbound():
+        parked.outbound.put(data)
+    REGISTRY.replace(client, parked)
+    client.close()
+    print(f"{REGISTRY.username(parked)} lost its connection; holding the session for {RESUME_WINDOW:.0f}s.")
+
+
+def take_over(old_conn, client):
+    # The reconnecting socket replaces the old one, whether it was parked or
+    # is still open because the server has not noticed it is dead yet.
+    new_session = REGISTRY.get(client)
+    drop_transfers(old_conn)
+    REGISTRY.close(client)
+    session = REGISTRY.replace(old_conn, client)
+    session.parser = new_session.parser
+    session.state = None
+    missed = old_conn.drain_outbound()
+    old_conn.close()
+
+    if (session.wire is None) != (new_session.wire is None):
+        # Queued in the other wire format, which this client cannot read.
+        missed = []
+        session.wire = new_session.wire
+    send_to_client(client, f"S|Session resumed. {len(missed)} missed message(s).")
+    if session.wire:
+        # The new connection's decoder starts with no names.
+        client.send(NAMES.define(sorted(session.wire)))
+    for data in missed:
+        client.send(data)
+    # PMs sent while parked were kept as unread.
+    send_inbox(client, session.username)
+    send_resume_token(client)
+
+
+def resume_session(client, token):
+    claims = Sessions.verify_token(RESUME_SECRET, token) if RESUME_SECRET else None
+    if claims is None or not is_framed(client):
+        RESUMES.inc('rejected')
+        send_to_client(client, 'F|Session expired. Type 1 to Register, 2 to Login.')
+        return
+
+    username = claims['u']
+    existing = REGISTRY.find(username)
+    if existing is not None:
+        if REGISTRY.get(existing).resume_id != claims['sid']:
+            RESUMES.inc('rejected')
+            send_to_client(client, 'F|User already logged in. Type 1 to Register, 2 to Login.')
+            return
+        RESUMES.inc('resumed')
+        take_over(existing, client)
+        return
+
+    # Nothing to take back (window over, server restarted, or the session is
+    # held by another shard): the token still stands in for the password and
+    # the client goes back to the room it was in, unless the user has logged
+    # out or in again since.
+    if not LOGINS.allows(username, claims['sid']):
+        RESUMES.inc('rejected')
+        send_to_client(client, 'F|Session expired. Type 1 to Register, 2 to Login.')
+        return
+    if CLUSTER and username in CLUSTER.user_shards:
+        CLUSTER.bus.send(CLUSTER.user_shards.pop(username), {'t': 'drop', 'user': username, 'sid': claims['sid']})
+    RESUMES.inc('restored')
+    send_to_client(client, 'S|Session restored.')
+    complete_login(client, username)
+    if REGISTRY.is_logged_in(client) and claims['r'] and claims['r'] != 'lobby':
+        join_room(client, claims['r'])
+    for room_name in claims.get('s', ()):
+        if REGISTRY.is_logged_in(client):
+            subscribe_room(client, room_name)
+
+
+# ---------------- FILE TRANSFERS ----------------
+# Client.py turns "/send <user|room> <path>" into a FILE|OFFER and streams the
+# file once the offer starts; see Transfers for the chunking and the window.
+#   FILE|OFFER|ref|target|size|sha256|name  -> X|OFFERED|ref|id|count or X|REFUSED|ref|reason
+#                                              X|OFFER|id|sender|room|size|sha256|name to recipients
+#   FILE|ACCEPT|id, FILE|DECLINE|id         (recipient)
+#                                           -> X|START|id|chunk size|window|count to the sender
+#   FILE|DATA|id|seq|base64                 (sender) -> X|DATA|id|seq|base64 to recipients
+#   FILE|ACK|id|seq                         (recipient) -> X|ACK|id|chunks every recipient has
+#   FILE|END|id                             (sender) -> X|END|id to recipients
+#   FILE|DONE|id                            (recipient, checksum verified) -> X|DELIVERED|id|user
+#   FILE|CANCEL|id|reason                   (either) -> X|FAILED|id|user|reason or X|CANCEL|id|reason
+def handle_file_message(client, message):
+    session = REGISTRY.get(client)
+    if not session.framed:
+        send_to_client(client, "E|File transfers need a framed client.")
+        return
+    kind, _, rest = message[len('FILE|'):].partition('|')
+
+    if kind == 'OFFER':
+        fields = rest.split('|', 4)
+        if len(fields) < 5:
+            return
+        ref, target, size, digest, name = fields
+        if not allow(client, 'command'):
+            send_to_client(client, f"X|REFUSED|{ref}|rate limited")
+            return
+        offer_file(client, ref, target, size, digest, name)
+        return
+
+    transfer_id, _, rest = rest.partition('|')
+    transfer = TRANSFERS.get(int(transfer_id)) if transfer_id.isdigit() else None
+    if transfer is None:
+        return
+
+    if client is transfer.sender:
+        if kind == 'DATA':
+            relay_chunk(transfer, rest)
+        elif kind == 'END':
+            if not transfer.started or transfer.received != transfer.size:
+                cancel_transfer(transfer, "incomplete")
+                return
+            transfer.ended = True
+            send_to_many(transfer.receivers, f"X|END|{transfer.id}")
+        elif kind == 'CANCEL':
+            cancel_transfer(transfer, rest or "cancelled by sender")
+        return
+
+    if kind in ('ACCEPT', 'DECLINE'):
+        if client not in transfer.offered:
+            return
+        del transfer.offered[client]
+        if kind == 'ACCEPT':
+            transfer.receivers[client] = 0
+        settle_transfer(transfer)
+
+    elif kind == 'ACK':
+        seq = int(rest) if rest.isdigit() else -1
+        if client in transfer.receivers and seq < transfer.next_seq:
+            transfer.receivers[client] = max(transfer.receivers[client], seq + 1)
+            update_credit(transfer)
+
+    elif kind == 'DONE':
+        if client in transfer.receivers and transfer.ended:
+            del transfer.receivers[client]
+            send_to_client(transfer.sender, f"X|DELIVERED|{transfer.id}|{session.username}")
+            settle_transfer(transfer)
+
+    elif kind == 'CANCEL':
+        drop_receiver(transfer, client, rest or "cancelled")
+
+
+def offer_file(client, ref, target, size, digest, name):
+    session = REGISTRY.get(client)
+    if not size.isdigit() or len(digest) != 64 or any(c not in '0123456789abcdef' for c in digest):
+        send_to_client(client, f"X|REFUSED|{ref}|malformed offer")
+        return
+    if '|' in session.username:
+        # Accounts from before valid_username: the name would shift every
+        # later field of X|OFFER, which receivers read with split('|', 5).
+        send_to_client(client, f"X|REFUSED|{ref}|usernames with '|' cannot send files")
+        return
+    if sum(1 for transfer in TRANSFERS.values() if transfer.sender is client) >= MAX_OPEN_TRANSFERS:
+        send_to_client(client, f"X|REFUSED|{ref}|you already have {MAX_OPEN_TRANSFERS} transfers open")
+        return
+
+    if target in (session.room, *session.subscriptions):
+        room = target
+        candidates = REGISTRY.members(room)
+    else:
+        room = ''
+        recipient = REGISTRY.find(target)
+        if recipient is None:
+            if CLUSTER and target in CLUSTER.user_shards:
+                reason = f"{target} is connected to another server"
             else:
-                send_to_client(client, 'F|Invalid choice. Type 1 or 2:')
+                reason = f"{target} is not a room you are in or an online user"
+            send_to_client(client, f"X|REFUSED|{ref}|{reason}")
+            return
+        candidates = [recipient]
+
+    # Parked sessions would come back on a new connection the offer does not
+    # know, and legacy clients cannot take the chunks.
+    recipients = [conn for conn in candidates if conn is not client and not isinstance(conn, ParkedConnection)
+                  and REGISTRY.get(conn).framed]
+    if not recipients:
+        send_to_client(client, f"X|REFUSED|{ref}|nobody there can receive files")
+        return
 
-        ONLINE_USERS[client] = username
+    name = Transfers.safe_name(name)
+    transfer = Transfers.Transfer(next(TRANSFER_IDS), client, session.username, room, int(size), digest, name,
+                                  recipients, time.monotonic() + Transfers.OFFER_TIMEOUT)
+    TRANSFERS[transfer.id] = transfer
+    send_to_client(client, f"X|OFFERED|{ref}|{transfer.id}|{len(recipients)}")
+    send_to_many(recipients, f"X|OFFER|{transfer.id}|{session.username}|{room}|{size}|{digest}|{name}")
+
+
+def relay_chunk(transfer, rest):
+    # rest is "seq|base64". The chunk is passed on as received; only its
+    # size is worked out, to hold the sender to the offer.
+    seq, _, data = rest.partition('|')
+    size = Transfers.decoded_size(data)
+    if (not transfer.started or transfer.ended or seq != str(transfer.next_seq)
+            or transfer.next_seq >= transfer.credit + Transfers.WINDOW
+            or len(data) > Transfers.ENCODED_CHUNK_SIZE or transfer.received + size > transfer.size):
+        cancel_transfer(transfer, "sender broke the transfer protocol")
+        return
+    transfer.next_seq += 1
+    transfer.received += size
+    Transfers.FILE_BYTES.inc(amount=size)
+    send_to_many(transfer.receivers, f"X|DATA|{transfer.id}|{rest}")
 
-        DEFAULT_ROOM = "lobby"
-        initial_join_msg_content = join_room(client, DEFAULT_ROOM, initial_connect=True)
 
-        lobby_message_content = (
-            f"Welcome, {username}!\n"
-            "You can start chatting immediately.\n"
-            "\n--- COMMANDS ---"
-            "\n/list\n/join <room>\n/leave\n/pm <user> <msg>\n/history <user>\n/call"
-        )
+def update_credit(transfer):
+    # Lets the sender run ahead again once the slowest recipient catches up.
+    acknowledged = transfer.acknowledged()
+    if transfer.started and acknowledged > transfer.credit:
+        transfer.credit = acknowledged
+        send_to_client(transfer.sender, f"X|ACK|{transfer.id}|{acknowledged}")
 
-        full_welcome_message = initial_join_msg_content + lobby_message_content
-        send_to_client(client, "I|" + full_welcome_message)
 
-        while True:
-            message = client.recv(1024).decode('utf-8').strip()
+def settle_transfer(transfer):
+    # Moves the transfer on after a recipient answered, finished or left:
+    # start it once nobody is left to answer, and close it once nobody is
+    # left to receive.
+    if transfer.id not in TRANSFERS:
+        return
+    if not transfer.started:
+        if transfer.offered:
+            return
+        if not transfer.receivers:
+            cancel_transfer(transfer, "nobody accepted")
+            return
+        transfer.started = True
+        send_to_client(transfer.sender, f"X|START|{transfer.id}|{Transfers.CHUNK_SIZE}|{Transfers.WINDOW}|{len(transfer.receivers)}")
+    elif not transfer.receivers:
+        if transfer.ended:
+            del TRANSFERS[transfer.id]
+        else:
+            cancel_transfer(transfer, "no recipients left")
+    else:
+        update_credit(transfer)
 
-            if not message: continue
 
-            state_info = CLIENT_STATE.get(client)
+def drop_receiver(transfer, conn, reason):
+    if transfer.id not in TRANSFERS:
+        return
+    if conn in transfer.offered:
+        del transfer.offered[conn]
+    elif conn in transfer.receivers:
+        del transfer.receivers[conn]
+        send_to_client(transfer.sender, f"X|FAILED|{transfer.id}|{REGISTRY.username(conn, '?')}|{reason}")
+    else:
+        return
+    settle_transfer(transfer)
 
-            if state_info and state_info[0] == 'AWAITING_ROOM_CHOICE':
-                process_room_selection(client, message, state_info[1])
-                continue
 
-            elif state_info and state_info[0] == 'AWAITING_NEW_ROOM_NAME':
-                process_new_room_name(client, message)
-                continue
+def cancel_transfer(transfer, reason, notify_sender=True):
+    if TRANSFERS.pop(transfer.id, None) is None:
+        return
+    message = f"X|CANCEL|{transfer.id}|{reason}"
+    send_to_many([*transfer.offered, *transfer.receivers], message)
+    if notify_sender:
+        send_to_client(transfer.sender, message)
+
+
+def drop_transfers(client):
+    # A connection going away (disconnect, resume, move to another shard)
+    # takes its transfers with it; a resumed client starts over.
+    for transfer in list(TRANSFERS.values()):
+        if transfer.sender is client:
+            cancel_transfer(transfer, "sender disconnected", notify_sender=False)
+        elif client in transfer.offered or client in transfer.receivers:
+            drop_receiver(transfer, client, "disconnected")
+
+
+def expire_offers(now):
+    for transfer in list(TRANSFERS.values()):
+        if not transfer.started and now > transfer.expires:
+            send_to_many(transfer.offered, f"X|CANCEL|{transfer.id}|offer expired")
+            transfer.offered.clear()
+            settle_transfer(transfer)
+
+
+# ---------------- HEARTBEATS ----------------
+def set_keepalive(sock):
+    # Lets the kernel notice peers that vanished without a FIN (power loss,
+    # NAT timeout) even when nothing is being written to them.
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (('TCP_KEEPIDLE', KEEPALIVE_IDLE), ('TCP_KEEPINTVL', KEEPALIVE_INTERVAL), ('TCP_KEEPCNT', KEEPALIVE_COUNT)):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def reap_idle_clients():
+    now = time.monotonic()
+    expire_offers(now)
+    LOGINS.purge()
+    for client in REGISTRY:
+        if isinstance(client, ParkedConnection):
+            if now > client.expires:
+                remove_client(client, resumable=False)
+            continue
+        idle = now - client.last_seen
+        framed = is_framed(client)
+        if framed:
+            timeout = IDLE_TIMEOUT
+        elif not REGISTRY.is_logged_in(client):
+            timeout = IDLE_TIMEOUT and max(IDLE_TIMEOUT, LEGACY_LOGIN_TIMEOUT)
+        else:
+            timeout = 0
+        if timeout and idle > timeout:
+            REAPED.inc()
+            print(f"Reaping {REGISTRY.username(client, client.address)} after {idle:.0f}s of silence.")
+            remove_client(client)
+        elif HEARTBEAT_INTERVAL and idle > HEARTBEAT_INTERVAL and framed:
+            send_to_client(client, 'H|ping')
+
+
+def reaper_interval():
+    return max(0.5, min(value for value in (HEARTBEAT_INTERVAL, IDLE_TIMEOUT, RESUME_WINDOW) if value) / 2)
 
-            if message.startswith("WEBRTC|"):
-                try:
-                    payload = json.loads(message[len("WEBRTC|"):])
-                    relay_webrtc_signal(client, payload)
-                except json.JSONDecodeError:
-                    pass
-                continue
 
-            if message.startswith('/'):
-                process_command(client, message)
+def reaper_thread():
+    while True:
+        time.sleep(reaper_interval())
+        with STATE_LOCK:
+            reap_idle_clients()
+
+
+async def reaper_task():
+    while True:
+        await asyncio.sleep(reaper_interval())
+        reap_idle_clients()
+
+
+# ---------------- VIDEO ----------------
+class VideoRooms:
+    # BridgeClient membership backed by the chat registry. A browser proves
+    # who it is with the token from its V|OPEN_VIDEO link and joins the call
+    # of whatever room its chat session is in, with the username as peer id;
+    # its websocket is kept on the session. room_peers holds, per room, the
+    # sessions whose video is in that room's call, so a signal only walks the
+    # call and not every member of the room.
+    def __init__(self):
+        self.joined = {}
+        self.room_peers = {}
+
+    def identify(self, data):
+        claims = Sessions.verify_token(VIDEO_SECRET, str(data.get('token') or ''))
+        session = REGISTRY.get(REGISTRY.find(claims['u'])) if claims else None
+        if session is None or not session.room:
+            return None
+        return session.username, session.username, session.room
+
+    def add(self, ws, peer_id, username, room):
+        session = REGISTRY.get(REGISTRY.find(username))
+        if session.video is not None:
+            end_video(session)  # a second tab replaces the first
+        session.video = ws
+        self.joined[ws] = (room, username)
+        self.room_peers.setdefault(room, {})[username] = ws
+
+    def detach(self, ws):
+        # Out of the call straight away; the websocket itself is closed later.
+        room, username = self.joined.get(ws, (None, None))
+        peers = self.room_peers.get(room)
+        if peers is None or peers.get(username) is not ws:
+            return
+        del peers[username]
+        if not peers:
+            del self.room_peers[room]
+
+    def remove(self, ws):
+        self.detach(ws)
+        joined = self.joined.pop(ws, None)
+        if joined is None:
+            return None
+        room, username = joined
+        session = REGISTRY.get(REGISTRY.find(username))
+        if session is not None and session.video is ws:
+            session.video = None
+        if self.room_peers.get(room, {}).get(username, ws) is not ws:
+            # A newer tab already holds the peer id in this call; the old
+            # websocket leaving must not announce it gone.
+            return None
+        return joined
+
+    def peers(self, room):
+        return self.room_peers.get(room, {})
+
+    def name(self, peer_id):
+        return peer_id
+
+
+def video_link(session):
+    token = Sessions.issue_token(VIDEO_SECRET, session.username, session.room, None, VIDEO_TOKEN_TTL)
+    if VIDEO_URL:
+        return f"{VIDEO_URL.rstrip('/')}/VideoClient.html?token={token}"
+    # Relative to the host the chat client is connected to.
+    return f":{HTTP_PORT + (CLUSTER.shard if CLUSTER else 0)}/VideoClient.html?token={token}"
+
+
+def end_video(session, room_name=None):
+    # Takes the session out of its call when it leaves the call's room or logs
+    # off.
+    ws = session.video
+    if ws is None:
+        return
+    if room_name is not None and BridgeClient.ROOMS.joined.get(ws, (room_name,))[0] != room_name:
+        return
+    session.video = None
+    BridgeClient.ROOMS.detach(ws)
+    LOOP.create_task(close_video(ws))
+
+
+async def close_video(ws):
+    await BridgeClient.leave_room(ws)
+    await ws.close(message=b"left the room")
+
+
+async def start_video():
+    global HTTP_SOCK, HTTP_RUNNER
+    if not HTTP_PORT:
+        return
+    if BridgeClient is None:
+        print("aiohttp is not installed; video calls are disabled.")
+        return
+    if HTTP_FD is not None:
+        HTTP_SOCK = socket.socket(fileno=HTTP_FD)
+    else:
+        port = HTTP_PORT + (CLUSTER.shard if CLUSTER else 0)
+        HTTP_SOCK = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        HTTP_SOCK.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        HTTP_SOCK.bind((HOST, port))
+        HTTP_SOCK.listen(1024)
+    HTTP_RUNNER = await BridgeClient.start(VideoRooms(), sock=HTTP_SOCK, adaptive=ADAPTIVE_BITRATE)
+    print(f"Video calls on http://{HOST}:{HTTP_SOCK.getsockname()[1]}/VideoClient.html")
+
+
+async def stop_video():
+    # Closes every call with 1012 so browsers reload onto a restarted server.
+    global HTTP_RUNNER
+    if HTTP_RUNNER is not None:
+        runner, HTTP_RUNNER = HTTP_RUNNER, None
+        await runner.cleanup()
+
+
+# ---------------- RESTART ----------------
+def successor_argv(listen_fd, handoff_fd):
+    argv = []
+    args = iter(sys.argv[1:])
+    for arg in args:
+        if arg in ('--listen-fd', '--handoff-fd', '--http-fd'):
+            next(args, None)
+        elif not arg.startswith(('--listen-fd=', '--handoff-fd=', '--http-fd=')):
+            argv.append(arg)
+    argv += ['--listen-fd', str(listen_fd), '--handoff-fd', str(handoff_fd)]
+    if HTTP_SOCK is not None:
+        argv += ['--http-fd', str(HTTP_SOCK.fileno())]
+    return [sys.executable, os.path.abspath(sys.argv[0]), *argv]
+
+
+def start_successor(listen_fd):
+    # Starts a new copy of the server on the same listening socket and waits
+    # for it to accept connections. Returns True once it does; until then, and
+    # if it fails, this process keeps serving.
+    global HANDOFF_PEER
+    started = time.monotonic()
+    if METRICS_SERVER is not None:
+        METRICS_SERVER.shutdown()
+        METRICS_SERVER.server_close()
+    ours, theirs = socket.socketpair()
+    try:
+        fds = (listen_fd, theirs.fileno()) + ((HTTP_SOCK.fileno(),) if HTTP_SOCK is not None else ())
+        child = subprocess.Popen(successor_argv(listen_fd, theirs.fileno()), pass_fds=fds)
+    except OSError as e:
+        print(f"Restart failed: {e}")
+        ours.close()
+        return False
+    finally:
+        theirs.close()
+
+    ours.settimeout(DRAIN_TIMEOUT)
+    try:
+        ready = ours.recv(1) == b'R'
+    except OSError:
+        ready = False
+    if not ready:
+        print("Restart failed: the new server did not start; still serving.")
+        ours.close()
+        if child.poll() is None:
+            child.kill()
+        start_metrics_server(LOOP)
+        return False
+    # Kept open until this process exits: the successor loads storage on EOF.
+    HANDOFF_PEER = ours
+    print(f"Restart: process {child.pid} accepting {(time.monotonic() - started) * 1000:.0f} ms after the signal; draining.")
+    return True
+
+
+def notify_predecessor():
+    if HANDOFF_FD is not None:
+        socket.socket(fileno=os.dup(HANDOFF_FD)).sendall(b'R')
+        print(f"Accepting {(time.time() - Metrics.STARTED_AT) * 1000:.0f} ms after start (inherited listener).")
+
+
+def wait_for_predecessor():
+    # The old process holds its end of the handoff socket until it exits.
+    handoff = socket.socket(fileno=HANDOFF_FD)
+    handoff.settimeout(DRAIN_TIMEOUT + 5)
+    try:
+        while handoff.recv(64):
+            pass
+    except OSError:
+        pass
+    handoff.close()
+
+
+def drain_clients():
+    # Sends every framed session a fresh resume token before closing it, so
+    # clients reconnect to the successor and carry on in the same room; no
+    # departure notices go out since everyone is coming straight back.
+    clients = []
+    for client in REGISTRY:
+        session = REGISTRY.get(client)
+        if not isinstance(client, ParkedConnection):
+            if session.username and session.resume_id and RESUME_SECRET:
+                send_resume_token(client)
+                send_to_client(client, 'S|Server restarting, reconnecting...')
             else:
-                current_room = CLIENT_ROOM.get(client)
-                if current_room:
-                    formatted_message = f'{username}: {message}'
-                    broadcast_to_room(formatted_message, current_room, client)
+                send_to_client(client, 'E|Server restarting. Please reconnect.')
+            clients.append(client)
+        REGISTRY.close(client)
+        WATCHERS.discard(session)
+        client.close()
+    print(f"Draining {len(clients)} connections.")
+    return clients
+
+
+async def restart_async(server, stopped):
+    # The successor starts on a worker thread so clients are served meanwhile.
+    global RESTARTING
+    if RESTARTING:
+        return
+    RESTARTING = True
+    listener = server.sockets[0]
+    if not await LOOP.run_in_executor(None, start_successor, listener.fileno()):
+        RESTARTING = False
+        return
+    server.close()
+    await stop_video()
+    clients = drain_clients()
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    while time.monotonic() < deadline and any(client.transport.get_write_buffer_size() for client in clients):
+        await asyncio.sleep(0.05)
+    stopped.set_result(None)
+
+
+# ---------------- THREADED MODE ----------------
+class ThreadedConnection:
+    # Wraps an accepted socket with a bounded outbound queue drained by its own
+    # writer thread, so a stalled receiver never blocks the thread that is
+    # broadcasting to it.
+    def __init__(self, sock, address=None):
+        self.sock = sock
+        self.address = address
+        self.last_seen = time.monotonic()
+        self.outbound = Outbound.OutboundQueue(OUTBOUND_MAX_MESSAGES, OUTBOUND_MAX_BYTES, OUTBOUND_OVERFLOW)
+        self.compressor = None
+        # Only framed clients can split a coalesced write back into messages.
+        self.framed = False
+        self.closed = False
+        self._ready = threading.Condition()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+
+    def recv(self, size):
+        return self.sock.recv(size)
+
+    def join(self, timeout=None):
+        # Waits for the writer to flush and close the socket after close().
+        self._writer.join(timeout)
+
+    def send(self, data):
+        with self._ready:
+            if self.closed:
+                raise ConnectionError("connection is closed")
+            self.outbound.put(data)
+            self._ready.notify()
+
+    def drain_outbound(self):
+        # Takes what the writer has not picked up yet, for a session that is
+        # being parked or resumed elsewhere.
+        with self._ready:
+            return self.outbound.drain()
+
+    def enable_compression(self, compressor):
+        with self._ready:
+            attach_compressor(self, compressor)
+
+    def close(self):
+        # Wakes the reader thread if it is blocked in recv(); the writer still
+        # flushes whatever is queued. This has to happen before the writer is
+        # woken, since it closes the socket when done and a close alone does
+        # not interrupt a blocked recv().
+        try:
+            self.sock.shutdown(socket.SHUT_RD)
+        except OSError:
+            pass
+        with self._ready:
+            self.closed = True
+            self._ready.notify()
+        if self.outbound.overflowed:
+            self.sock.close()
+
+    def _write_loop(self):
+        try:
+            while True:
+                with self._ready:
+                    while not self.outbound and not self.closed:
+                        self._ready.wait()
+                    batch = self.outbound.drain()
+                    compressor = self.compressor
+                    framed = self.framed
+                    closed = self.closed
+                if batch:
+                    if compressor is not None:
+                        batch = compressor.pack(batch)
+                    if framed:
+                        Outbound.send_batch(self.sock, batch)
+                    else:
+                        # Legacy clients take each recv() as one message, so
+                        # they get one send per message, as before framing.
+                        for data in batch:
+                            self.sock.sendall(data)
+                elif closed:
+                    break
+        except OSError:
+            with self._ready:
+                self.closed = True
+        finally:
+            self.sock.close()
+
+
+def handle_client(client):
+    try:
+        with STATE_LOCK:
+            REGISTRY.open(client)
+            start_auth(client)
+
+        first_read = True
+        while not client.closed:
+            data = client.recv(Framing.RECV_SIZE)
+            if not data:
+                break
+            client.last_seen = time.monotonic()
+
+            with STATE_LOCK:
+                for message in decode_incoming(client, data, first_read):
+                    receive_message(client, message)
+            first_read = False
 
     except Exception as e:
-        print(f"Error handling client {ONLINE_USERS.get(client, 'Unknown')}: {e}")
+        print(f"Error handling client {REGISTRY.username(client, 'Unknown')}: {e}")
+
+    with STATE_LOCK:
         remove_client(client)
 
 
 def receive():
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((HOST, PORT))
-    server.listen()
+    if LISTEN_FD is not None:
+        server = socket.socket(fileno=LISTEN_FD)
+    else:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((HOST, PORT))
+        server.listen()
+    # accept() wakes up periodically to notice a restart request; the timeout
+    # also makes the socket non-blocking, which a successor sharing it needs.
+    server.settimeout(0.5)
     print(f"Server listening on {HOST}:{PORT}")
-
+    notify_predecessor()
+    start_metrics_server()
+    if IDLE_TIMEOUT or RESUME_WINDOW:
+        threading.Thread(target=reaper_thread, daemon=True).start()
+    STORAGE.when_ready(release_held_messages)
+
+    restart_requested = threading.Event()
+    signal.signal(RESTART_SIGNAL, lambda signum, frame: restart_requested.set())
     while True:
-        client, address = server.accept()
+        if restart_requested.is_set():
+            restart_requested.clear()
+            if start_successor(server.fileno()):
+                break
+        try:
+            sock, address = server.accept()
+        except socket.timeout:
+            continue
+        if not allow_global('connect'):
+            sock.close()
+            continue
+        set_keepalive(sock)
+        client = ThreadedConnection(sock, address)
         thread = threading.Thread(target=handle_client, args=(client,))
         thread.start()
 
+    signal.signal(RESTART_SIGNAL, signal.SIG_IGN)
+    server.close()
+    with STATE_LOCK:
+        clients = drain_clients()
+    deadline = time.monotonic() + DRAIN_TIMEOUT
+    for client in clients:
+        client.join(max(0.0, deadline - time.monotonic()))
+
+
+# ---------------- ASYNC MODE ----------------
+class AsyncConnection(asyncio.Protocol):
+    # One protocol instance per connection, driven by the event loop, which is
+    # the only writer of server state. send() only appends to a bounded outbound
+    # queue and schedules a flush, so everything sent to a framed connection
+    # during one loop iteration leaves in a single writelines() call; a legacy
+    # connection gets one write() per message. While the transport
+    # is above its high-water mark the queue absorbs the backlog and the
+    # overflow policy decides what happens to a consumer that never catches up.
+    def __init__(self, adopted_session=None):
+        self.transport = None
+        self.address = None
+        self.outbound = Outbound.OutboundQueue(OUTBOUND_MAX_MESSAGES, OUTBOUND_MAX_BYTES, OUTBOUND_OVERFLOW)
+        self.compressor = None
+        self.framed = False
+        self.closed = False
+        self.first_read = True
+        self.last_seen = time.monotonic()
+        self.handoff = None
+        self._adopted_session = adopted_session
+        self._paused = False
+        self._flush_scheduled = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self._adopted_session is None and not allow_global('connect'):
+            transport.abort()
+            return
+        self.address = transport.get_extra_info('peername')
+        set_keepalive(transport.get_extra_info('socket'))
+        REGISTRY.open(self)
+        if self._adopted_session is not None:
+            adopt_session(self, self._adopted_session)
+            self._adopted_session = None
+        else:
+            start_auth(self)
+
+    def data_received(self, data):
+        self.last_seen = time.monotonic()
+        try:
+            messages = decode_incoming(self, data, self.first_read)
+            self.first_read = False
+            for i, message in enumerate(messages):
+                if self.closed:
+                    break
+                if self.handoff is not None:
+                    # The session is moving to another shard; whatever the
+                    # client pipelined after the move goes with it.
+                    self.handoff['messages'].extend(messages[i:])
+                    break
+                receive_message(self, message)
+            if self in HELD_MESSAGES and not self.closed:
+                self.transport.pause_reading()
+        except Exception as e:
+            print(f"Error handling client {REGISTRY.username(self, 'Unknown')}: {e}")
+            remove_client(self)
+
+    def connection_lost(self, exc):
+        self.closed = True
+        remove_client(self)
+
+    def pause_writing(self):
+        self._paused = True
+
+    def resume_writing(self):
+        self._paused = False
+        self._schedule_flush()
+
+    def send(self, data):
+        if self.closed:
+            raise ConnectionError("connection is closed")
+        self.outbound.put(data)
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if not self._flush_scheduled and not self._paused:
+            self._flush_scheduled = True
+            asyncio.get_running_loop().call_soon(self._flush)
+
+    def drain_outbound(self):
+        return self.outbound.drain()
+
+    def enable_compression(self, compressor):
+        attach_compressor(self, compressor)
+
+    def _write_queued(self):
+        batch = self.outbound.drain()
+        if self.compressor is not None:
+            batch = self.compressor.pack(batch)
+        if self.framed:
+            self.transport.writelines(batch)
+        else:
+            for data in batch:
+                self.transport.write(data)
+
+    def _flush(self):
+        self._flush_scheduled = False
+        if self._paused or self.transport.is_closing():
+            return
+        if self.outbound:
+            self._write_queued()
+
+    async def wait_flushed(self, timeout=5.0):
+        deadline = time.monotonic() + timeout
+        while self.outbound or self.transport.get_write_buffer_size():
+            if self.transport.is_closing() or time.monotonic() > deadline:
+                return False
+            await asyncio.sleep(0.005)
+        return True
+
+    def close(self):
+        self.closed = True
+        if self.transport is None or self.transport.is_closing():
+            return
+        if self.outbound.overflowed:
+            self.transport.abort()
+            return
+        if self.outbound:
+            self._write_queued()
+        self.transport.close()
+
+
+# ---------------- CLUSTER ----------------
+def hand_off(client, room_name):
+    # Moves a logged-in connection to the shard that owns room_name: the session
+    # is detached here without a disconnect notice, the socket stops being read,
+    # and once everything already queued for it has been written the file
+    # descriptor travels over the bus to the owner, which re-attaches it and
+    # completes the join.
+    # Subscriptions are to rooms this shard hosts, so they end here.
+    session = REGISTRY.get(client)
+    dropped = list(session.subscriptions)
+    for subscribed_room in dropped:
+        unsubscribe_room(client, subscribed_room)
+    if dropped:
+        send_to_client(client, f"I|Unsubscribed from {', '.join(dropped)}: {room_name} is on another server.")
+    client.transport.pause_reading()
+    drop_transfers(client)
+    REGISTRY.close(client)
+    client.handoff = {
+        't': 'handoff',
+        'user': session.username,
+        'room': room_name,
+        'framed': session.parser is not None,
+        'wire': session.wire is not None,
+        'zlib': client.compressor is not None,
+        'sid': session.resume_id,
+        'messages': [],
+    }
+    if session.parser is not None:
+        client.handoff['pending'] = base64.b64encode(session.parser.pending()).decode('ascii')
+    asyncio.get_running_loop().create_task(transfer_connection(client, CLUSTER.owner_of(room_name)))
+
+
+async def transfer_connection(client, shard):
+    if not await client.wait_flushed():
+        client.transport.abort()
+        return
+    sock = client.transport.get_extra_info('socket')
+    CLUSTER.bus.send(shard, client.handoff, fds=[os.dup(sock.fileno())])
+    # Only this process's descriptor is closed; the connection lives on in the
+    # owning shard.
+    client.closed = True
+    client.transport.abort()
+
+
+def adopt_session(client, session):
+    username = session['user']
+    client.first_read = False
+    if session['framed']:
+        parser = REGISTRY.get(client).parser = Framing.FrameParser()
+        client.framed = True
+        parser.feed(base64.b64decode(session.get('pending', '')))
+    else:
+        parser = None
+    if session.get('wire'):
+        # Names are interned per process, so this shard defines its own; its
+        # compressor starts a fresh stream, which the client is told of.
+        REGISTRY.get(client).wire = set()
+    if session.get('zlib'):
+        client.compressor = Wire.Compressor(COMPRESS_THRESHOLD)
+
+    if not REGISTRY.login(client, username):
+        send_to_client(client, 'F|User already logged in.')
+        remove_client(client)
+        return
+    REGISTRY.get(client).resume_id = session.get('sid')
+    CLUSTER.bus.broadcast({'t': 'online', 'user': username})
+    join_room(client, session['room'])
+
+    messages = list(session['messages'])
+    if parser is not None:
+        messages += [message.strip() for message in parser.read_messages() if message.strip()]
+    for message in messages:
+        if client.closed or client.handoff is not None:
+            break
+        receive_message(client, message)
+    if client in HELD_MESSAGES and not client.closed:
+        client.transport.pause_reading()
+
+
+def handle_bus_message(message, fds):
+    kind = message['t']
+    source = message['src']
+
+    if kind == 'room':
+        deliver_to_rooms(message['msg'], (message['room'],), chat=message.get('chat'))
+        if message.get('record'):
+            record_room_message(message['room'], message['msg'])
+
+    elif kind == 'pm':
+        recipient_socket = REGISTRY.find(message['to'])
+        if isinstance(recipient_socket, ParkedConnection):
+            recipient_socket = None
+        if STORAGE.ready():
+            save_pm(message['from'], message['to'], message['text'], unread=recipient_socket is None)
+        else:
+            STORAGE.when_ready(functools.partial(LOOP.call_soon_threadsafe, save_pm, message['from'], message['to'],
+                                                 message['text'], recipient_socket is None))
+        if recipient_socket:
+            send_to_client(recipient_socket, message['msg'])
+
+    elif kind == 'online':
+        username = message['user']
+        CLUSTER.user_shards[username] = source
+        # Two shards accepted the same login at the same moment; the lower shard
+        # id keeps it.
+        duplicate = REGISTRY.find(username)
+        if duplicate and source < CLUSTER.shard:
+            send_to_client(duplicate, 'F|User logged in elsewhere.')
+            remove_client(duplicate, resumable=False)
+
+    elif kind == 'login':
+        LOGINS.record(message['user'], message['sid'], message['until'], persist=False)
+
+    elif kind == 'offline':
+        if CLUSTER.user_shards.get(message['user']) == source:
+            del CLUSTER.user_shards[message['user']]
+
+    elif kind == 'count':
+        # Rooms owned by other shards have no local members; their owners
+        # publish the authoritative counts.
+        if not CLUSTER.owns(message['room']):
+            DIRECTORY.update(message['room'], message['count'])
+            schedule_presence_flush()
+
+    elif kind == 'handoff':
+        sock = socket.socket(fileno=fds[0])
+        for fd in fds[1:]:
+            os.close(fd)
+        loop = asyncio.get_running_loop()
+        loop.create_task(loop.connect_accepted_socket(lambda: AsyncConnection(adopted_session=message), sock))
+
+    elif kind == 'drop':
+        # The user resumed on another shard after its session here was parked
+        # (or before its dead socket was noticed).
+        conn = REGISTRY.find(message['user'])
+        if conn is not None and REGISTRY.get(conn).resume_id == message['sid']:
+            remove_client(conn, resumable=False)
+
+    elif kind == 'hello':
+        # A shard (re)started: tell it who is online here and how full the rooms
+        # we own are.
+        CLUSTER.bus.send(source, {
+            't': 'snapshot',
+            'users': list(REGISTRY.users),
+            'counts': {name: len(members) for name, members in REGISTRY.rooms.items() if name not in CLUSTER.replicated_rooms and CLUSTER.owns(name)},
+        })
+
+    elif kind == 'snapshot':
+        for username in message['users']:
+            CLUSTER.user_shards[username] = source
+        for name, count in message['counts'].items():
+            DIRECTORY.update(name, count)
+        schedule_presence_flush()
+
+
+def raise_fd_limit():
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+async def serve_async(backlog=4096):
+    global LOOP
+    raise_fd_limit()
+    loop = LOOP = asyncio.get_running_loop()
+    STORAGE.when_ready(functools.partial(loop.call_soon_threadsafe, release_held_messages))
+
+    if CLUSTER:
+        CLUSTER.start(loop)
+        CLUSTER.bus.broadcast({'t': 'hello'})
+
+    # Every shard binds the same port; the kernel spreads new connections
+    # across them.
+    if LISTEN_FD is not None:
+        server = await loop.create_server(AsyncConnection, sock=socket.socket(fileno=LISTEN_FD), backlog=backlog)
+    else:
+        server = await loop.create_server(AsyncConnection, HOST, PORT, backlog=backlog, reuse_port=bool(CLUSTER))
+    if CLUSTER:
+        print(f"Shard {CLUSTER.shard}/{CLUSTER.shard_count} listening on {HOST}:{PORT} (async)")
+    else:
+        print(f"Server listening on {HOST}:{PORT} (async)")
+    await start_video()
+    notify_predecessor()
+    start_metrics_server(loop)
+    # The loop only keeps a weak reference to a task, so this one is held here.
+    reaper = loop.create_task(reaper_task()) if IDLE_TIMEOUT or RESUME_WINDOW else None
+
+    stopped = loop.create_future()
+    loop.add_signal_handler(signal.SIGTERM, stopped.set_result, None)
+    if not CLUSTER:
+        loop.add_signal_handler(RESTART_SIGNAL, lambda: loop.create_task(restart_async(server, stopped)))
+    try:
+        async with server:
+            await stopped
+    finally:
+        if reaper is not None:
+            reaper.cancel()
+            try:
+                await reaper
+            except asyncio.CancelledError:
+                pass
+        await stop_video()
+        if CLUSTER:
+            CLUSTER.close()
+
 
 if __name__ == '__main__':
-    receive()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="MultiVidChat chat server")
+    parser.add_argument('--mode', choices=['async', 'threaded'], default='async',
+                        help="async: one event loop for all connections; threaded: one thread per connection")
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--queue-messages', type=int, default=OUTBOUND_MAX_MESSAGES,
+                        help="max messages buffered per connection before the overflow policy applies")
+    parser.add_argument('--queue-bytes', type=int, default=OUTBOUND_MAX_BYTES,
+                        help="max bytes buffered per connection before the overflow policy applies")
+    parser.add_argument('--overflow', choices=Outbound.OVERFLOW_POLICIES, default=OUTBOUND_OVERFLOW,
+                        help="what to do with a slow consumer whose outbound queue is full")
+    parser.add_argument('--storage', choices=Storage.STORAGE_BACKENDS, default=STORAGE_BACKEND,
+                        help="json rewrites chat_data.json on every change; sqlite stores users and PMs in --db")
+    parser.add_argument('--db', default=DB_FILE,
+                        help="SQLite database path (migrated from chat_data.json on first use)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="run N worker processes that each own a subset of the rooms (Linux, async mode, sqlite storage)")
+    parser.add_argument('--heartbeat', type=float, default=HEARTBEAT_INTERVAL, metavar='SECONDS',
+                        help="ping framed clients that have been silent this long")
+    parser.add_argument('--idle-timeout', type=float, default=IDLE_TIMEOUT, metavar='SECONDS',
+                        help="disconnect clients silent for this long (0 disables the reaper)")
+    parser.add_argument('--legacy-login-timeout', type=float, default=LEGACY_LOGIN_TIMEOUT, metavar='SECONDS',
+                        help="disconnect unframed clients that stay this long at the login prompt")
+    parser.add_argument('--room-history', type=int, default=ROOM_HISTORY_MESSAGES, metavar='N',
+                        help="recent messages kept per room and shown on join (0 disables)")
+    parser.add_argument('--room-history-bytes', type=int, default=ROOM_HISTORY_BYTES, metavar='BYTES',
+                        help="memory cap for all room histories; idle rooms are evicted first")
+    parser.add_argument('--resume-window', type=float, default=RESUME_WINDOW, metavar='SECONDS',
+                        help="hold a dropped session this long for the client to resume (0 disables resuming)")
+    parser.add_argument('--resume-buffer', type=int, default=RESUME_BUFFER, metavar='N',
+                        help="messages kept for a dropped session while it can be resumed")
+    parser.add_argument('--compress-threshold', type=int, default=COMPRESS_THRESHOLD, metavar='BYTES',
+                        help="compress output to binary clients that ask for it in batches of at least this size (0 disables)")
+    parser.add_argument('--max-subscriptions', type=int, default=MAX_SUBSCRIPTIONS, metavar='N',
+                        help="rooms a user may /subscribe to besides the active one")
+    parser.add_argument('--kdf-cost', type=int, default=KDF_COST, metavar='LOG2_N',
+                        help="scrypt cost for password hashes (N = 2**LOG2_N); older hashes are upgraded on login")
+    parser.add_argument('--auth-workers', type=int, default=AUTH_WORKERS, help="threads hashing passwords")
+    parser.add_argument('--auth-queue', type=int, default=AUTH_QUEUE, help="password checks allowed to wait for a worker")
+    parser.add_argument('--auth-timeout', type=float, default=AUTH_TIMEOUT, metavar='SECONDS',
+                        help="answer a password check that waited this long with 'server busy'")
+    parser.add_argument('--rate-limit', action='append', default=[], type=RateLimit.parse_limit, metavar='CLASS=RATE[/BURST]',
+                        help=f"override a token-bucket limit (events/s); classes: {', '.join(RATE_LIMITS)}")
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help="serve Prometheus metrics on 127.0.0.1:PORT/metrics (PORT+shard per worker)")
+    parser.add_argument('--admin', action='append', default=[], metavar='USER',
+                        help="user allowed to run /stats (repeatable)")
+    parser.add_argument('--profile-interval', type=float, default=None, metavar='SECONDS',
+                        help="sample the hottest stack frames every SECONDS (shown in /stats and /metrics)")
+    parser.add_argument('--drain-timeout', type=float, default=DRAIN_TIMEOUT, metavar='SECONDS',
+                        help=f"on {RESTART_SIGNAL.name}, start a new server on the same socket and give clients this long to move over")
+    parser.add_argument('--http-port', type=int, default=HTTP_PORT,
+                        help="serve VideoClient.html and /ws signaling here (PORT+shard per worker; 0 disables; async mode only)")
+    parser.add_argument('--video-url', default=None, metavar='URL',
+                        help="public base URL browsers should use for video calls (e.g. a tunnel to --http-port)")
+    parser.add_argument('--adaptive-bitrate', action='store_true',
+                        help="send video senders maxBitrate hints when their receivers report packet loss")
+    parser.add_argument('--listen-fd', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--handoff-fd', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--http-fd', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--shard', type=int, default=None, help=argparse.SUPPRESS)
+    parser.add_argument('--bus-dir', default=None, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    for name, rate, burst in args.rate_limit:
+        if name not in RATE_LIMITS:
+            parser.error(f"unknown rate limit class {name!r}")
+        RATE_LIMITS[name] = (rate, burst)
+    PORT = args.port
+    STORAGE_BACKEND = args.storage
+    DB_FILE = args.db
+    OUTBOUND_MAX_MESSAGES = args.queue_messages
+    OUTBOUND_MAX_BYTES = args.queue_bytes
+    OUTBOUND_OVERFLOW = args.overflow
+    HEARTBEAT_INTERVAL = args.heartbeat
+    IDLE_TIMEOUT = args.idle_timeout
+    LEGACY_LOGIN_TIMEOUT = args.legacy_login_timeout
+    RESUME_WINDOW = args.resume_window
+    ROOM_HISTORY_MESSAGES = args.room_history
+    ROOM_HISTORY_BYTES = args.room_history_bytes
+    ROOM_HISTORY = Backlog.RoomBacklog(ROOM_HISTORY_MESSAGES, ROOM_HISTORY_BYTES)
+    RESUME_BUFFER = args.resume_buffer
+    MAX_SUBSCRIPTIONS = args.max_subscriptions
+    COMPRESS_THRESHOLD = args.compress_threshold
+    METRICS_PORT = args.metrics_port
+    ADMINS.update(args.admin)
+    KDF_COST = args.kdf_cost
+    DRAIN_TIMEOUT = args.drain_timeout
+    LISTEN_FD = args.listen_fd
+    HANDOFF_FD = args.handoff_fd
+    HTTP_PORT = args.http_port if args.mode == 'async' else 0
+    HTTP_FD = args.http_fd
+    VIDEO_URL = args.video_url
+    ADAPTIVE_BITRATE = args.adaptive_bitrate
+
+    if args.workers > 1:
+        if args.mode != 'async' or args.storage != 'sqlite':
+            parser.error("--workers needs --mode async and --storage sqlite")
+        if args.shard is None:
+            # Create the resume key once so every worker signs with it.
+            Sessions.load_secret(RESUME_KEY_FILE)
+            Sessions.LoginLedger(LOGIN_LEDGER_FILE).compact()
+            # Migrate and upgrade the schema once here instead of racing in
+            # every worker.
+            Storage.open_storage(STORAGE_BACKEND, JSON_FILE, DB_FILE).close()
+            Cluster.run_cluster(args.workers, sys.argv[1:])
+            sys.exit(0)
+        CLUSTER = Cluster.Cluster(args.shard, args.workers, args.bus_dir, handle_bus_message, replicated_rooms=["lobby"])
+
+    if args.profile_interval:
+        Metrics.start_profiler(args.profile_interval)
+
+    RESUME_SECRET = Sessions.load_secret(RESUME_KEY_FILE)
+    LOGINS = Sessions.LoginLedger(LOGIN_LEDGER_FILE)
+    if CLUSTER is None:
+        LOGINS.compact()
+    VIDEO_SECRET = Sessions.derive_secret(RESUME_SECRET, 'video')
+    init_storage()
+    AUTH_POOL = Auth.HashPool(args.auth_workers, args.auth_queue, args.auth_timeout)
+    try:
+        if args.mode == 'threaded':
+            receive()
+        else:
+            asyncio.run(serve_async())
+    finally:
+        STORAGE.close()
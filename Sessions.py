@@ -0,0 +1,280 @@
+import base64
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import time
+
+
+class Session:
+    # Per-connection server state. Slots keep it to a few dozen bytes plus the
+    # referenced objects, instead of one dict entry per connection in each of
+    # several parallel tables.
+    __slots__ = ('conn', 'username', 'room', 'subscriptions', 'state', 'room_map', 'parser', 'wire', 'resume_id', 'limits', 'video', 'hello')
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.username = None
+        self.room = None
+        # Rooms followed besides the active one, in subscription order.
+        self.subscriptions = {}
+        self.state = None
+        self.room_map = None
+        self.parser = None
+        # Intern ids this client has been sent, on binary (Wire) connections.
+        self.wire = None
+        self.resume_id = None
+        self.limits = None
+        self.video = None
+        # The start of a hello that has not fully arrived yet.
+        self.hello = None
+
+    @property
+    def framed(self):
+        return self.parser is not None
+
+
+class Registry:
+    # The one owner of connection, user and room tables; every membership
+    # change goes through it so the indexes cannot drift apart. Rooms map to
+    # dicts used as insertion-ordered sets (members listed in join order), and
+    # users map username -> connection, so joins, leaves, PM routing and the
+    # duplicate-login check are all O(1). A session is a member of its active
+    # room and of every room it subscribed to; multi_room holds the
+    # connections with subscriptions, whose room messages are tagged.
+    def __init__(self, permanent_rooms=()):
+        self.permanent_rooms = tuple(permanent_rooms)
+        self.sessions = {}
+        self.users = {}
+        self.rooms = {name: {} for name in self.permanent_rooms}
+        self.multi_room = set()
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def __iter__(self):
+        return iter(list(self.sessions))
+
+    # ---------------- CONNECTIONS ----------------
+    def open(self, conn):
+        session = self.sessions[conn] = Session(conn)
+        return session
+
+    def get(self, conn):
+        return self.sessions.get(conn)
+
+    def close(self, conn):
+        # Detaches the connection from every table. Returns (session, closed)
+        # where the session keeps its last username, room and subscriptions for
+        # the caller's departure notices, and closed lists the rooms that were
+        # removed.
+        session = self.sessions.pop(conn, None)
+        if session is None:
+            return None, []
+        closed = [room_name for room_name in (session.room, *session.subscriptions)
+                  if self._remove_member(conn, room_name)]
+        self.multi_room.discard(conn)
+        if session.username is not None and self.users.get(session.username) is conn:
+            del self.users[session.username]
+        return session, closed
+
+    def replace(self, old_conn, new_conn):
+        # Moves a session, with its room seats and username, onto a new
+        # connection (a client resuming after a reconnect).
+        session = self.sessions.pop(old_conn)
+        session.conn = new_conn
+        self.sessions[new_conn] = session
+        for room_name in (session.room, *session.subscriptions):
+            members = self.rooms.get(room_name)
+            if members is not None:
+                members.pop(old_conn, None)
+                members[new_conn] = None
+        if old_conn in self.multi_room:
+            self.multi_room.discard(old_conn)
+            self.multi_room.add(new_conn)
+        if session.username is not None and self.users.get(session.username) is old_conn:
+            self.users[session.username] = new_conn
+        return session
+
+    # ---------------- USERS ----------------
+    def login(self, conn, username):
+        if username in self.users:
+            return False
+        self.users[username] = conn
+        self.sessions[conn].username = username
+        return True
+
+    def find(self, username):
+        return self.users.get(username)
+
+    def is_online(self, username):
+        return username in self.users
+
+    def username(self, conn, default=None):
+        session = self.sessions.get(conn)
+        if session is None or session.username is None:
+            return default
+        return session.username
+
+    def is_logged_in(self, conn):
+        session = self.sessions.get(conn)
+        return session is not None and session.username is not None
+
+    # ---------------- ROOMS ----------------
+    def join(self, conn, room_name):
+        # Returns True if the room had to be created.
+        created = room_name not in self.rooms
+        members = self.rooms.setdefault(room_name, {})
+        members[conn] = None
+        self.sessions[conn].room = room_name
+        return created
+
+    def leave(self, conn):
+        # Returns (room_name, closed) like close().
+        session = self.sessions[conn]
+        room_name, session.room = session.room, None
+        return room_name, self._remove_member(conn, room_name)
+
+    def subscribe(self, conn, room_name):
+        # Returns True if the room had to be created.
+        created = room_name not in self.rooms
+        self.rooms.setdefault(room_name, {})[conn] = None
+        self.sessions[conn].subscriptions[room_name] = None
+        self.multi_room.add(conn)
+        return created
+
+    def unsubscribe(self, conn, room_name):
+        # Returns True if the room was removed.
+        session = self.sessions[conn]
+        del session.subscriptions[room_name]
+        if not session.subscriptions:
+            self.multi_room.discard(conn)
+        return self._remove_member(conn, room_name)
+
+    def activate(self, conn, room_name):
+        # Makes a subscribed room the active one; the previous active room
+        # becomes a subscription. Membership does not change.
+        session = self.sessions[conn]
+        del session.subscriptions[room_name]
+        if session.room is not None:
+            session.subscriptions[session.room] = None
+        session.room = room_name
+        if not session.subscriptions:
+            self.multi_room.discard(conn)
+
+    def _remove_member(self, conn, room_name):
+        members = self.rooms.get(room_name)
+        if members is None:
+            return False
+        members.pop(conn, None)
+        if not members and room_name not in self.permanent_rooms:
+            del self.rooms[room_name]
+            return True
+        return False
+
+    def members(self, room_name):
+        return self.rooms.get(room_name, {}).keys()
+
+
+# ---------------- RESUME TOKENS ----------------
+def load_secret(path):
+    # The signing key lives next to the data files so tokens survive restarts
+    # and are accepted by every worker of a clustered server.
+    if os.path.exists(path):
+        with open(path, 'r', encoding='ascii') as f:
+            return bytes.fromhex(f.read().strip())
+    key = secrets.token_bytes(32)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600)
+    with os.fdopen(fd, 'w', encoding='ascii') as f:
+        f.write(key.hex())
+    return key
+
+
+def derive_secret(secret, purpose):
+    # A separate key per token kind, so a video link cannot be replayed as a
+    # resume token.
+    return hmac.new(secret, purpose.encode('utf-8'), hashlib.sha256).digest()
+
+
+def new_resume_id():
+    return secrets.token_hex(8)
+
+
+def _b64(data):
+    return base64.urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _unb64(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def issue_token(secret, username, room, resume_id, ttl, subscriptions=()):
+    claims = {'u': username, 'r': room, 'sid': resume_id, 'exp': int(time.time() + ttl)}
+    if subscriptions:
+        claims['s'] = list(subscriptions)
+    payload = _b64(json.dumps(claims, separators=(',', ':')).encode('utf-8'))
+    signature = _b64(hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest())
+    return f"{payload}.{signature}"
+
+
+class LoginLedger:
+    # Which resume session of a user may still be restored from a token once
+    # nothing holds it: the one started by the user's latest login, or none
+    # after /quit. Other sessions' tokens were issued before that entry, so
+    # an entry only has to outlive them by the token TTL. Entries are
+    # appended to path, one JSON line each, so they survive a restart.
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        username, sid, until = json.loads(line)
+                    except ValueError:
+                        continue
+                    self.entries[username] = (sid, until)
+            self.purge()
+
+    def record(self, username, sid, until, persist=True):
+        self.entries[username] = (sid, until)
+        if self.path and persist:
+            # Opened per write so a successor that compacted the file gets
+            # this process's lines too.
+            with open(self.path, 'a', encoding='utf-8') as f:
+                f.write(json.dumps([username, sid, until]) + '\n')
+
+    def allows(self, username, sid):
+        entry = self.entries.get(username)
+        return entry is None or entry[1] < time.time() or entry[0] == sid
+
+    def purge(self):
+        now = time.time()
+        for username in [username for username, (_, until) in self.entries.items() if until < now]:
+            del self.entries[username]
+
+    def compact(self):
+        # Rewrites the file with the live entries only.
+        if not self.path:
+            return
+        self.purge()
+        with open(self.path + '.tmp', 'w', encoding='utf-8') as f:
+            for username, (sid, until) in self.entries.items():
+                f.write(json.dumps([username, sid, until]) + '\n')
+        os.replace(self.path + '.tmp', self.path)
+
+
+def verify_token(secret, token):
+    # Returns the token's claims, or None if it is malformed, forged or expired.
+    try:
+        payload, signature = token.split('.')
+        expected = hmac.new(secret, payload.encode('ascii'), hashlib.sha256).digest()
+        if not hmac.compare_digest(expected, _unb64(signature)):
+            return None
+        claims = json.loads(_unb64(payload))
+    except (ValueError, UnicodeError):
+        return None
+    if not isinstance(claims, dict) or claims.get('exp', 0) < time.time():
+        return None
+    return claims
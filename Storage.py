@@ -0,0 +1,529 @@
+import sqlite3
+import bisect
+import threading
+import argparse
+import json
+import time
+import os
+
+import Metrics
+import Search
+
+
+SAVE_SECONDS = Metrics.Histogram('multividchat_storage_save_seconds', "Time spent writing to storage", label='backend')
+
+
+def pair_key(user1, user2):
+    return (user1, user2) if user1 <= user2 else (user2, user1)
+
+
+class ConversationIndex:
+    # PMs grouped by unordered user pair, each conversation kept in
+    # (timestamp, id) order as parallel lists so a page is a bisect plus a
+    # slice. The id breaks ties, so PMs with equal timestamps never straddle
+    # a page boundary.
+    def __init__(self):
+        self._conversations = {}
+
+    def add(self, pm_id, sender, recipient, message, timestamp):
+        keys, entries = self._conversations.setdefault(pair_key(sender, recipient), ([], []))
+        key = (timestamp, pm_id)
+        if not keys or key > keys[-1]:
+            keys.append(key)
+            entries.append((pm_id, sender, message, timestamp))
+        else:
+            at = bisect.bisect_right(keys, key)
+            keys.insert(at, key)
+            entries.insert(at, (pm_id, sender, message, timestamp))
+
+    def page(self, user1, user2, before=None, limit=None):
+        # before is a (timestamp, id) key; the page ends just ahead of it.
+        conversation = self._conversations.get(pair_key(user1, user2))
+        if not conversation:
+            return []
+        keys, entries = conversation
+        end = len(keys) if before is None else bisect.bisect_left(keys, before)
+        start = 0 if limit is None else max(0, end - limit)
+        return entries[start:end]
+
+
+class Inbox:
+    # Unread PMs per recipient, oldest first, with a count per sender. Saving a
+    # PM is O(1) and delivering them touches only the recipient's own unread
+    # messages.
+    def __init__(self):
+        self._unread = {}
+
+    def add(self, recipient, sender, entry):
+        counts, entries = self._unread.setdefault(recipient, ({}, []))
+        counts[sender] = counts.get(sender, 0) + 1
+        entries.append((sender, entry))
+
+    def counts(self, recipient):
+        inbox = self._unread.get(recipient)
+        return dict(inbox[0]) if inbox else {}
+
+    def take(self, recipient, limit=None):
+        inbox = self._unread.get(recipient)
+        if inbox is None:
+            return []
+        counts, entries = inbox
+        taken = entries[:limit]
+        del entries[:limit]
+        for sender, _ in taken:
+            counts[sender] -= 1
+            if not counts[sender]:
+                del counts[sender]
+        if not entries:
+            del self._unread[recipient]
+        return [entry for _, entry in taken]
+
+
+# ---------------- JSON ----------------
+class JsonStorage:
+    # The original format: everything lives in memory and the whole file is
+    # rewritten on every change. Fine for a handful of users, O(history) per PM.
+    # Marking PMs read is the exception: their ids are appended to a journal
+    # next to the file, applied on load and emptied by the next full save.
+    def __init__(self, path):
+        self.path = path
+        self.read_path = path + '.read'
+        self.data = self._load()
+        self._apply_read_journal()
+        self.conversations = ConversationIndex()
+        self.inbox = Inbox()
+        # PM ids are positions in data['pms'].
+        self.search = Search.SearchIndex()
+        for pm_id, pm in enumerate(self.data['pms']):
+            self.conversations.add(pm_id, pm['sender'], pm['recipient'], pm['message'], pm['timestamp'])
+            self.search.add(pm_id, pm['sender'], pm['recipient'], pm['message'])
+            if pm.get('unread'):
+                self.inbox.add(pm['recipient'], pm['sender'], (pm_id, pm))
+
+    def _load(self):
+        if os.path.exists(self.path) and os.path.getsize(self.path) > 0:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                try:
+                    data = json.load(f)
+                    data.setdefault('users', {})
+                    data.setdefault('pms', [])
+                    return data
+                except json.JSONDecodeError:
+                    return {"users": {}, "pms": []}
+        else:
+            return {"users": {}, "pms": []}
+
+    def _apply_read_journal(self):
+        if not os.path.exists(self.read_path):
+            return
+        pms = self.data['pms']
+        with open(self.read_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                # A torn last line from a crash is ignored.
+                if line.strip().isdigit() and int(line) < len(pms):
+                    pms[int(line)].pop('unread', None)
+
+    def _save(self):
+        # Written to a temporary file and renamed over the original, so a
+        # process loading the file (a restarting server) never sees it half
+        # written.
+        with SAVE_SECONDS.time('json'):
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.data, f, indent=4, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+            # The file now holds every read mark.
+            if os.path.exists(self.read_path):
+                os.remove(self.read_path)
+
+    def add_user(self, username, password_hash):
+        if username in self.data['users']:
+            return False
+        self.data['users'][username] = {'password': password_hash}
+        self._save()
+        return True
+
+    def get_password_hash(self, username):
+        user_data = self.data['users'].get(username)
+        return user_data['password'] if user_data else None
+
+    def set_password_hash(self, username, password_hash):
+        self.data['users'][username]['password'] = password_hash
+        self._save()
+
+    def save_pm(self, sender, recipient, message, timestamp, unread=False):
+        # unread marks a PM the recipient was offline for; it stays in their
+        # inbox until take_unread() hands it out.
+        pm = {
+            'sender': sender,
+            'recipient': recipient,
+            'message': message,
+            'timestamp': timestamp
+        }
+        if unread:
+            pm['unread'] = True
+            self.inbox.add(recipient, sender, (len(self.data['pms']), pm))
+        pm_id = len(self.data['pms'])
+        self.search.add(pm_id, sender, recipient, message)
+        self.data['pms'].append(pm)
+        self.conversations.add(pm_id, sender, recipient, message, timestamp)
+        self._save()
+
+    def get_pm_history(self, user1, user2, before=None, limit=None):
+        # Oldest first, as (id, sender, message, timestamp); the PMs that come
+        # before the one with id before, if given.
+        if before is not None:
+            if not 0 <= before < len(self.data['pms']):
+                return []
+            before = (self.data['pms'][before]['timestamp'], before)
+        return self.conversations.page(user1, user2, before, limit)
+
+    def search_pms(self, username, text, with_user=None, before=None, limit=None):
+        # Newest first, as (id, sender, recipient, message, timestamp); the id
+        # is the cursor for the next page.
+        pms = self.data['pms']
+        return [(pm_id, pms[pm_id]['sender'], pms[pm_id]['recipient'], pms[pm_id]['message'], pms[pm_id]['timestamp'])
+                for pm_id in self.search.search(username, text, with_user, before, limit)]
+
+    def unread_counts(self, username):
+        return self.inbox.counts(username)
+
+    def take_unread(self, username, limit=None):
+        # The oldest unread PMs as (sender, message, timestamp), marked read.
+        # Only their ids are written, to the read journal.
+        taken = self.inbox.take(username, limit)
+        for _, pm in taken:
+            del pm['unread']
+        if taken:
+            with SAVE_SECONDS.time('json'):
+                with open(self.read_path, 'a', encoding='utf-8') as f:
+                    f.write(''.join(f"{pm_id}\n" for pm_id, _ in taken))
+        return [(pm['sender'], pm['message'], pm['timestamp']) for _, pm in taken]
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+
+# ---------------- SQLITE ----------------
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY,
+    password TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS pms (
+    id INTEGER PRIMARY KEY,
+    user_a TEXT NOT NULL,
+    user_b TEXT NOT NULL,
+    sender TEXT NOT NULL,
+    recipient TEXT NOT NULL,
+    message TEXT NOT NULL,
+    timestamp REAL NOT NULL,
+    unread INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS pms_by_pair ON pms (user_a, user_b, timestamp);
+"""
+# Full-text index over PM text. It is contentless (the text stays in pms) and
+# filled by a trigger, so every process sharing the database sees new PMs;
+# owners holds one token per participant so a search only matches that user's
+# PMs.
+SEARCH_SCHEMA = """
+CREATE VIRTUAL TABLE pms_search USING fts5(message, owners, content='');
+CREATE TRIGGER pms_search_insert AFTER INSERT ON pms BEGIN
+    INSERT INTO pms_search (rowid, message, owners) VALUES (new.id, new.message, 'u' || hex(new.sender) || ' u' || hex(new.recipient));
+END;
+INSERT INTO pms_search (rowid, message, owners) SELECT id, message, 'u' || hex(sender) || ' u' || hex(recipient) FROM pms;
+"""
+
+
+def owner_token(username):
+    return 'u' + username.encode('utf-8').hex().upper()
+
+
+# Only unread rows are indexed, so an inbox lookup is O(unread) however long
+# the PM history grows.
+UNREAD_INDEX = "CREATE INDEX IF NOT EXISTS pms_unread ON pms (recipient, id) WHERE unread = 1"
+
+
+class SqliteStorage:
+    # save_pm only appends to an in-memory batch; a background thread inserts
+    # each batch with one executemany() and commits it (group commit) every
+    # commit_interval seconds, or sooner once commit_batch PMs are waiting. The
+    # write transaction is therefore only held for the duration of one batch,
+    # which keeps the database usable by several server processes at once.
+    # Up to commit_interval of PMs can be lost if the process dies; user
+    # registrations are committed immediately.
+    def __init__(self, path, commit_interval=0.05, commit_batch=256):
+        self.path = path
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._lock = threading.Lock()
+        self._pending_lock = threading.Lock()
+        self._pending = []
+        self._closed = False
+        self._wakeup = threading.Event()
+
+        self.db = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(pms)")]
+        if 'unread' not in columns:
+            self.db.execute("ALTER TABLE pms ADD COLUMN unread INTEGER NOT NULL DEFAULT 0")
+        self.db.execute(UNREAD_INDEX)
+        self.db.commit()
+        self.searchable = self._create_search_index()
+
+        self._committer = threading.Thread(target=self._commit_loop, daemon=True)
+        self._committer.start()
+
+    def add_user(self, username, password_hash):
+        with self._lock:
+            try:
+                self.db.execute("INSERT INTO users (username, password) VALUES (?, ?)", (username, password_hash))
+            except sqlite3.IntegrityError:
+                self.db.rollback()
+                return False
+            self.db.commit()
+        return True
+
+    def get_password_hash(self, username):
+        with self._lock:
+            row = self.db.execute("SELECT password FROM users WHERE username = ?", (username,)).fetchone()
+        return row[0] if row else None
+
+    def set_password_hash(self, username, password_hash):
+        with self._lock:
+            self.db.execute("UPDATE users SET password = ? WHERE username = ?", (password_hash, username))
+            self.db.commit()
+
+    def save_pm(self, sender, recipient, message, timestamp, unread=False):
+        user_a, user_b = pair_key(sender, recipient)
+        with self._pending_lock:
+            self._pending.append((user_a, user_b, sender, recipient, message, timestamp, int(unread)))
+            pending = len(self._pending)
+        if pending >= self.commit_batch:
+            self._wakeup.set()
+
+    def get_pm_history(self, user1, user2, before=None, limit=None):
+        # Oldest first, as (id, sender, message, timestamp); the PMs that come
+        # before the one with id before, if given. PMs waiting for a group
+        # commit have no id yet, so they are written first.
+        user_a, user_b = pair_key(user1, user2)
+        query = "SELECT id, sender, message, timestamp FROM pms WHERE user_a = ? AND user_b = ?"
+        params = [user_a, user_b]
+        if before is not None:
+            query += " AND (timestamp, id) < (SELECT timestamp, id FROM pms WHERE id = ?)"
+            params.append(before)
+        # Walk the (pair, timestamp) index backwards from the cursor and stop
+        # after one page, then hand the page back in chronological order.
+        query += " ORDER BY timestamp DESC, id DESC LIMIT ?"
+        params.append(-1 if limit is None else limit)
+        self.flush()
+        with self._lock:
+            rows = self.db.execute(query, params).fetchall()
+        rows.reverse()
+        return rows
+
+    def _create_search_index(self):
+        # Built in one pass over existing PMs the first time; afterwards the
+        # trigger keeps it current.
+        if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'pms_search'").fetchone():
+            return True
+        try:
+            self.db.executescript("BEGIN;" + SEARCH_SCHEMA + "COMMIT;")
+        except sqlite3.OperationalError as e:
+            self.db.rollback()
+            if self.db.execute("SELECT 1 FROM sqlite_master WHERE name = 'pms_search'").fetchone():
+                return True  # another process created it first
+            print(f"PM search is disabled: {e}")
+            return False
+        return True
+
+    def search_pms(self, username, text, with_user=None, before=None, limit=None):
+        # Newest first, as (id, sender, recipient, message, timestamp); the id
+        # is the cursor for the next page.
+        tokens = Search.tokenize(text)
+        if not tokens or not self.searchable:
+            return []
+        owners = [username] if with_user in (None, username) else [username, with_user]
+        match = " AND ".join([f'owners:"{owner_token(owner)}"' for owner in owners] +
+                             [f'message:"{token}"' for token in sorted(tokens)])
+        query = ("SELECT p.id, p.sender, p.recipient, p.message, p.timestamp FROM pms_search"
+                 " JOIN pms p ON p.id = pms_search.rowid WHERE pms_search MATCH ?")
+        params = [match]
+        if before is not None:
+            query += " AND pms_search.rowid < ?"
+            params.append(before)
+        query += " ORDER BY pms_search.rowid DESC LIMIT ?"
+        params.append(-1 if limit is None else limit)
+        self.flush()
+        with self._lock:
+            return self.db.execute(query, params).fetchall()
+
+    def unread_counts(self, username):
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT sender, COUNT(*) FROM pms WHERE recipient = ? AND unread = 1 GROUP BY sender", (username,)
+            ).fetchall()
+            with self._pending_lock:
+                pending = [row[2] for row in self._pending if row[3] == username and row[6]]
+        counts = dict(rows)
+        for sender in pending:
+            counts[sender] = counts.get(sender, 0) + 1
+        return counts
+
+    def take_unread(self, username, limit=None):
+        # The oldest unread PMs as (sender, message, timestamp), marked read in
+        # the same transaction. PMs still waiting for a group commit are
+        # written first so none is skipped.
+        self.flush()
+        with self._lock:
+            rows = self.db.execute(
+                "SELECT id, sender, message, timestamp FROM pms WHERE recipient = ? AND unread = 1 ORDER BY id LIMIT ?",
+                (username, -1 if limit is None else limit)
+            ).fetchall()
+            if rows:
+                self.db.execute("UPDATE pms SET unread = 0 WHERE recipient = ? AND unread = 1 AND id <= ?",
+                                (username, rows[-1][0]))
+                self.db.commit()
+        return [row[1:] for row in rows]
+
+    def _commit_loop(self):
+        while not self._closed:
+            self._wakeup.wait(self.commit_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            with self._pending_lock:
+                if self._closed or not self._pending:
+                    return
+                batch, self._pending = self._pending, []
+            with SAVE_SECONDS.time('sqlite'):
+                self.db.executemany(
+                    "INSERT INTO pms (user_a, user_b, sender, recipient, message, timestamp, unread) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    batch
+                )
+                self.db.commit()
+
+    def close(self):
+        self.flush()
+        with self._lock:
+            self._closed = True
+            self.db.close()
+        self._wakeup.set()
+
+
+# ---------------- MIGRATION ----------------
+def migrate_json_to_sqlite(json_path, db_path):
+    source = JsonStorage(json_path)
+    target = SqliteStorage(db_path)
+    try:
+        with target._lock:
+            target.db.executemany(
+                "INSERT OR IGNORE INTO users (username, password) VALUES (?, ?)",
+                ((username, user['password']) for username, user in source.data['users'].items())
+            )
+            target.db.executemany(
+                "INSERT INTO pms (user_a, user_b, sender, recipient, message, timestamp, unread) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (pair_key(pm['sender'], pm['recipient']) +
+                 (pm['sender'], pm['recipient'], pm['message'], pm['timestamp'], int(pm.get('unread', False)))
+                 for pm in source.data['pms'])
+            )
+            target.db.commit()
+    finally:
+        target.close()
+    return len(source.data['users']), len(source.data['pms'])
+
+
+# ---------------- BACKGROUND LOAD ----------------
+class BackgroundStorage:
+    # Opens a backend on its own thread so the server can start accepting
+    # connections before a large chat_data.json is parsed. Calls made before
+    # the backend is ready block until it is, so an event loop should check
+    # ready() and use when_ready() instead. wait_for, if given, runs first (a
+    # restarting server waits for its predecessor to release the files).
+    def __init__(self, opener, wait_for=None):
+        self._opener = opener
+        self._wait_for = wait_for
+        self._storage = None
+        self._error = None
+        self._ready = threading.Event()
+        self._callbacks = []
+        self._callbacks_lock = threading.Lock()
+        threading.Thread(target=self._open, daemon=True).start()
+
+    def _open(self):
+        try:
+            if self._wait_for is not None:
+                self._wait_for()
+            started = time.time()
+            self._storage = self._opener()
+            print(f"Storage ready in {time.time() - started:.2f}s")
+        except Exception as e:
+            self._error = e
+            print(f"Failed to open storage: {e}")
+        finally:
+            with self._callbacks_lock:
+                self._ready.set()
+                callbacks, self._callbacks = self._callbacks, []
+            for callback in callbacks:
+                callback()
+
+    def ready(self):
+        return self._ready.is_set()
+
+    def wait(self):
+        self._ready.wait()
+
+    def when_ready(self, callback):
+        # callback runs once the backend is open (or failed to open): on the
+        # opening thread, or straight away if that already happened.
+        with self._callbacks_lock:
+            if not self._ready.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def __getattr__(self, name):
+        self._ready.wait()
+        if self._error is not None:
+            raise self._error
+        return getattr(self._storage, name)
+
+    def close(self):
+        self._ready.wait()
+        if self._storage is not None:
+            self._storage.close()
+
+
+STORAGE_BACKENDS = ('json', 'sqlite')
+
+
+def open_storage(kind, json_path, db_path):
+    if kind == 'json':
+        return JsonStorage(json_path)
+    if kind == 'sqlite':
+        if not os.path.exists(db_path) and os.path.exists(json_path):
+            started = time.time()
+            users, pms = migrate_json_to_sqlite(json_path, db_path)
+            print(f"Migrated {users} users and {pms} PMs from {json_path} to {db_path} in {time.time() - started:.2f}s")
+        return SqliteStorage(db_path)
+    raise ValueError(f"Unknown storage backend: {kind}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Migrate MultiVidChat data from JSON to SQLite")
+    parser.add_argument('json_path', nargs='?', default='chat_data.json')
+    parser.add_argument('db_path', nargs='?', default='chat_data.db')
+    args = parser.parse_args()
+
+    if os.path.exists(args.db_path):
+        parser.error(f"{args.db_path} already exists; refusing to migrate into it twice")
+
+    users, pms = migrate_json_to_sqlite(args.json_path, args.db_path)
+    print(f"Migrated {users} users and {pms} PMs to {args.db_path}")
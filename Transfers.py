@@ -0,0 +1,123 @@
+import base64
+import hashlib
+import math
+import os
+
+import Metrics
+
+# File transfers (/send) travel as ordinary messages: the sender's FILE|DATA
+# frames carry CHUNK_SIZE bytes of the file in base64, and the server relays
+# each one to the recipients that accepted the offer as an X|DATA message,
+# queued behind and ahead of their chat like anything else. Nothing is kept on
+# the server beyond the chunk in hand. The sender may run at most WINDOW chunks
+# ahead of the slowest recipient's acknowledgements, so a transfer adds about
+# WINDOW * ENCODED_CHUNK_SIZE bytes to any outbound queue, and to the wait of
+# the chat queued behind it, however large the file is.
+CHUNK_SIZE = 16 * 1024
+ENCODED_CHUNK_SIZE = 4 * math.ceil(CHUNK_SIZE / 3)
+WINDOW = 8
+# Offers not answered by every recipient by then start with those who
+# accepted, or are withdrawn if nobody did.
+OFFER_TIMEOUT = 60.0
+DOWNLOAD_DIR = 'downloads'
+
+FILE_BYTES = Metrics.Counter('multividchat_file_bytes_total', "File transfer bytes relayed from senders")
+
+
+def decoded_size(data):
+    # Size of the bytes a base64 string encodes, without decoding it.
+    return len(data) // 4 * 3 - data[-2:].count('=')
+
+
+def safe_name(name):
+    # The last component of a path, never empty, '.' or '..'.
+    name = os.path.basename(name.replace('\\', '/')).strip()
+    if name in ('', '.', '..'):
+        return 'file'
+    return name
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_chunks(path, chunk_size=CHUNK_SIZE):
+    # Yields the file as base64 strings of chunk_size bytes each.
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            yield base64.b64encode(chunk).decode('ascii')
+
+
+class Transfer:
+    # Server-side state of one offer: who still has to answer, and for each
+    # recipient that accepted, how many chunks it has acknowledged. credit is
+    # the lowest of those counts as last told to the sender.
+    __slots__ = ('id', 'sender', 'username', 'room', 'size', 'digest', 'name', 'offered', 'receivers',
+                 'started', 'ended', 'next_seq', 'received', 'credit', 'expires')
+
+    def __init__(self, transfer_id, sender, username, room, size, digest, name, recipients, expires):
+        self.id = transfer_id
+        self.sender = sender
+        self.username = username
+        self.room = room
+        self.size = size
+        self.digest = digest
+        self.name = name
+        self.offered = dict.fromkeys(recipients)
+        self.receivers = {}
+        self.started = False
+        self.ended = False
+        self.next_seq = 0
+        self.received = 0
+        self.credit = 0
+        self.expires = expires
+
+    def acknowledged(self):
+        return min(self.receivers.values(), default=self.next_seq)
+
+
+class Spool:
+    # Client side: writes an accepted file to name.part in directory, hashing
+    # it on the way, and renames it into place once size and checksum match.
+    def __init__(self, directory, name, size, digest):
+        os.makedirs(directory, exist_ok=True)
+        base, ext = os.path.splitext(safe_name(name))
+        self.path = os.path.join(directory, base + ext)
+        copy = 1
+        while os.path.exists(self.path) or os.path.exists(self.path + '.part'):
+            self.path = os.path.join(directory, f"{base} ({copy}){ext}")
+            copy += 1
+        self.size = size
+        self.digest = digest
+        self.written = 0
+        self.next_seq = 0
+        self._hash = hashlib.sha256()
+        self._file = open(self.path + '.part', 'wb')
+
+    def write(self, seq, data):
+        if seq != self.next_seq:
+            raise ValueError(f"chunk {seq} arrived, expected {self.next_seq}")
+        chunk = base64.b64decode(data)
+        if self.written + len(chunk) > self.size:
+            raise ValueError("more data than offered")
+        self._hash.update(chunk)
+        self._file.write(chunk)
+        self.written += len(chunk)
+        self.next_seq += 1
+
+    def finish(self):
+        self._file.close()
+        if self.written != self.size or self._hash.hexdigest() != self.digest:
+            os.remove(self.path + '.part')
+            raise ValueError("checksum mismatch")
+        os.replace(self.path + '.part', self.path)
+        return self.path
+
+    def discard(self):
+        self._file.close()
+        if os.path.exists(self.path + '.part'):
+            os.remove(self.path + '.part')
@@ -0,0 +1,250 @@
+import json
+import zlib
+
+import Framing
+import Metrics
+
+# Binary server -> client format. A client opens with HELLO (optionally asking
+# for " zlib") instead of Framing.HELLO; the server answers with HELLO_ACK plus
+# the options it accepted and a newline. Client -> server traffic stays in
+# Framing's length-prefixed text frames. Server -> client messages become a
+# varint body length followed by the body, whose first byte is a type code:
+#   'A'..'Z'   the message "X|text" as the letter and the UTF-8 text
+#   TEXT       any other message, as UTF-8
+#   DEFINE     varint id, name: adds a username or room name to the table
+#   CHAT       varint room id (0: untagged), varint user id, text -> "R|[#room|]user: text"
+#   NOTICE     varint room id, text -> "R|#room|text"
+#   COUNTS     (varint room id, varint count)* -> "D|room=count,..."
+#   SIGNAL     varint user id, JSON payload -> 'V|{"from": user, "payload": ...}'
+#   COMPRESSED / COMPRESSED_RESET
+#              raw deflate data, sync-flushed, that inflates to whole frames.
+#              The stream's zlib context is shared by every compressed frame
+#              of the connection; RESET starts a fresh one.
+# Names are interned per server process; a connection is sent a DEFINE before
+# the first frame that uses each id, so a chat line costs its text plus a few
+# bytes however long the username and room name are.
+HELLO = b"\x00MVC/B1"
+HELLO_ACK = b"\x00MVC/B1+"
+ZLIB = b"zlib"
+# A hello line longer than this is not one.
+MAX_HELLO = 256
+
+TEXT = 0x00
+DEFINE = 0x01
+CHAT = 0x02
+NOTICE = 0x03
+COUNTS = 0x04
+SIGNAL = 0x05
+COMPRESSED = 0x06
+COMPRESSED_RESET = 0x07
+
+# Batches smaller than this go out uncompressed; a chat line or two gains
+# little and the sync flush costs a few bytes of its own.
+COMPRESS_THRESHOLD = 256
+COMPRESS_LEVEL = 6
+MAX_NAMES = 1 << 16
+
+COMPRESSION_BYTES = Metrics.Counter('multividchat_compression_bytes_total', "Bytes passed through per-connection compression, by stage", label='stage')
+
+
+def hello(compress=True):
+    return HELLO + (b" " + ZLIB if compress else b"") + b"\n"
+
+
+def parse_hello(data):
+    # Returns (options, rest) for data starting with HELLO, or None if the
+    # line is not complete yet.
+    end = data.find(b"\n")
+    if end < 0:
+        return None
+    return set(data[len(HELLO):end].split()), data[end + 1:]
+
+
+def hello_ack(options):
+    return HELLO_ACK + b"".join(b" " + option for option in sorted(options)) + b"\n"
+
+
+def varint(value):
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def read_varint(data, at):
+    # Returns (value, next offset), or (None, at) if data ends mid-varint.
+    value = shift = 0
+    while at < len(data):
+        byte = data[at]
+        at += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, at
+        shift += 7
+    return None, at
+
+
+def frame(body):
+    if len(body) > Framing.MAX_FRAME_SIZE:
+        raise Framing.FrameError(f"Frame of {len(body)} bytes exceeds {Framing.MAX_FRAME_SIZE}")
+    return varint(len(body)) + body
+
+
+def encode_text(data):
+    # data is an encoded "X|text" message.
+    if len(data) >= 2 and data[1] == 0x7c and 0x41 <= data[0] <= 0x5a:
+        return frame(data[:1] + data[2:])
+    return frame(bytes([TEXT]) + data)
+
+
+def chat_body(room_id, user_id, text):
+    return bytes([CHAT]) + varint(room_id) + varint(user_id) + text.encode('utf-8')
+
+
+def notice_body(room_id, text):
+    return bytes([NOTICE]) + varint(room_id) + text.encode('utf-8')
+
+
+def counts_body(counts):
+    # counts: (room id, count) pairs.
+    return bytes([COUNTS]) + b"".join(varint(room_id) + varint(count) for room_id, count in counts)
+
+
+def signal_body(user_id, payload):
+    return bytes([SIGNAL]) + varint(user_id) + payload.encode('utf-8')
+
+
+class Names:
+    # Intern table shared by all connections of a process, so one encoded
+    # frame serves every recipient. Ids are never reused; once MAX_NAMES are
+    # taken, id() returns 0 and callers fall back to the text encoding.
+    def __init__(self, limit=MAX_NAMES):
+        self.limit = limit
+        self._ids = {}
+        self._definitions = [None]
+
+    def __len__(self):
+        return len(self._ids)
+
+    def id(self, name):
+        name_id = self._ids.get(name)
+        if name_id is None:
+            if len(self._definitions) > self.limit:
+                return 0
+            name_id = self._ids[name] = len(self._definitions)
+            self._definitions.append(frame(bytes([DEFINE]) + varint(name_id) + name.encode('utf-8')))
+        return name_id
+
+    def define(self, ids):
+        return b"".join(self._definitions[name_id] for name_id in ids)
+
+
+class Compressor:
+    # Per-connection deflate stream, applied when a batch of queued frames is
+    # written rather than when each frame is queued: the queue may still drop
+    # or replay frames (overflow, resume), which must not break the stream.
+    # The first skip items written after compression is switched on (the
+    # handshake itself) go out as they are.
+    def __init__(self, threshold=COMPRESS_THRESHOLD, level=COMPRESS_LEVEL):
+        self.threshold = threshold
+        self.level = level
+        self.skip = 0
+        self._zlib = None
+
+    def pack(self, batch):
+        raw = []
+        if self.skip:
+            raw, batch = batch[:self.skip], batch[self.skip:]
+            self.skip -= len(raw)
+        size = sum(len(data) for data in batch)
+        if size < self.threshold:
+            return raw + batch
+
+        code = COMPRESSED
+        if self._zlib is None:
+            self._zlib = zlib.compressobj(self.level, zlib.DEFLATED, -zlib.MAX_WBITS)
+            code = COMPRESSED_RESET
+        data = self._zlib.compress(b"".join(batch)) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        COMPRESSION_BYTES.inc('in', size)
+        COMPRESSION_BYTES.inc('out', len(data))
+        return raw + [varint(len(data) + 1) + bytes([code]) + data]
+
+
+class Decoder:
+    # Client side: turns the binary stream back into the "X|text" messages of
+    # the text protocol. Use one per connection; a resumed session is sent
+    # the names it knew again before anything that refers to them.
+    def __init__(self, max_frame_size=4 * Framing.MAX_FRAME_SIZE):
+        self.names = {}
+        self.max_frame_size = max_frame_size
+        self._buffer = bytearray()
+        self._zlib = None
+
+    def feed(self, data):
+        self._buffer += data
+
+    def recv_into(self, sock, size=Framing.RECV_SIZE):
+        data = sock.recv(size)
+        self.feed(data)
+        return len(data)
+
+    def read_messages(self):
+        messages = []
+        del self._buffer[:self._read_frames(self._buffer, messages)]
+        return messages
+
+    def _read_frames(self, data, messages):
+        at = 0
+        while at < len(data):
+            length, body_at = read_varint(data, at)
+            if length is None:
+                break
+            if length > self.max_frame_size:
+                raise Framing.FrameError(f"Frame of {length} bytes exceeds {self.max_frame_size}")
+            if len(data) - body_at < length:
+                break
+            at = body_at + length
+            self._decode(bytes(data[body_at:at]), messages)
+        return at
+
+    def _name(self, name_id):
+        return self.names.get(name_id, '?')
+
+    def _room_tag(self, room_id):
+        return f"#{self._name(room_id)}|" if room_id else ""
+
+    def _decode(self, body, messages):
+        code = body[0]
+        if 0x41 <= code <= 0x5a:
+            messages.append(chr(code) + "|" + body[1:].decode('utf-8'))
+        elif code == TEXT:
+            messages.append(body[1:].decode('utf-8'))
+        elif code == DEFINE:
+            name_id, at = read_varint(body, 1)
+            self.names[name_id] = body[at:].decode('utf-8')
+        elif code == CHAT:
+            room_id, at = read_varint(body, 1)
+            user_id, at = read_varint(body, at)
+            messages.append(f"R|{self._room_tag(room_id)}{self._name(user_id)}: {body[at:].decode('utf-8')}")
+        elif code == NOTICE:
+            room_id, at = read_varint(body, 1)
+            messages.append(f"R|{self._room_tag(room_id)}{body[at:].decode('utf-8')}")
+        elif code == COUNTS:
+            changes = []
+            at = 1
+            while at < len(body):
+                room_id, at = read_varint(body, at)
+                count, at = read_varint(body, at)
+                changes.append(f"{self._name(room_id)}={count}")
+            messages.append("D|" + ",".join(changes))
+        elif code == SIGNAL:
+            user_id, at = read_varint(body, 1)
+            messages.append(f'V|{{"from": {json.dumps(self._name(user_id))}, "payload": {body[at:].decode("utf-8")}}}')
+        elif code in (COMPRESSED, COMPRESSED_RESET):
+            if code == COMPRESSED_RESET or self._zlib is None:
+                self._zlib = zlib.decompressobj(-zlib.MAX_WBITS)
+            inflated = self._zlib.decompress(body[1:])
+            if self._read_frames(inflated, messages) != len(inflated):
+                raise Framing.FrameError("Compressed block ends mid-frame")
@@ -0,0 +1,77 @@
+import unittest
+
+import CallQuality
+
+T0 = 1000.0
+
+
+def report(**entry):
+    # What peer "a" reports about its stream from peer "b".
+    return {"action": "stats", "peers": {"b": entry}}
+
+
+class QualityBoardTest(unittest.TestCase):
+    def board(self, adaptive=False):
+        board = CallQuality.QualityBoard(adaptive=adaptive)
+        board.join("lobby", "a", now=T0)
+        board.join("lobby", "b", now=T0)
+        return board
+
+    def test_window_expires(self):
+        board = self.board()
+        board.ingest("lobby", "a", report(rtt=40), now=T0)
+        board.ingest("lobby", "a", report(rtt=60), now=T0 + 2)
+
+        rtt = board.snapshot(now=T0 + 3)["rooms"]["lobby"]["window"]["rtt_ms"]
+        self.assertEqual(rtt, {"count": 2, "avg": 50, "min": 40, "max": 60})
+
+        later = T0 + CallQuality.WINDOW_SECONDS + CallQuality.BUCKET_SECONDS
+        self.assertNotIn("rtt_ms", board.snapshot(now=later)["rooms"]["lobby"]["window"])
+        # Once the call is over too, the room is forgotten.
+        board.leave("lobby", "a", now=later)
+        board.leave("lobby", "b", now=later)
+        self.assertEqual(board.snapshot(now=later)["rooms"], {})
+        self.assertEqual(len(board.snapshot(now=later)["recent_calls"]), 1)
+
+    def test_reports_are_rate_limited_per_peer(self):
+        board = self.board()
+        board.ingest("lobby", "a", report(rtt=40), now=T0)
+        board.ingest("lobby", "a", report(rtt=40), now=T0 + CallQuality.MIN_REPORT_INTERVAL / 2)
+        board.ingest("lobby", "b", {"peers": {"a": {"rtt": 40}}}, now=T0 + CallQuality.MIN_REPORT_INTERVAL / 2)
+        board.ingest("lobby", "a", report(rtt=40), now=T0 + CallQuality.MIN_REPORT_INTERVAL)
+
+        call = board.snapshot(now=T0 + 2)["calls"][0]
+        self.assertEqual(call["reports"], 3)
+        self.assertEqual(call["window"]["rtt_ms"]["count"], 3)
+
+    def test_cap_decreases_on_loss_and_is_lifted_once_it_clears(self):
+        board = self.board(adaptive=True)
+        # 10% loss on a 1000 kbit/s stream from b.
+        hints = board.ingest("lobby", "a", report(lost=10, recv=90, dt=1000, rx=125000), now=T0)
+        self.assertEqual(hints, [("b", "a", int(1000000 * CallQuality.DECREASE))])
+        self.assertEqual(board.snapshot(now=T0)["calls"][0]["caps"], {"b->a": 700000})
+
+        # Still lossy, but within HINT_INTERVAL of the last change.
+        self.assertEqual(board.ingest("lobby", "a", report(lost=10, recv=90), now=T0 + 1), [])
+
+        caps = []
+        now = T0
+        while not caps or caps[-1] is not None:
+            now += CallQuality.HINT_INTERVAL
+            self.assertLess(now, T0 + 600, "the cap was never lifted")
+            for _, _, cap in board.ingest("lobby", "a", report(lost=0, recv=100), now=now):
+                caps.append(cap)
+        # Smoothed loss takes a few reports to fall: the cap keeps dropping,
+        # then climbs back step by step until it is lifted.
+        caps.pop()
+        lowest = caps.index(min(caps))
+        self.assertEqual(caps[:lowest + 1], sorted(caps[:lowest + 1], reverse=True))
+        self.assertEqual(caps[lowest:], sorted(caps[lowest:]))
+        self.assertGreaterEqual(caps[lowest], CallQuality.MIN_BITRATE)
+        self.assertGreater(caps[-1], 700000)
+        self.assertLess(caps[-1], CallQuality.MAX_BITRATE)
+        self.assertEqual(board.snapshot(now=now)["calls"][0]["caps"], {})
+
+
+if __name__ == '__main__':
+    unittest.main()